@@ -0,0 +1,6 @@
+"""
+Standalone benchmarks for the backend. These aren't collected by pytest, run
+them individually from the backend directory, e.g.:
+
+    uv run python -m benchmarks.bench_hashing --help
+"""
@@ -0,0 +1,85 @@
+"""
+Compares the time and peak memory of each hash engine across image sizes,
+along with the original whole-image tobytes() method for reference. Every
+measurement runs in a fresh process so that peak RSS isn't polluted by earlier
+runs. Peak memory is read from /proc, so this only runs on linux.
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated
+
+import typer
+from PIL import Image
+
+from benchmarks.corpus import generate_corpus
+from photosite_backend.image.hashing import HASH_ENGINES
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+app = typer.Typer()
+
+
+def hash_tobytes(image_path: Path):
+    with Image.open(image_path) as img:
+        return hashlib.sha256(img.tobytes()).hexdigest()
+
+
+METHODS = {"tobytes": hash_tobytes, **HASH_ENGINES}
+
+
+def peak_rss():
+    # unlike ru_maxrss, VmHWM isn't inherited from the parent across exec so
+    # the benchmark's own memory use doesn't leak into the measurement.
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+
+    raise RuntimeError("VmHWM missing from /proc/self/status")
+
+
+def measure(method: str, image_paths: list[Path]):
+    baseline = peak_rss()
+
+    start = time.perf_counter()
+    for image_path in image_paths:
+        METHODS[method](image_path)
+    elapsed = time.perf_counter() - start
+
+    peak = peak_rss()
+    return elapsed / len(image_paths), (peak - baseline) / 2**10
+
+
+@app.command()
+def main(
+    count: int = 4,
+    megapixels: Annotated[list[int] | None, typer.Option()] = None,
+):
+    megapixels = megapixels or [12, 24, 50]
+    context = multiprocessing.get_context("spawn")
+
+    logging.info("%4s %10s %14s %16s", "MP", "method", "ms per image", "peak MiB above")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in megapixels:
+            width = int((size * 1_000_000 * 4 / 3) ** 0.5)
+            height = width * 3 // 4
+            image_paths = generate_corpus(
+                Path(temp_dir) / str(size), count, (width, height)
+            )
+
+            for method in METHODS:
+                with context.Pool(1) as pool:
+                    seconds, peak = pool.apply(measure, (method, image_paths))
+
+                logging.info(
+                    "%4d %10s %14.1f %16.1f", size, method, seconds * 1000, peak
+                )
+
+
+if __name__ == "__main__":
+    app()
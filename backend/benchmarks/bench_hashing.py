@@ -0,0 +1,61 @@
+"""
+Measures how the wall time of hashing a corpus scales with the number of
+worker processes given to hash_images.
+"""
+
+import logging
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated
+
+import typer
+
+from benchmarks.corpus import generate_corpus
+from photosite_backend.image import hash_image, hash_images
+from photosite_backend.image.scan import ScannedImage
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+app = typer.Typer()
+
+
+@app.command()
+def main(
+    count: int = 64,
+    width: int = 4000,
+    height: int = 3000,
+    jobs: Annotated[list[int] | None, typer.Option()] = None,
+):
+    jobs = jobs or [1, 2, 4, 8, 16]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        logging.info("Generating %d %dx%d images...", count, width, height)
+        images = [
+            ScannedImage(path, path.stat())
+            for path in generate_corpus(Path(temp_dir), count, (width, height))
+        ]
+
+        logging.info("%6s %10s %10s %8s", "jobs", "seconds", "images/s", "speedup")
+        baseline: float | None = None
+        for job_count in jobs:
+            hash_image.cache_clear()
+
+            start = time.perf_counter()
+            for _ in hash_images(images, job_count):
+                pass
+            elapsed = time.perf_counter() - start
+
+            if baseline is None:
+                baseline = elapsed
+            logging.info(
+                "%6d %10.2f %10.1f %7.1fx",
+                job_count,
+                elapsed,
+                count / elapsed,
+                baseline / elapsed,
+            )
+
+
+if __name__ == "__main__":
+    app()
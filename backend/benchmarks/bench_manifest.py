@@ -0,0 +1,114 @@
+"""
+Compares what a client has to fetch and parse before it can show the newest
+images, between a single v2 manifest and a sharded v3 manifest, for synthetic
+galleries of various sizes.
+"""
+
+import hashlib
+import json
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Annotated
+
+import typer
+
+from photosite_backend.manifest import Manifest, ManifestEntry
+from photosite_backend.manifest.sharded import (
+    DEFAULT_SHARD_SIZE,
+    ShardOptions,
+    build_shards,
+)
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+app = typer.Typer()
+
+KEYWORDS = [f"keyword_{i}" for i in range(200)]
+
+
+def generate_manifest(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    start = datetime(2010, 1, 1)
+
+    images = {}
+    for i in range(count):
+        image_hash = hashlib.sha256(str(i).encode()).hexdigest()
+        created = start + timedelta(seconds=rng.randrange(15 * 365 * 24 * 3600))
+        images[image_hash] = ManifestEntry(
+            filename=f"{image_hash}.jpg",
+            created_date=created.strftime("%Y:%m:%d %H:%M:%S"),
+            keyword_tags=sorted(rng.sample(KEYWORDS, rng.randint(0, 6))),
+            derivatives=[
+                {
+                    "filename": f"{image_hash}_{width}w_q80.webp",
+                    "width": width,
+                    "height": width * 3 // 4,
+                    "format": "webp",
+                }
+                for width in (400, 1200, 2400)
+            ],
+        )
+
+    return Manifest(version=2, hash_engine="pixels", images=images)
+
+
+def time_parse(contents: list[bytes], repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in contents:
+            json.loads(content)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+@app.command()
+def main(
+    counts: Annotated[list[int] | None, typer.Option("--count")] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    repeat: int = 5,
+):
+    counts = counts or [10_000, 100_000]
+
+    logging.info(
+        "%8s %6s %14s %14s %14s",
+        "images",
+        "format",
+        "first paint KB",
+        "parse ms",
+        "total KB",
+    )
+    for count in counts:
+        manifest = generate_manifest(count)
+
+        v2_contents = json.dumps(manifest).encode()
+        logging.info(
+            "%8d %6s %14.1f %14.2f %14.1f",
+            count,
+            "v2",
+            len(v2_contents) / 2**10,
+            time_parse([v2_contents], repeat) * 1000,
+            len(v2_contents) / 2**10,
+        )
+
+        index, shard_files = build_shards(
+            manifest, ShardOptions(shard_size=shard_size, keyword_shards=False)
+        )
+        index_contents = json.dumps(index).encode()
+        # the frontend fetches the index, then the newest shard
+        first_paint = [index_contents, shard_files[index["shards"][-1]["filename"]]]
+        logging.info(
+            "%8d %6s %14.1f %14.2f %14.1f",
+            count,
+            "v3",
+            sum(map(len, first_paint)) / 2**10,
+            time_parse(first_paint, repeat) * 1000,
+            (len(index_contents) + sum(map(len, shard_files.values()))) / 2**10,
+        )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,92 @@
+"""
+Measures the encode time of a synthetic manifest with each JSON encoder, and
+the transfer size of each manifest layout uncompressed and precompressed.
+"""
+
+import gzip
+import json
+import logging
+import time
+from typing import Any, Callable
+
+import typer
+import ujson
+
+from benchmarks.bench_manifest import generate_manifest
+from photosite_backend.manifest.columnar import to_columnar
+from photosite_backend.manifest.encoding import brotli, compress, orjson
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+app = typer.Typer()
+
+
+def time_encode(encode, obj, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encode(obj)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+@app.command()
+def main(count: int = 50_000, repeat: int = 5):
+    manifest = generate_manifest(count)
+
+    encoders: dict[str, Callable[[Any], bytes]] = {
+        "json": lambda obj: json.dumps(obj).encode(),
+        "ujson": lambda obj: ujson.dumps(
+            obj, ensure_ascii=False, escape_forward_slashes=False
+        ).encode(),
+    }
+    if orjson:
+        encoders["orjson"] = orjson.dumps
+
+    layouts = {"rows": manifest, "columnar": to_columnar(manifest)}
+
+    logging.info("Encoding %d images", count)
+    logging.info("%10s %8s %10s", "layout", "encoder", "encode ms")
+    for layout, obj in layouts.items():
+        for encoder, encode in encoders.items():
+            logging.info(
+                "%10s %8s %10.1f",
+                layout,
+                encoder,
+                time_encode(encode, obj, repeat) * 1000,
+            )
+
+    logging.info("")
+    logging.info(
+        "%10s %10s %10s %10s %12s", "layout", "raw KB", "gz KB", "br KB", "gz ms"
+    )
+    for layout, obj in layouts.items():
+        contents = encoders["ujson"](obj)
+
+        start = time.perf_counter()
+        gz_size = len(compress(contents, "gz"))
+        gz_time = time.perf_counter() - start
+
+        br_size = len(compress(contents, "br")) / 2**10 if brotli else float("nan")
+        logging.info(
+            "%10s %10.1f %10.1f %10.1f %12.1f",
+            layout,
+            len(contents) / 2**10,
+            gz_size / 2**10,
+            br_size,
+            gz_time * 1000,
+        )
+
+    # what the old write_manifest produced
+    plain = json.dumps(manifest).encode()
+    logging.info("")
+    logging.info(
+        "json.dump baseline: %.1f KB, %.1f KB gzipped on the fly (level 6)",
+        len(plain) / 2**10,
+        len(gzip.compress(plain, compresslevel=6)) / 2**10,
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,68 @@
+"""
+Measures how many files per second the manifest's tags can be read from, in
+process by the JPEG metadata reader against exiftool in bulk, for a corpus of
+images carrying a capture date and keywords in IPTC and XMP.
+"""
+
+import logging
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated, Callable
+
+import typer
+
+from benchmarks.corpus import DEFAULT_CORPUS_SIZES, generate_corpus
+from photosite_backend.image import close_exiftool, read_tags_bulk
+from photosite_backend.image.metadata import MANIFEST_TAGS, read_jpeg_tags
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+app = typer.Typer()
+
+
+@app.command()
+def main(
+    count: int = 1000,
+    repeat: int = 3,
+    exiftool: Annotated[
+        bool, typer.Option(help="Also time exiftool, which needs it installed")
+    ] = True,
+):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        logging.info("Generating %d images...", count)
+        image_paths = generate_corpus(
+            Path(temp_dir), count, sizes=DEFAULT_CORPUS_SIZES, metadata=True
+        )
+
+        readers: dict[str, Callable[[], object]] = {
+            "in process": lambda: [read_jpeg_tags(p) for p in image_paths]
+        }
+        if exiftool:
+            readers["exiftool"] = lambda: read_tags_bulk(image_paths)
+
+        logging.info("%12s %10s %12s", "reader", "seconds", "files/s")
+        for name, read in readers.items():
+            # the first run starts exiftool, which isn't counted
+            read()
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                read()
+                best = min(best, time.perf_counter() - start)
+
+            logging.info("%12s %10.3f %12.0f", name, best, count / best)
+
+        if exiftool:
+            exiftool_tags = read_tags_bulk(image_paths)
+            mismatches = sum(
+                read_jpeg_tags(path)
+                != {tag: tags[tag] for tag in MANIFEST_TAGS if tag in tags}
+                for path, tags in exiftool_tags.items()
+            )
+            logging.info("%d files read differently to exiftool", mismatches)
+            close_exiftool()
+
+
+if __name__ == "__main__":
+    app()
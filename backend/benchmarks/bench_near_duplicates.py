@@ -0,0 +1,117 @@
+"""
+Measures building the near duplicate index and querying it, against comparing
+a query with every perceptual hash, and grouping every image's near duplicates,
+for synthetic galleries of various sizes where some images have near copies.
+"""
+
+import logging
+import random
+import time
+from typing import Annotated
+
+import typer
+
+from photosite_backend.image.perceptual import (
+    HammingIndex,
+    find_near_duplicates,
+    hamming_distance,
+)
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+app = typer.Typer()
+
+
+def generate_hashes(count: int, copy_ratio: float, seed: int = 0):
+    """
+    Random 64 bit hashes, with copy_ratio of them near copies of another (up
+    to 4 bits flipped), like re-exports of the same shot.
+    """
+
+    rng = random.Random(seed)
+    hashes: list[int] = []
+    for _ in range(count):
+        if hashes and rng.random() < copy_ratio:
+            value = rng.choice(hashes)
+            for bit in rng.sample(range(64), rng.randint(0, 4)):
+                value ^= 1 << bit
+        else:
+            value = rng.getrandbits(64)
+        hashes.append(value)
+
+    return hashes
+
+
+@app.command()
+def main(
+    counts: Annotated[list[int] | None, typer.Option("--count")] = None,
+    distances: Annotated[list[int] | None, typer.Option("--distance")] = None,
+    queries: int = 1000,
+    copy_ratio: float = 0.1,
+    group: Annotated[
+        bool, typer.Option(help="Also time grouping every image's near duplicates")
+    ] = True,
+):
+    counts = counts or [10_000, 100_000]
+    distances = distances or [4, 6, 10]
+
+    logging.info(
+        "%8s %8s %10s %12s %14s %10s %10s",
+        "images",
+        "distance",
+        "build s",
+        "query ms",
+        "brute ms",
+        "speedup",
+        "group s",
+    )
+    for count in counts:
+        hashes = generate_hashes(count, copy_ratio)
+        rng = random.Random(1)
+        sample = rng.sample(hashes, min(queries, count))
+
+        start = time.perf_counter()
+        index = HammingIndex()
+        for key, value in enumerate(hashes):
+            index.add(value, str(key))
+        build_seconds = time.perf_counter() - start
+
+        for max_distance in distances:
+            start = time.perf_counter()
+            for query in sample:
+                for _ in index.find(query, max_distance):
+                    pass
+            query_ms = (time.perf_counter() - start) * 1000 / len(sample)
+
+            # a tenth of the sample is plenty to time a linear scan with
+            brute_sample = sample[: max(1, len(sample) // 10)]
+            start = time.perf_counter()
+            for query in brute_sample:
+                for value in hashes:
+                    if hamming_distance(query, value) <= max_distance:
+                        pass
+            brute_ms = (time.perf_counter() - start) * 1000 / len(brute_sample)
+
+            group_seconds = float("nan")
+            if group:
+                perceptual_hashes = {
+                    str(key): f"{value:016x}" for key, value in enumerate(hashes)
+                }
+                start = time.perf_counter()
+                find_near_duplicates(perceptual_hashes, max_distance)
+                group_seconds = time.perf_counter() - start
+
+            logging.info(
+                "%8d %8d %10.2f %12.3f %14.3f %9.1fx %10.2f",
+                count,
+                max_distance,
+                build_seconds,
+                query_ms,
+                brute_ms,
+                brute_ms / query_ms,
+                group_seconds,
+            )
+
+
+if __name__ == "__main__":
+    app()
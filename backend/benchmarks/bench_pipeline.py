@@ -0,0 +1,400 @@
+"""
+Measures the throughput and peak memory of each stage of the sync pipeline
+against a synthetic corpus, with EXIF/IPTC/XMP metadata like a real gallery's:
+scanning, hashing (cold and from the hash cache), reading tags, building the
+manifest, uploading and writing the manifest, and sync end to end.
+
+Uploads and manifest writes go to both a local directory and a local s3
+stand-in, an async filesystem adding a fixed latency to every request.
+
+Peak memory is the peak resident set size of this process during each stage,
+so doesn't include worker processes when hashing with --jobs above 1.
+
+Results can be saved with --output and compared against an earlier run with
+--baseline, exiting non-zero if any stage got slower by more than --tolerance.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated, Callable, NamedTuple
+
+import typer
+from fsspec.asyn import AsyncFileSystem
+from fsspec.implementations.dirfs import DirFileSystem
+from fsspec.implementations.local import LocalFileSystem
+
+from benchmarks.corpus import DEFAULT_CORPUS_SIZES, generate_corpus
+from photosite_backend.image import (
+    hash_image,
+    hash_images,
+    read_tags,
+    read_tags_bulk,
+    set_hash_cache,
+)
+from photosite_backend.image.cache import HashCache
+from photosite_backend.image.hashing import HashEngine
+from photosite_backend.image.scan import get_images
+from photosite_backend.main import sync
+from photosite_backend.manifest import (
+    Manifest,
+    generate_manifest_entry,
+    write_manifest,
+)
+from photosite_backend.manifest.columnar import COLUMNAR_MANIFEST_VERSION
+from photosite_backend.manifest.sharded import (
+    DEFAULT_SHARD_SIZE,
+    SHARDED_MANIFEST_VERSION,
+    ShardOptions,
+)
+from photosite_backend.upload import DEFAULT_UPLOAD_CONCURRENCY, Uploader
+
+# main configures logging when imported
+logging.basicConfig(level=logging.INFO, format="%(message)s", force=True)
+
+# stages quicker than this are too noisy to compare against a baseline
+MIN_COMPARED_SECONDS = 0.1
+
+app = typer.Typer()
+
+
+class LocalS3StandIn(AsyncFileSystem):
+    """
+    An async filesystem over local paths which waits latency seconds before
+    every request, standing in for s3.
+    """
+
+    latency = 0.02
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._local = LocalFileSystem()
+
+    async def _request(self, method: str, *args, **kwargs):
+        await asyncio.sleep(self.latency)
+        return await asyncio.to_thread(getattr(self._local, method), *args, **kwargs)
+
+    async def _put_file(self, lpath, rpath, mode="overwrite", **kwargs):
+        return await self._request("put_file", lpath, rpath)
+
+    async def _pipe_file(self, path, value, *args, **kwargs):
+        return await self._request("pipe_file", path, value)
+
+    async def _cat_file(self, path, start=None, end=None, **kwargs):
+        return await self._request("cat_file", path, start=start, end=end)
+
+    async def _info(self, path, **kwargs):
+        return await self._request("info", path)
+
+    async def _ls(self, path, detail=True, **kwargs):
+        return await self._request("ls", path, detail=detail)
+
+    async def _rm_file(self, path, **kwargs):
+        return await self._request("rm_file", path)
+
+    def open(
+        self,
+        path,
+        mode="rb",
+        block_size=None,
+        cache_options=None,
+        compression=None,
+        **kwargs,
+    ):
+        return self._local.open(
+            path, mode, block_size, cache_options, compression, **kwargs
+        )
+
+
+class StageResult(NamedTuple):
+    stage: str
+    backend: str
+    seconds: float
+    items: int
+    bytes: int
+    # the most memory the process used during the stage
+    peak_rss: int
+
+    @property
+    def items_per_second(self):
+        return self.items / self.seconds if self.seconds else 0.0
+
+
+def _reset_peak_rss():
+    # linux resets the peak (VmHWM) when 5 is written to clear_refs, elsewhere
+    # the peak is only ever the peak of the whole run
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 2**10
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2**10
+
+
+def measure(
+    stage: str, backend: str, items: int, size: int, function: Callable[[], object]
+):
+    # keep the stage's own logging quiet, only the results are of interest
+    logging.disable(logging.INFO)
+    _reset_peak_rss()
+    start = time.perf_counter()
+    try:
+        function()
+    finally:
+        elapsed = time.perf_counter() - start
+        logging.disable(logging.NOTSET)
+
+    result = StageResult(stage, backend, elapsed, items, size, _peak_rss())
+    logging.info(
+        "%-26s %-6s %10.2f %12.1f %10.1f %10.0f",
+        stage,
+        backend,
+        elapsed,
+        result.items_per_second,
+        size / 2**20 / elapsed if elapsed else 0.0,
+        result.peak_rss / 2**20,
+    )
+    return result
+
+
+def _parse_size(size: str):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def _compare(results: list[StageResult], baseline_path: Path, tolerance: float):
+    with baseline_path.open() as file:
+        baseline = {
+            (result["stage"], result["backend"]): result for result in json.load(file)
+        }
+
+    regressions = 0
+    for result in results:
+        previous = baseline.get((result.stage, result.backend))
+        if (
+            not previous
+            or min(previous["seconds"], result.seconds) < MIN_COMPARED_SECONDS
+        ):
+            continue
+
+        previous_rate = previous["items"] / previous["seconds"]
+        if result.items_per_second < previous_rate * (1 - tolerance):
+            regressions += 1
+            logging.warning(
+                "%s (%s) regressed: %.1f/s, was %.1f/s",
+                result.stage,
+                result.backend,
+                result.items_per_second,
+                previous_rate,
+            )
+
+    return regressions
+
+
+@app.command()
+def main(
+    count: int = 1000,
+    sizes: Annotated[
+        list[str] | None,
+        typer.Option("--size", help="WIDTHxHEIGHT of images, can be repeated"),
+    ] = None,
+    corpus_dir: Annotated[
+        Path | None,
+        typer.Option(help="Keep the generated corpus here to reuse across runs"),
+    ] = None,
+    jobs: int = os.cpu_count() or 1,
+    engines: Annotated[
+        list[str] | None, typer.Option("--engine", help="Hash engines to measure")
+    ] = None,
+    upload_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+    latency: float = 0.02,
+    output: Annotated[
+        Path | None, typer.Option(help="Write the results to this JSON file")
+    ] = None,
+    baseline: Annotated[
+        Path | None,
+        typer.Option(help="Compare against the results of an earlier --output"),
+    ] = None,
+    tolerance: float = 0.2,
+):
+    image_sizes = [_parse_size(size) for size in sizes] if sizes else None
+    hash_engines: list[HashEngine] = engines or ["pixels", "scan"]  # type: ignore
+    LocalS3StandIn.latency = latency
+    has_exiftool = shutil.which("exiftool") is not None
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = Path(temp_dir)
+        source_dir = corpus_dir or work_dir / "corpus"
+
+        logging.info("Generating %d images into `%s`...", count, source_dir)
+        generate_corpus(
+            source_dir,
+            count,
+            sizes=image_sizes or DEFAULT_CORPUS_SIZES,
+            metadata=True,
+            jobs=jobs,
+        )
+
+        logging.info(
+            "%-26s %-6s %10s %12s %10s %10s",
+            "stage",
+            "dest",
+            "seconds",
+            "items/s",
+            "MB/s",
+            "peak MB",
+        )
+
+        results: list[StageResult] = []
+        scanned_images = sorted(get_images(source_dir))
+        image_paths = [image.path for image in scanned_images]
+        corpus_bytes = sum(image.stat.st_size for image in scanned_images)
+
+        results.append(
+            measure("scan", "-", count, 0, lambda: list(get_images(source_dir)))
+        )
+
+        set_hash_cache(None)
+        image_hashes: dict[Path, str] = {}
+        for engine in hash_engines:
+            hash_image.cache_clear()
+            results.append(
+                measure(
+                    f"hash ({engine})",
+                    "-",
+                    count,
+                    corpus_bytes,
+                    lambda: image_hashes.update(
+                        hash_images(scanned_images, jobs, engine)
+                    ),
+                )
+            )
+
+        hash_cache = HashCache(work_dir / "cache")
+        set_hash_cache(hash_cache)
+        for _ in hash_images(scanned_images, jobs, hash_engines[-1]):
+            pass
+        hash_image.cache_clear()
+        results.append(
+            measure(
+                "hash (cached)",
+                "-",
+                count,
+                corpus_bytes,
+                lambda: list(hash_images(scanned_images, jobs, hash_engines[-1])),
+            )
+        )
+        hash_cache.close()
+        set_hash_cache(None)
+
+        image_tags = {path: {} for path in image_paths}
+        if has_exiftool:
+            read_tags.cache_clear()
+            results.append(
+                measure(
+                    "read_tags",
+                    "-",
+                    count,
+                    corpus_bytes,
+                    lambda: image_tags.update(read_tags_bulk(image_paths)),
+                )
+            )
+        else:
+            logging.warning("exiftool isn't installed, skipping reading tags")
+
+        images = {}
+
+        def build_entries():
+            for path in image_paths:
+                images[image_hashes[path]] = generate_manifest_entry(
+                    path, image_tags[path], image_hashes[path], hash_engines[-1]
+                )
+
+        results.append(measure("manifest entries", "-", count, 0, build_entries))
+
+        manifests = {
+            "v2": Manifest(version=2, hash_engine=hash_engines[-1], images=images),
+            "v3": Manifest(
+                version=SHARDED_MANIFEST_VERSION,
+                hash_engine=hash_engines[-1],
+                sharding=ShardOptions(
+                    shard_size=DEFAULT_SHARD_SIZE, keyword_shards=True
+                ),
+                images=images,
+            ),
+            "columnar": Manifest(
+                version=COLUMNAR_MANIFEST_VERSION,
+                hash_engine=hash_engines[-1],
+                images=images,
+            ),
+        }
+
+        filesystems = {"dir": LocalFileSystem(), "s3": LocalS3StandIn()}
+        for backend, fs in filesystems.items():
+            dest = work_dir / f"dest_{backend}"
+            dest.mkdir()
+            dest_fs = DirFileSystem(str(dest), fs)
+
+            def upload():
+                with Uploader(dest_fs, upload_concurrency) as uploader:
+                    for path in image_paths:
+                        uploader.submit(path, f"{image_hashes[path]}.jpg")
+
+            results.append(measure("upload", backend, count, corpus_bytes, upload))
+
+            for manifest_format, manifest in manifests.items():
+                results.append(
+                    measure(
+                        f"write_manifest ({manifest_format})",
+                        backend,
+                        count,
+                        0,
+                        lambda: write_manifest(dest_fs, manifest),
+                    )
+                )
+
+        if has_exiftool:
+            sync_dest = work_dir / "dest_sync"
+            sync_dest.mkdir()
+            results.append(
+                measure(
+                    "sync",
+                    "dir",
+                    count,
+                    corpus_bytes,
+                    lambda: sync(
+                        source_dir,
+                        str(sync_dest),
+                        jobs=jobs,
+                        upload_concurrency=upload_concurrency,
+                        hash_engine=hash_engines[-1],
+                    ),
+                )
+            )
+
+    if output:
+        output.write_text(
+            json.dumps([result._asdict() for result in results], indent=2)
+        )
+
+    if baseline and _compare(results, baseline, tolerance):
+        raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,109 @@
+"""
+Measures upload throughput against concurrency. Uploads go to local stand-ins
+for a remote backend which add a fixed latency to every request, for both the
+threaded (sync filesystem) and event loop (async filesystem, like s3) paths.
+"""
+
+import asyncio
+import logging
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated
+
+import typer
+from fsspec.asyn import AsyncFileSystem
+from fsspec.implementations.dirfs import DirFileSystem
+from fsspec.implementations.local import LocalFileSystem
+
+from benchmarks.corpus import generate_corpus
+from photosite_backend.image import hash_image
+from photosite_backend.upload import Uploader
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+app = typer.Typer()
+
+
+class LatencyFileSystem(LocalFileSystem):
+    latency = 0.05
+
+    def pipe_file(self, path, value, mode="overwrite", **kwargs):
+        time.sleep(self.latency)
+        return super().pipe_file(path, value, mode, **kwargs)
+
+    def put_file(self, path1, path2, callback=None, **kwargs):
+        time.sleep(self.latency)
+        return super().put_file(path1, path2, callback, **kwargs)
+
+
+class AsyncLatencyFileSystem(AsyncFileSystem):
+    latency = 0.05
+
+    # the base class only raises NotImplementedError, so is typed as never
+    # returning
+    async def _put_file(self, lpath, rpath, mode="overwrite", **kwargs):  # type: ignore
+        await asyncio.sleep(self.latency)
+        await asyncio.to_thread(shutil.copyfile, lpath, rpath)
+
+
+def run(dest_fs: DirFileSystem, image_paths: list[Path], concurrency: int):
+    start = time.perf_counter()
+    with Uploader(dest_fs, concurrency) as uploader:
+        for image_path in image_paths:
+            uploader.submit(image_path, f"{hash_image(image_path)}.jpg")
+
+    return time.perf_counter() - start, uploader.uploaded_bytes
+
+
+@app.command()
+def main(
+    count: int = 64,
+    width: int = 1200,
+    height: int = 800,
+    latency: float = 0.05,
+    concurrency: Annotated[list[int] | None, typer.Option()] = None,
+):
+    concurrency = concurrency or [1, 2, 4, 8, 16, 32]
+    LatencyFileSystem.latency = AsyncLatencyFileSystem.latency = latency
+
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_paths = generate_corpus(Path(temp_dir) / "in", count, (width, height))
+        # hash up front so only the uploads are timed
+        for image_path in image_paths:
+            hash_image.__wrapped__(image_path)
+
+        filesystems = {
+            "threads": LatencyFileSystem(),
+            "async": AsyncLatencyFileSystem(),
+        }
+
+        logging.disable(logging.NOTSET)
+        logging.info(
+            "%d images, %.0fms simulated latency per request", count, latency * 1000
+        )
+        logging.info("%8s %12s %10s %10s", "mode", "concurrency", "images/s", "MB/s")
+        for mode, fs in filesystems.items():
+            for slots in concurrency:
+                dest = Path(temp_dir) / f"out_{mode}_{slots}"
+                dest.mkdir()
+
+                logging.disable(logging.INFO)
+                elapsed, uploaded_bytes = run(
+                    DirFileSystem(str(dest), fs), image_paths, slots
+                )
+                logging.disable(logging.NOTSET)
+
+                logging.info(
+                    "%8s %12d %10.1f %10.1f",
+                    mode,
+                    slots,
+                    count / elapsed,
+                    uploaded_bytes / 2**20 / elapsed,
+                )
+
+
+if __name__ == "__main__":
+    app()
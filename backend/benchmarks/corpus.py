@@ -0,0 +1,175 @@
+"""
+Generates synthetic photo corpora for the benchmarks to run against.
+
+Images can optionally carry the metadata a real gallery's would, a capture date
+in EXIF and keywords in both IPTC and XMP (including hierarchical subjects), so
+reading tags and building the manifest do realistic amounts of work.
+"""
+
+import io
+import random
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Sequence
+
+from PIL import Image
+
+from photosite_backend.image.jpeg import APP13
+
+# a mix of landscape and portrait photos at typical web export sizes
+DEFAULT_CORPUS_SIZES = [(2400, 1600), (1600, 2400), (1600, 1200), (1200, 800)]
+
+KEYWORD_HIERARCHIES = [
+    ["animal", "bird", "magpie"],
+    ["animal", "bird", "kookaburra"],
+    ["animal", "cat"],
+    ["animal", "dog"],
+    ["place", "australia", "melbourne"],
+    ["place", "australia", "sydney"],
+    ["place", "japan", "tokyo"],
+    ["place", "japan", "kyoto"],
+    ["event", "concert"],
+    ["event", "wedding"],
+    ["film"],
+    ["digital"],
+    ["night"],
+    ["portrait"],
+    ["landscape"],
+    ["street"],
+]
+
+EXIF_IFD = 0x8769
+EXIF_DATETIME = 0x0132
+EXIF_DATETIME_ORIGINAL = 0x9003
+
+XMP_TEMPLATE = """<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:lr="http://ns.adobe.com/lightroom/1.0/">
+   <dc:subject><rdf:Bag>{subjects}</rdf:Bag></dc:subject>
+   <lr:hierarchicalSubject><rdf:Bag>{hierarchical}</rdf:Bag></lr:hierarchicalSubject>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>"""
+
+
+def generate_image(size: tuple[int, int], rng: random.Random):
+    # a tiny random image scaled up smoothly compresses and decodes much more
+    # like a real photo than pure noise would, while still being unique.
+    seed_size = (32, 24)
+    seed = Image.frombytes(
+        "RGB", seed_size, rng.randbytes(seed_size[0] * seed_size[1] * 3)
+    )
+
+    return seed.resize(size, Image.Resampling.BICUBIC)
+
+
+def _xmp(hierarchies: list[list[str]]):
+    subjects = sorted({keyword for hierarchy in hierarchies for keyword in hierarchy})
+    return XMP_TEMPLATE.format(
+        subjects="".join(f"<rdf:li>{subject}</rdf:li>" for subject in subjects),
+        hierarchical="".join(
+            f"<rdf:li>{'|'.join(hierarchy)}</rdf:li>" for hierarchy in hierarchies
+        ),
+    ).encode()
+
+
+def _iptc_segment(keywords: list[str]):
+    """
+    Builds an APP13 segment holding an IPTC record with the keywords, the way
+    photoshop (and so everything else) stores it.
+    """
+
+    # record version, then a 2:25 dataset per keyword
+    records = b"\x1c\x02\x00\x00\x02\x00\x04"
+    for keyword in keywords:
+        value = keyword.encode()
+        records += b"\x1c\x02\x19" + struct.pack(">H", len(value)) + value
+    if len(records) % 2:
+        records += b"\x00"
+
+    # an 8BIM image resource 0x0404 (IPTC-NAA) with an empty pascal name
+    resource = b"8BIM\x04\x04\x00\x00" + struct.pack(">I", len(records)) + records
+    payload = b"Photoshop 3.0\x00" + resource
+
+    return bytes([0xFF, APP13]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def _generate_photo(path: Path, size: tuple[int, int], seed: int, metadata: bool):
+    rng = random.Random(seed)
+    image = generate_image(size, rng)
+    # written under a temporary name, so an interrupted run never leaves a
+    # partial image behind to be reused
+    partial_path = path.with_name(f".{path.name}.partial")
+
+    if not metadata:
+        image.save(partial_path, "JPEG", quality=90)
+        partial_path.replace(path)
+        return
+
+    created = datetime(2015, 1, 1) + timedelta(seconds=rng.randrange(10 * 365 * 86400))
+    exif = Image.Exif()
+    exif[EXIF_DATETIME] = created.strftime("%Y:%m:%d %H:%M:%S")
+    exif.get_ifd(EXIF_IFD)[EXIF_DATETIME_ORIGINAL] = exif[EXIF_DATETIME]
+
+    hierarchies = rng.sample(KEYWORD_HIERARCHIES, rng.randint(1, 4))
+    keywords = sorted({keyword for hierarchy in hierarchies for keyword in hierarchy})
+
+    output = io.BytesIO()
+    image.save(output, "JPEG", quality=90, exif=exif, xmp=_xmp(hierarchies))
+    data = output.getvalue()
+
+    # PIL can't write IPTC, so splice it in straight after the SOI marker
+    partial_path.write_bytes(data[:2] + _iptc_segment(keywords) + data[2:])
+    partial_path.replace(path)
+
+
+def generate_corpus(
+    dest: Path,
+    count: int,
+    size: tuple[int, int] = (4000, 3000),
+    seed: int = 0,
+    sizes: Sequence[tuple[int, int]] | None = None,
+    metadata: bool = False,
+    jobs: int = 1,
+):
+    """
+    Writes count unique JPEGs into dest, returning their paths. Each image is
+    size, or picked at random from sizes if given. With metadata set, each
+    image gets a capture date and some keywords.
+
+    Images already in dest from an earlier run with the same arguments are
+    reused rather than generated again.
+    """
+
+    rng = random.Random(seed)
+    dest.mkdir(parents=True, exist_ok=True)
+
+    paths = []
+    pending = []
+    for index in range(count):
+        path = dest / f"photo_{index:06}.jpg"
+        paths.append(path)
+
+        image_size = rng.choice(sizes) if sizes else size
+        image_seed = rng.getrandbits(64)
+        if not path.exists():
+            pending.append((path, image_size, image_seed, metadata))
+
+    if not pending:
+        return paths
+
+    if jobs <= 1:
+        for arguments in pending:
+            _generate_photo(*arguments)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for _ in executor.map(_generate_photo, *zip(*pending), chunksize=16):
+                pass
+
+    return paths
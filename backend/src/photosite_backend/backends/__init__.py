@@ -1,23 +1,29 @@
-from typing import Literal
+from typing import TYPE_CHECKING, Any, Literal
 
-from fsspec.implementations.dirfs import DirFileSystem
-from fsspec.implementations.local import LocalFileSystem
-from s3fs import S3FileSystem
-
-import photosite_backend.backends.s3 as s3
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
 
 dest_type_options = Literal["dir", "s3"]
 
 
-def get_fs(dest: str, dest_type: dest_type_options):
+def get_fs(dest: str, dest_type: dest_type_options, max_connections: int = 10):
+    # fsspec, and s3fs (which pulls in botocore) even more so, are slow to
+    # import, so they're only imported once a dest is actually needed
+    from fsspec.implementations.dirfs import DirFileSystem
+    from fsspec.implementations.local import LocalFileSystem
+
     if dest_type == "dir":
         return DirFileSystem(dest, LocalFileSystem())
     if dest_type == "s3":
+        import photosite_backend.backends.s3 as s3
+
         account_id, access_key, access_key_secret, is_r2 = (
             s3.get_configuration_from_env()
         )
 
-        extra_kwargs = {}
+        extra_kwargs: dict[str, dict[str, Any]] = {}
+        # enough connections for every concurrent upload to have its own
+        extra_kwargs["config_kwargs"] = dict(max_pool_connections=max_connections)
         if is_r2:
             extra_kwargs["client_kwargs"] = dict(
                 endpoint_url=f"https://{account_id}.r2.cloudflarestorage.com",
@@ -26,7 +32,19 @@ def get_fs(dest: str, dest_type: dest_type_options):
             extra_kwargs["s3_additional_kwargs"] = dict(ACL="private")
         return DirFileSystem(
             dest,
-            S3FileSystem(key=access_key, secret=access_key_secret, **extra_kwargs),
+            s3.CountingS3FileSystem(
+                key=access_key, secret=access_key_secret, **extra_kwargs
+            ),
         )
 
     raise
+
+
+def is_local(dest_fs: "DirFileSystem"):
+    """
+    Whether dest is a local directory.
+    """
+
+    from fsspec.implementations.local import LocalFileSystem
+
+    return isinstance(dest_fs.fs, LocalFileSystem)
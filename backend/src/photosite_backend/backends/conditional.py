@@ -0,0 +1,216 @@
+"""
+This file contains conditional writes, for read-modify-writes of a file in dest
+which don't lose the changes of anything else writing it at the same time.
+
+A file is read along with a version of it, and written back only if it's still
+at that version. On s3 the version is the file's ETag, and the write is an
+If-Match (or If-None-Match if it didn't exist) put. For local directories the
+version is a hash of the file's contents, which is checked and the file
+replaced with an atomic rename while holding a lock file.
+"""
+
+import hashlib
+import logging
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, NamedTuple, TypeVar
+
+from photosite_backend.backends import is_local
+
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
+
+
+DEFAULT_COMMIT_ATTEMPTS = 10
+
+# a lock file older than this was left behind by a writer which died holding it
+STALE_LOCK_SECONDS = 30.0
+
+# s3 error codes for a conditional write whose condition didn't hold
+PRECONDITION_FAILED_CODES = {"PreconditionFailed", "ConditionalRequestConflict"}
+
+T = TypeVar("T")
+
+
+class PreconditionFailedError(Exception):
+    """
+    The file was changed by something else since it was read.
+    """
+
+
+class FileVersion(NamedTuple):
+    # None if the file didn't exist when it was read
+    tag: str | None
+
+
+def read_versioned(dest_fs: "DirFileSystem", filename: str):
+    """
+    Reads a file from dest along with its version, the contents are None if it
+    doesn't exist.
+    """
+
+    if is_local(dest_fs):
+        try:
+            contents = dest_fs.cat_file(filename)
+        except FileNotFoundError:
+            return None, FileVersion(tag=None)
+
+        return contents, FileVersion(tag=hashlib.sha256(contents).hexdigest())
+
+    # the ETag is fetched first, so if the contents are newer than it the
+    # conditional write fails rather than overwriting them
+    dest_fs.invalidate_cache(filename)
+    try:
+        tag = dest_fs.info(filename)["ETag"]
+        contents = dest_fs.cat_file(filename)
+    except FileNotFoundError:
+        return None, FileVersion(tag=None)
+
+    return contents, FileVersion(tag=tag)
+
+
+def _break_stale_lock(lock_path: str):
+    """
+    Removes lock_path if it was left behind by a writer which died holding it,
+    returning whether it's worth trying to take the lock again straight away.
+
+    The lock is moved aside before it's removed, and put back if it turns out
+    not to be the stale one, so writers which all find the same stale lock
+    can't each remove the lock another of them has since taken.
+    """
+
+    try:
+        stale = os.stat(lock_path)
+    except FileNotFoundError:
+        return True
+    if time.time() - stale.st_mtime <= STALE_LOCK_SECONDS:
+        return False
+
+    moved_path = f"{lock_path}.{uuid.uuid4().hex}.stale"
+    try:
+        os.rename(lock_path, moved_path)
+    except FileNotFoundError:
+        return True
+
+    try:
+        moved = os.stat(moved_path)
+        if (moved.st_ino, moved.st_mtime_ns) == (stale.st_ino, stale.st_mtime_ns):
+            logging.warning("Removing stale lock file `%s`", lock_path)
+            return True
+
+        # another writer broke the stale lock and took a new one first
+        try:
+            os.link(moved_path, lock_path)
+        except FileExistsError:
+            logging.warning("Lock file `%s` was taken while put aside", lock_path)
+        return False
+    finally:
+        os.unlink(moved_path)
+
+
+@contextmanager
+def _lock_file(path: str):
+    lock_path = f"{path}.lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if _break_stale_lock(lock_path):
+                continue
+
+            time.sleep(random.uniform(0.005, 0.05))
+
+    try:
+        os.close(fd)
+        yield
+    finally:
+        os.unlink(lock_path)
+
+
+def _write_local(path: str, contents: bytes, version: FileVersion):
+    with _lock_file(path):
+        try:
+            with open(path, "rb") as file:
+                tag = hashlib.sha256(file.read()).hexdigest()
+        except FileNotFoundError:
+            tag = None
+
+        if tag != version.tag:
+            raise PreconditionFailedError(f"`{path}` has changed since it was read")
+
+        # written beside the file, so it can be renamed over it atomically. not
+        # a tempfile, which would be created readable only by its owner
+        temp_path = Path(path).with_name(
+            f".{os.path.basename(path)}.{uuid.uuid4().hex}.partial"
+        )
+        try:
+            with temp_path.open("wb") as file:
+                file.write(contents)
+                file.flush()
+                os.fsync(file.fileno())
+            temp_path.replace(path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+
+def write_conditional(
+    dest_fs: "DirFileSystem",
+    filename: str,
+    contents: bytes,
+    version: FileVersion,
+    **kwargs,
+):
+    """
+    Writes a file to dest only if it's still at version, raising
+    PreconditionFailedError otherwise. kwargs are passed on to the upload.
+    """
+
+    if is_local(dest_fs):
+        _write_local(os.path.join(dest_fs.path, filename), contents, version)
+        return
+
+    if version.tag is None:
+        kwargs["IfNoneMatch"] = "*"
+    else:
+        kwargs["IfMatch"] = version.tag
+
+    try:
+        dest_fs.pipe_file(filename, contents, **kwargs)
+    except FileExistsError as error:
+        raise PreconditionFailedError(
+            f"`{filename}` was created by another writer"
+        ) from error
+    except OSError as error:
+        response = getattr(error.__cause__, "response", None) or {}
+        if response.get("Error", {}).get("Code") in PRECONDITION_FAILED_CODES:
+            raise PreconditionFailedError(
+                f"`{filename}` has changed since it was read"
+            ) from error
+        raise
+
+
+def retry_on_conflict(
+    attempt: Callable[[], T], attempts: int = DEFAULT_COMMIT_ATTEMPTS
+):
+    """
+    Calls attempt, a whole read-modify-write, until it doesn't raise
+    PreconditionFailedError, backing off a random and increasing time between
+    tries so competing writers spread out.
+    """
+
+    for attempt_number in range(attempts):
+        try:
+            return attempt()
+        except PreconditionFailedError:
+            if attempt_number == attempts - 1:
+                raise
+
+            logging.info("Another writer got there first, retrying")
+            time.sleep(random.uniform(0, 0.05 * 2**attempt_number))
+
+    raise ValueError("attempts must be at least 1")
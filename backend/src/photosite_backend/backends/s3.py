@@ -1,5 +1,9 @@
 import os
 
+from s3fs import S3FileSystem
+
+from photosite_backend.metrics import count
+
 
 def get_configuration_from_env():
     account_id = os.getenv("S3_ACCOUNT_ID")
@@ -15,3 +19,15 @@ def get_configuration_from_env():
         raise ValueError("Missing S3 access key secret")
 
     return (account_id, access_key, access_key_secret, is_r2)
+
+
+class CountingS3FileSystem(S3FileSystem):
+    """
+    An S3FileSystem which counts the requests made to s3, by API method.
+    """
+
+    async def _call_s3(self, method, *args, **kwargs):
+        count("s3.requests")
+        count(f"s3.requests.{method}")
+
+        return await super()._call_s3(method, *args, **kwargs)
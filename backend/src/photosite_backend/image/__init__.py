@@ -1,16 +1,51 @@
-import hashlib
+import atexit
 import logging
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from pathlib import Path
-from typing import Any, List
+from typing import TYPE_CHECKING, Any, Iterable
 
-import exiftool
-from exiftool import ExifToolHelper
-from fsspec.implementations.dirfs import DirFileSystem
-from PIL import Image
+from photosite_backend.backends import is_local
+from photosite_backend.image.cache import HashCache
+from photosite_backend.image.hashing import (
+    DEFAULT_HASH_ENGINE,
+    HashEngine,
+    compute_hash,
+)
+from photosite_backend.image.metadata import read_jpeg_tags
+from photosite_backend.image.preview import ImagePreview, hash_and_preview
+from photosite_backend.image.scan import ScannedImage
+from photosite_backend.image.strip import StripOptions, strip_metadata
+from photosite_backend.metrics import count, phase
+from photosite_backend.utils import lru_cache
 
-from photosite_backend.utils import cache, lru_cache
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
 
-ALLOWED_EXTENSIONS = (".jpg", ".jpeg")
+    from photosite_backend.image.exiftool_pool import ExifToolPool
+
+# the most of a file held in memory at once while streaming it to dest. this is
+# also the part size for multipart uploads, so must be at least 5MiB for s3.
+TRANSFER_CHUNK_SIZE = 8 * 2**20
+
+# how many images to have queued for each hashing worker process, enough to
+# keep them busy without reading far ahead of them
+HASH_QUEUE_PER_JOB = 4
+
+# how many files to hand to exiftool in each call when reading tags in bulk
+DEFAULT_EXIFTOOL_CHUNK_SIZE = 100
+
+# how many exiftool processes to read and write tags with at once
+DEFAULT_EXIFTOOL_PROCESSES = min(4, os.cpu_count() or 1)
 
 # these are the keys left behind by exiftool after removing ALL
 # 'tags'
@@ -40,109 +75,405 @@ PERMANENT_TAGS = {
 }
 
 
-def get_images(input_path: Path):
-    return {
-        entry
-        for entry in input_path.iterdir()
-        if (entry.is_file() and entry.suffix in ALLOWED_EXTENSIONS)
-    }
+# the persistent hash cache used by hash_image, if any. this is configured once
+# by the CLI at startup.
+_hash_cache: HashCache | None = None
+
+
+def set_hash_cache(hash_cache: HashCache | None):
+    global _hash_cache
+
+    _hash_cache = hash_cache
+    hash_image.cache_clear()
+
+
+def get_hash_cache():
+    return _hash_cache
 
 
 @lru_cache(maxsize=5)
-def hash_image(image_path: Path):
+def hash_image(image_path: Path, engine: HashEngine = DEFAULT_HASH_ENGINE):
     # hashes just the image data, not the metadata, for identifying images
     # even when their metadata has been modified.
 
-    with Image.open(image_path) as img:
-        image_bytes = img.tobytes()
-        sha256_hash = hashlib.sha256(image_bytes).hexdigest()
-        return sha256_hash
+    hash_cache = get_hash_cache()
+    if not hash_cache:
+        return _compute_hash(image_path, engine, image_path.stat())
 
+    # stat before hashing, so a file modified mid-hash is never cached
+    stat = image_path.stat()
+    image_hash = hash_cache.get(image_path, stat, engine)
+    if image_hash:
+        count("hash_cache.hits")
+    else:
+        count("hash_cache.misses")
+        image_hash = _compute_hash(image_path, engine, stat)
+        hash_cache.set(image_path, image_hash, stat, engine)
 
-class ExifToolWithClear(ExifToolHelper):
-    def clear(self, files: Any | List[Any]):
-        """
-                    Delete all tags for the given files.
+    return image_hash
 
-                :param files: File(s) to be worked on.
 
-            * If a non-iterable is provided, it will get tags for a single item (str(non-iterable))
-            * If an iterable is provided, the list is passed into :py:meth:`execute_json` verbatim.
+def _compute_hash(image_path: Path, engine: HashEngine, stat: os.stat_result):
+    with phase("hash"):
+        image_hash = compute_hash(image_path, engine)
 
-            .. note::
-                Any files/params which are not bytes/str will be casted to a str in :py:meth:`execute()`.
+    count("hash.files")
+    count("hash.bytes", stat.st_size)
+    return image_hash
 
-            .. warning::
-                Currently, filenames are NOT checked for existence!  That is left up to the caller.
 
-            .. warning::
-                Wildcard strings are valid and passed verbatim to exiftool.
+def hash_images(
+    images: Iterable[ScannedImage],
+    jobs: int = 1,
+    engine: HashEngine = DEFAULT_HASH_ENGINE,
+    previews: dict[str, ImagePreview] | None = None,
+):
+    """
+    Hashes many images (with the stat results they were found with, see
+    image.scan), decoding them across up to `jobs` worker processes.
+
+    Yields (image_path, image_hash) pairs as each image finishes rather than in
+    the order they were given, so callers can get started on the results while
+    the rest are still being hashed. images is consumed as it's hashed, so it
+    can be a generator still finding them. Images already in the hash cache
+    are yielded straight away, without being decoded.
+
+    If previews is given, images which are decoded to be hashed (by the pixels
+    engine) are also previewed from that decode, and their previews added to it
+    by image hash. Others are left to be previewed separately.
+    """
 
-                However, exiftool's wildcard matching/globbing may be different than Python's matching/globbing,
-                which may cause unexpected behavior if you're using one and comparing the result to the other.
-                Read `ExifTool Common Mistakes - Over-use of Wildcards in File Names`_ for some related info.
+    hash_cache = get_hash_cache()
+    previewing = previews is not None and engine == "pixels"
+
+    def hashed(image_path, stat, image_hash, preview):
+        count("hash.files")
+        count("hash.bytes", stat.st_size)
+        if hash_cache:
+            hash_cache.set(image_path, image_hash, stat, engine)
+        if previews is not None and preview is not None:
+            count("preview.files")
+            previews[image_hash] = preview
+
+    if jobs <= 1:
+        for image_path, stat in images:
+            image_hash = _cached_hash(hash_cache, image_path, stat, engine)
+            if image_hash is None:
+                with phase("hash"):
+                    image_hash, preview = _hash_uncached(image_path, engine, previewing)
+                hashed(image_path, stat, image_hash, preview)
+            yield image_path, image_hash
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # images are handed to the workers as they arrive (e.g. as the scan lists
+    # each directory), rather than once they've all been found
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures: dict[Future, tuple[Path, os.stat_result]] = {}
+
+        def finished(done: Iterable[Future]):
+            for future in done:
+                image_path, stat = futures.pop(future)
+                image_hash, preview = future.result()
+                hashed(image_path, stat, image_hash, preview)
+                yield image_path, image_hash
+
+        for image_path, stat in images:
+            image_hash = _cached_hash(hash_cache, image_path, stat, engine)
+            if image_hash:
+                yield image_path, image_hash
+                continue
+
+            future = executor.submit(_hash_uncached, image_path, engine, previewing)
+            futures[future] = image_path, stat
+
+            # wait for a worker to finish once the queue is full, yielding any
+            # which have already
+            full = len(futures) >= jobs * HASH_QUEUE_PER_JOB
+            done, _ = wait(
+                futures, timeout=None if full else 0, return_when=FIRST_COMPLETED
+            )
+            yield from finished(done)
+
+        yield from finished(as_completed(list(futures)))
+
+
+def _cached_hash(
+    hash_cache: HashCache | None,
+    image_path: Path,
+    stat: os.stat_result,
+    engine: HashEngine,
+):
+    """
+    Returns the hash of image_path if it's in the hash cache.
+    """
 
-        :type files: Any or List(Any) - see Note
+    if not hash_cache:
+        return None
 
-        :return: The format of the return value is the same as for :py:meth:`exiftool.ExifTool.execute_json()`.
+    image_hash = hash_cache.get(image_path, stat, engine)
+    count("hash_cache.hits" if image_hash else "hash_cache.misses")
+    return image_hash
 
 
-                :raises ValueError: Invalid Parameter
-                :raises TypeError: Invalid Parameter
-                :raises ExifToolExecuteError: If :py:attr:`check_execute` == True, and exit status was non-zero
+def _hash_uncached(
+    image_path: Path, engine: HashEngine, previewing: bool
+) -> tuple[str, ImagePreview | None]:
+    if previewing:
+        return hash_and_preview(image_path)
 
-                .. _ExifTool Common Mistakes - Over-use of Wildcards in File Names: https://exiftool.org/mistakes.html#M2
+    return compute_hash(image_path, engine), None
 
-        """
 
-        final_files: List = self.__class__._parse_arg_files(files)
-        exec_params: List = []
+_exiftool_processes = DEFAULT_EXIFTOOL_PROCESSES
+_exiftool_pool: "ExifToolPool | None" = None
+_exiftool_pool_lock = threading.Lock()
+
+
+def set_exiftool_processes(processes: int):
+    """
+    Sets how many exiftool processes to keep open, closing the current pool so
+    the next call starts a pool of the new size.
+    """
+
+    global _exiftool_processes
+
+    _exiftool_processes = processes
+    close_exiftool()
+
 
-        exec_params.extend(["-all="])
-        exec_params.extend(final_files)
-        try:
-            ret = self.execute(*exec_params)
-        except exiftool.exceptions.ExifToolOutputEmptyError:
-            raise
-            # raise RuntimeError(f"{self.__class__.__name__}.get_tags: exiftool returned no data")
-        except exiftool.exceptions.ExifToolJSONInvalidError:
-            raise
-        except exiftool.exceptions.ExifToolExecuteError:
-            # if last_status is <> 0, raise an error that one or more files failed?
-            raise
-
-        return ret
-
-
-# for now, just keep one instance of exiftool open for the duration of the
-# tool's run time
-@cache
 def get_exiftool():
-    et = ExifToolWithClear()
-    et.common_args = (et.common_args or []) + ["-overwrite_original"]
+    """
+    The exiftool processes are kept open for the duration of the tool's run
+    time, and shared between threads.
+    """
+
+    global _exiftool_pool
+
+    with _exiftool_pool_lock:
+        if _exiftool_pool is None:
+            # imported here, as pyexiftool is slow to import and only needed
+            # when reading or writing tags
+            from photosite_backend.image.exiftool_pool import (
+                ExifToolPool,
+                start_exiftool,
+            )
+
+            _exiftool_pool = ExifToolPool(start_exiftool, _exiftool_processes)
+
+        return _exiftool_pool
 
-    return et
+
+@atexit.register
+def close_exiftool():
+    global _exiftool_pool
+
+    with _exiftool_pool_lock:
+        pool, _exiftool_pool = _exiftool_pool, None
+
+    if pool:
+        pool.close()
 
 
 @lru_cache(maxsize=5)
 def read_tags(image_path: Path):
     exiftool = get_exiftool()
-    # this library really seems to want to be run in bulk, todo: consider refactor
-    # to use in bulk.
-    tags: dict[str, Any] = exiftool.get_metadata(str(image_path))[0]
+    # prefer read_tags_bulk when reading many files, this costs a round trip
+    # through exiftool per call.
+    with phase("exiftool"):
+        tags: dict[str, Any] = exiftool.get_metadata(str(image_path))[0]
+    count("exiftool.calls")
+    count("exiftool.files")
     return tags
 
 
-def write_image(dest_fs: DirFileSystem, image_path: Path):
+def _read_chunk_tags(chunk: list[Path]):
+    from exiftool.exceptions import ExifToolException
+
+    try:
+        count("exiftool.calls")
+        count("exiftool.files", len(chunk))
+        with phase("exiftool"):
+            return get_exiftool().get_metadata([str(path) for path in chunk])
+    except ExifToolException:
+        logging.warning(
+            "Failed to read tags for %d files in bulk, retrying individually",
+            len(chunk),
+        )
+        return []
+
+
+def read_tags_bulk(
+    image_paths: Iterable[Path], chunk_size: int = DEFAULT_EXIFTOOL_CHUNK_SIZE
+):
     """
-    Writes an image into dest, named after its image hash.
+    Reads the tags of many images, handing them to exiftool chunk_size files at
+    a time, with a chunk in flight on each process of the exiftool pool. If
+    exiftool fails on a chunk, the files in it are retried one at a time so
+    that a single bad file only affects itself.
     """
 
-    output_filename = f"{hash_image(image_path)}{image_path.suffix}"
-    dest_fs.write_bytes(output_filename, image_path.read_bytes())
+    image_paths = list(image_paths)
+    tags: dict[Path, dict[str, Any]] = {}
+    chunks = [
+        image_paths[start : start + chunk_size]
+        for start in range(0, len(image_paths), chunk_size)
+    ]
+
+    if len(chunks) <= 1 or _exiftool_processes <= 1:
+        chunks_tags = map(_read_chunk_tags, chunks)
+    else:
+        with ThreadPoolExecutor(
+            max_workers=min(_exiftool_processes, len(chunks))
+        ) as executor:
+            chunks_tags = list(executor.map(_read_chunk_tags, chunks))
+
+    for chunk, chunk_tags in zip(chunks, chunks_tags):
+        # exiftool reports files in the order they were given
+        if len(chunk_tags) == len(chunk):
+            tags.update(zip(chunk, chunk_tags))
+            continue
+
+        for image_path in chunk:
+            tags[image_path] = read_tags(image_path)
+
+    return tags
+
+
+def read_manifest_tags(image_path: Path):
+    """
+    Reads the tags the manifest needs from an image (see image.metadata), in
+    process if possible and with exiftool if not.
+    """
+
+    with phase("read_metadata"):
+        tags = read_jpeg_tags(image_path)
+
+    return read_tags(image_path) if tags is None else tags
+
+
+def read_manifest_tags_bulk(
+    image_paths: Iterable[Path], chunk_size: int = DEFAULT_EXIFTOOL_CHUNK_SIZE
+):
+    """
+    Reads the tags the manifest needs from many images, in process where
+    possible, handing the rest to exiftool in bulk (see read_tags_bulk).
+    """
+
+    image_paths = list(image_paths)
+    tags: dict[Path, dict[str, Any]] = {}
+    unusual = []
+    with phase("read_metadata"):
+        for image_path in image_paths:
+            image_tags = read_jpeg_tags(image_path)
+            if image_tags is None:
+                unusual.append(image_path)
+            else:
+                tags[image_path] = image_tags
+
+    if unusual:
+        tags.update(read_tags_bulk(unusual, chunk_size))
+
+    return {image_path: tags[image_path] for image_path in image_paths}
+
+
+def image_filename(image_path: Path, image_hash: str):
+    """
+    Returns the content addressed filename an image is stored under in dest.
+    """
+
+    return f"{image_hash}{image_path.suffix.lower()}"
+
+
+def transfer_file(
+    dest_fs: "DirFileSystem",
+    source_path: Path,
+    filename: str,
+    strip: StripOptions | None = None,
+):
+    """
+    Streams source_path into dest as filename, without ever holding more than
+    TRANSFER_CHUNK_SIZE of it in memory. If strip is given, the image's
+    metadata is stripped on the way (see image.strip).
+
+    For local dests the copy is done by the kernel (sendfile/copy_file_range)
+    into a temporary file that is renamed into place once complete, so a
+    partial file never appears under its final name. Each transfer has a
+    temporary file of its own, as images with the same pixels but different
+    metadata are transferred to the same filename. Other dests only commit the
+    file once it's complete (e.g. completing an s3 multipart upload), and
+    discard it if the transfer fails.
+    """
+
+    if is_local(dest_fs):
+        dest_path = Path(dest_fs._join(filename))
+        # not a tempfile, which would be created readable only by its owner
+        temp_path = dest_path.with_name(f".{dest_path.name}.{uuid.uuid4().hex}.partial")
+
+        try:
+            if strip is None:
+                shutil.copyfile(source_path, temp_path)
+            else:
+                with temp_path.open("wb") as dest:
+                    strip_metadata(source_path, dest, strip)
+            temp_path.replace(dest_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+        return
+
+    dest = dest_fs.open(
+        filename, "wb", block_size=TRANSFER_CHUNK_SIZE, autocommit=False
+    )
+    try:
+        with dest:
+            if strip is None:
+                with source_path.open("rb") as source:
+                    shutil.copyfileobj(source, dest, TRANSFER_CHUNK_SIZE)
+            else:
+                strip_metadata(source_path, dest, strip)
+    except BaseException:
+        dest.discard()
+        raise
+    dest.commit()
+
+
+def write_image(
+    dest_fs: "DirFileSystem", image_path: Path, image_hash: str | None = None
+):
+    """
+    Writes an image into dest, named after its image hash. If the image has
+    already been hashed, pass it as image_hash to avoid hashing it again.
+    """
+
+    output_filename = image_filename(image_path, image_hash or hash_image(image_path))
+    transfer_file(dest_fs, image_path, output_filename)
     logging.info(
         "Wrote image `%s` to `%s/%s`",
         image_path.name,
         dest_fs.path,
         output_filename,
     )
+
+
+def remove_images(dest_fs: "DirFileSystem", filenames: Iterable[str]):
+    """
+    Removes the given files from dest in one go, ignoring any that are already
+    missing.
+    """
+
+    filenames = sorted(filenames)
+    if not filenames:
+        return
+
+    try:
+        dest_fs.rm(filenames)
+    except FileNotFoundError:
+        # some backends give up on the first missing file, so finish the rest
+        # one by one.
+        for filename in filenames:
+            if dest_fs.exists(filename):
+                dest_fs.rm(filename)
+
+    for filename in filenames:
+        logging.info("Removed `%s/%s`", dest_fs.path, filename)
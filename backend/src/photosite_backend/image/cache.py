@@ -0,0 +1,183 @@
+"""
+A persistent cache of image hashes, so that unchanged source files don't have
+to be decoded again on every run.
+
+Entries are keyed by the file's absolute path and the hash engine used, and are
+only considered valid while the file's size, modification time and inode still
+match what was recorded when it was hashed.
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import NamedTuple
+
+from photosite_backend.image.hashing import DEFAULT_HASH_ENGINE, HashEngine
+
+CACHE_FILENAME = "hash_cache.sqlite3"
+
+# bump this whenever the table layout or the meaning of a stored hash changes,
+# existing caches with a different version are discarded.
+SCHEMA_VERSION = 2
+
+
+def default_cache_dir():
+    xdg_cache_home = os.getenv("XDG_CACHE_HOME")
+    base_dir = Path(xdg_cache_home) if xdg_cache_home else Path.home() / ".cache"
+
+    return base_dir / "photosite"
+
+
+class CacheStats(NamedTuple):
+    path: Path
+    entries: int
+    size: int
+
+
+class HashCache:
+    def __init__(self, cache_dir: Path):
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.path = cache_dir / CACHE_FILENAME
+
+        # hashes may be recorded from worker threads, so share the one
+        # connection and serialise access to it ourselves.
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+
+        (version,) = self._connection.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            self._connection.execute("DROP TABLE IF EXISTS hashes")
+            self._connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT NOT NULL,
+                engine TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (path, engine)
+            )
+            """
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def _key(image_path: Path):
+        return str(image_path.absolute())
+
+    def get(
+        self,
+        image_path: Path,
+        stat: os.stat_result | None = None,
+        engine: HashEngine = DEFAULT_HASH_ENGINE,
+    ):
+        """
+        Returns the cached hash of image_path, or None if it hasn't been hashed
+        before or the file has changed since.
+        """
+
+        stat = stat or image_path.stat()
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT size, mtime_ns, inode, hash FROM hashes"
+                " WHERE path = ? AND engine = ?",
+                (self._key(image_path), engine),
+            ).fetchone()
+
+        if not row:
+            return None
+
+        size, mtime_ns, inode, image_hash = row
+        if (size, mtime_ns, inode) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return None
+
+        return str(image_hash)
+
+    def set(
+        self,
+        image_path: Path,
+        image_hash: str,
+        stat: os.stat_result,
+        engine: HashEngine = DEFAULT_HASH_ENGINE,
+    ):
+        """
+        Records the hash of image_path. stat should be taken before the file was
+        hashed, so that a file modified while being hashed isn't cached.
+        """
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self._key(image_path),
+                    engine,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    stat.st_ino,
+                    image_hash,
+                ),
+            )
+            self._connection.commit()
+
+    def stats(self):
+        with self._lock:
+            (entries,) = self._connection.execute(
+                "SELECT COUNT(*) FROM hashes"
+            ).fetchone()
+
+        size = sum(
+            path.stat().st_size
+            for path in self.path.parent.glob(f"{CACHE_FILENAME}*")
+            if path.is_file()
+        )
+
+        return CacheStats(path=self.path, entries=entries, size=size)
+
+    def prune(self):
+        """
+        Removes entries for files which no longer exist or have changed since
+        they were hashed. Returns the number of entries removed.
+        """
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path, engine, size, mtime_ns, inode FROM hashes"
+            ).fetchall()
+
+        stale = []
+        for path, engine, size, mtime_ns, inode in rows:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stale.append((path, engine))
+                continue
+
+            if (size, mtime_ns, inode) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                stale.append((path, engine))
+
+        with self._lock:
+            self._connection.executemany(
+                "DELETE FROM hashes WHERE path = ? AND engine = ?", stale
+            )
+            self._connection.commit()
+            self._connection.execute("VACUUM")
+
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM hashes")
+            self._connection.commit()
+            self._connection.execute("VACUUM")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,274 @@
+"""
+Renders resized derivatives of images (e.g. thumbnails in WebP/AVIF), so the
+frontend can load something appropriately sized rather than the original.
+
+Derivatives are named after the source image's hash and the parameters they
+were rendered with, so a given file never changes once written. Rendered files
+are kept in a local directory, and an image is only decoded if one of its
+derivatives is missing from both there and dest.
+"""
+
+import math
+import tempfile
+import uuid
+from concurrent.futures import as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Collection, Iterable, Literal, NamedTuple
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+DerivativeFormat = Literal["webp", "avif", "jpeg"]
+
+DEFAULT_DERIVATIVE_FORMATS: list[DerivativeFormat] = ["webp"]
+
+DERIVATIVE_QUALITY: dict[DerivativeFormat, int] = {
+    "webp": 80,
+    "avif": 55,
+    "jpeg": 82,
+}
+
+# name of the directory derivatives are rendered into, within the cache dir
+DERIVATIVE_CACHE_DIRNAME = "derivatives"
+
+# these exif orientations rotate the image by 90 degrees
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+class DerivativeSpec(NamedTuple):
+    width: int
+    format: DerivativeFormat
+
+    @property
+    def quality(self):
+        return DERIVATIVE_QUALITY[self.format]
+
+
+class Derivative(NamedTuple):
+    filename: str
+    # where the rendered file is kept locally, ready to be uploaded. None if
+    # dest already holds it and it wasn't rendered.
+    path: Path | None
+    width: int
+    height: int
+    format: DerivativeFormat
+
+
+def derivative_specs(widths: Iterable[int], formats: Iterable[DerivativeFormat]):
+    unique_formats: dict[DerivativeFormat, None] = dict.fromkeys(formats)
+    return [
+        DerivativeSpec(width, derivative_format)
+        for width in sorted(set(widths))
+        for derivative_format in unique_formats
+    ]
+
+
+def derivative_filename(image_hash: str, spec: DerivativeSpec):
+    return f"{image_hash}_{spec.width}w_q{spec.quality}.{spec.format}"
+
+
+@contextmanager
+def derivative_output_dir(cache_dir: Path | None):
+    """
+    The directory to render derivatives into: within cache_dir so they are
+    kept between runs, or a temporary directory for this run if caching is
+    disabled.
+    """
+
+    if cache_dir:
+        yield cache_dir / DERIVATIVE_CACHE_DIRNAME
+        return
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        yield Path(temp_dir)
+
+
+def oriented_size(img: "Image.Image"):
+    """
+    The size of an opened image once its EXIF orientation is applied, read
+    from its header without decoding it.
+    """
+
+    from PIL import ExifTags
+
+    orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        return img.height, img.width
+
+    return img.width, img.height
+
+
+def _derivative_height(oriented_width: int, oriented_height: int, width: int):
+    return max(1, round(oriented_height * width / oriented_width))
+
+
+def _render(
+    image_path: Path, image_hash: str, specs: list[DerivativeSpec], output_dir: Path
+):
+    from PIL import Image, ImageOps
+
+    with Image.open(image_path) as img:
+        oriented_width, oriented_height = oriented_size(img)
+
+        # never upscale, the original already covers those widths
+        specs = [spec for spec in specs if spec.width < oriented_width]
+        if not specs:
+            return
+
+        # let the jpeg decoder downscale by up to 8x while decoding, as long as
+        # the result is still at least as big as the largest derivative. this
+        # is far cheaper than decoding at full size and resizing.
+        scale = max(spec.width for spec in specs) / oriented_width
+        img.draft("RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+
+        icc_profile = img.info.get("icc_profile")
+        oriented = ImageOps.exif_transpose(img)
+        if oriented.mode != "RGB":
+            oriented = oriented.convert("RGB")
+
+    for spec in sorted(specs, key=lambda spec: spec.width, reverse=True):
+        # sized from the header rather than the reduced decode, so the same as
+        # a derivative already in dest is recorded with
+        height = _derivative_height(oriented_width, oriented_height, spec.width)
+        resized = oriented.resize(
+            (spec.width, height), Image.Resampling.LANCZOS, reducing_gap=3.0
+        )
+
+        # render to a temporary name, so an interrupted render never leaves a
+        # partial file that looks finished. each render has its own, as images
+        # with the same pixels but different metadata can be rendered at once
+        output_path = output_dir / derivative_filename(image_hash, spec)
+        partial_path = output_path.with_name(
+            f".{output_path.name}.{uuid.uuid4().hex}.partial"
+        )
+        try:
+            resized.save(
+                partial_path,
+                format=spec.format.upper(),
+                quality=spec.quality,
+                icc_profile=icc_profile,
+            )
+            partial_path.replace(output_path)
+        finally:
+            partial_path.unlink(missing_ok=True)
+
+
+def render_derivatives(
+    image_path: Path,
+    image_hash: str,
+    specs: list[DerivativeSpec],
+    output_dir: Path,
+    in_dest: Collection[str] = (),
+    published: Iterable[Derivative] = (),
+):
+    """
+    Renders the derivatives of an image into output_dir, skipping any which
+    have already been rendered. Widths at least as wide as the image itself are
+    skipped.
+
+    Derivatives dest already holds (their filenames in in_dest) aren't rendered
+    either, they're taken from published (the image's manifest entry) or sized
+    from the image's header.
+
+    Returns the derivatives which exist for the image.
+    """
+
+    from PIL import Image
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    published_by_filename = {
+        derivative.filename: derivative for derivative in published
+    }
+
+    missing = [
+        spec
+        for spec in specs
+        if derivative_filename(image_hash, spec) not in in_dest
+        and not (output_dir / derivative_filename(image_hash, spec)).exists()
+    ]
+    if missing:
+        _render(image_path, image_hash, missing, output_dir)
+
+    oriented: tuple[int, int] | None = None
+    derivatives = []
+    for spec in specs:
+        filename = derivative_filename(image_hash, spec)
+        if filename in published_by_filename and filename in in_dest:
+            derivatives.append(published_by_filename[filename])
+            continue
+
+        if filename in in_dest:
+            if oriented is None:
+                # only reads the header
+                with Image.open(image_path) as img:
+                    oriented = oriented_size(img)
+            height = _derivative_height(*oriented, spec.width)
+            derivatives.append(
+                Derivative(filename, None, spec.width, height, spec.format)
+            )
+            continue
+
+        path = output_dir / filename
+        if not path.exists():
+            continue
+
+        # only reads the header
+        with Image.open(path) as img:
+            width, height = img.size
+
+        derivatives.append(Derivative(filename, path, width, height, spec.format))
+
+    return derivatives
+
+
+def render_all_derivatives(
+    images: Iterable[tuple[Path, str]],
+    specs: list[DerivativeSpec],
+    output_dir: Path,
+    jobs: int = 1,
+    in_dest: Callable[[str], bool] | None = None,
+    published: dict[str, list[Derivative]] | None = None,
+):
+    """
+    Renders the derivatives of many (image_path, image_hash) pairs across up to
+    `jobs` worker processes. in_dest says whether dest already holds a
+    derivative, and published has the derivatives in the manifest by image
+    hash, see render_derivatives.
+
+    Yields (image_path, derivatives) pairs as each image finishes, rather than
+    in the order they were given.
+    """
+
+    def arguments(image_path: Path, image_hash: str):
+        # checked here, the listing of dest isn't shared with the workers
+        filenames = [derivative_filename(image_hash, spec) for spec in specs]
+        return (
+            image_path,
+            image_hash,
+            specs,
+            output_dir,
+            {filename for filename in filenames if in_dest and in_dest(filename)},
+            (published or {}).get(image_hash, []),
+        )
+
+    if jobs <= 1:
+        for image_path, image_hash in images:
+            yield (
+                image_path,
+                render_derivatives(*arguments(image_path, image_hash)),
+            )
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                render_derivatives, *arguments(image_path, image_hash)
+            ): image_path
+            for image_path, image_hash in images
+        }
+
+        for future in as_completed(futures):
+            yield futures[future], future.result()
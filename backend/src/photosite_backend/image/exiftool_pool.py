@@ -0,0 +1,177 @@
+"""
+A pool of persistent exiftool processes, so reading and writing tags isn't
+limited to the one file at a time a single exiftool process can work on.
+
+Processes are only started once there's more work than the idle ones can take,
+up to the pool's size. Each call checks out an idle process for its duration,
+so calls from up to size threads at once each get their own process. A process
+which died, or failed in a way that might have left its output out of step
+with its input, is terminated and replaced by a fresh one on the next call.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, List
+
+from exiftool import ExifToolHelper
+from exiftool.exceptions import (
+    ExifToolExecuteError,
+    ExifToolJSONInvalidError,
+    ExifToolOutputEmptyError,
+)
+
+# errors exiftool reports cleanly about the files it was given, after which the
+# process is still in step and can carry on being used
+FILE_ERRORS = (ExifToolExecuteError, ExifToolJSONInvalidError, ExifToolOutputEmptyError)
+
+
+class ExifToolWithClear(ExifToolHelper):
+    def clear(self, files: Any | List[Any]):
+        """
+                    Delete all tags for the given files.
+
+                :param files: File(s) to be worked on.
+
+            * If a non-iterable is provided, it will get tags for a single item (str(non-iterable))
+            * If an iterable is provided, the list is passed into :py:meth:`execute_json` verbatim.
+
+            .. note::
+                Any files/params which are not bytes/str will be casted to a str in :py:meth:`execute()`.
+
+            .. warning::
+                Currently, filenames are NOT checked for existence!  That is left up to the caller.
+
+            .. warning::
+                Wildcard strings are valid and passed verbatim to exiftool.
+
+                However, exiftool's wildcard matching/globbing may be different than Python's matching/globbing,
+                which may cause unexpected behavior if you're using one and comparing the result to the other.
+                Read `ExifTool Common Mistakes - Over-use of Wildcards in File Names`_ for some related info.
+
+        :type files: Any or List(Any) - see Note
+
+        :return: The format of the return value is the same as for :py:meth:`exiftool.ExifTool.execute_json()`.
+
+
+                :raises ValueError: Invalid Parameter
+                :raises TypeError: Invalid Parameter
+                :raises ExifToolExecuteError: If :py:attr:`check_execute` == True, and exit status was non-zero
+
+                .. _ExifTool Common Mistakes - Over-use of Wildcards in File Names: https://exiftool.org/mistakes.html#M2
+
+        """
+
+        final_files: List = self.__class__._parse_arg_files(files)
+        exec_params: List = []
+
+        exec_params.extend(["-all="])
+        exec_params.extend(final_files)
+        try:
+            ret = self.execute(*exec_params)
+        except ExifToolOutputEmptyError:
+            raise
+            # raise RuntimeError(f"{self.__class__.__name__}.get_tags: exiftool returned no data")
+        except ExifToolJSONInvalidError:
+            raise
+        except ExifToolExecuteError:
+            # if last_status is <> 0, raise an error that one or more files failed?
+            raise
+
+        return ret
+
+
+def start_exiftool():
+    et = ExifToolWithClear()
+    et.common_args = (et.common_args or []) + ["-overwrite_original"]
+
+    return et
+
+
+class ExifToolPool:
+    def __init__(self, factory: Callable[[], ExifToolHelper], size: int):
+        self.size = size
+        self._factory = factory
+
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # most recently used last, so the warmest processes are reused first
+        self._idle: list[ExifToolHelper] = []
+        self._closed = False
+
+    @contextmanager
+    def checkout(self):
+        """
+        Yields an exiftool process for the caller to use alone, blocking while
+        every process in the pool is in use.
+        """
+
+        self._slots.acquire()
+        try:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("The exiftool pool has been closed")
+                exiftool = self._idle.pop() if self._idle else None
+
+            # a process which died while idle is replaced
+            if exiftool is not None and not exiftool.running:
+                logging.warning("An idle exiftool process died, replacing it")
+                self._terminate(exiftool)
+                exiftool = None
+            if exiftool is None:
+                exiftool = self._factory()
+
+            try:
+                yield exiftool
+            except FILE_ERRORS:
+                self._release(exiftool)
+                raise
+            except BaseException:
+                logging.warning("exiftool failed, replacing its process")
+                self._terminate(exiftool)
+                raise
+            else:
+                self._release(exiftool)
+        finally:
+            self._slots.release()
+
+    def _release(self, exiftool: ExifToolHelper):
+        with self._lock:
+            if not self._closed:
+                self._idle.append(exiftool)
+                return
+
+        self._terminate(exiftool)
+
+    @staticmethod
+    def _terminate(exiftool: ExifToolHelper):
+        try:
+            if exiftool.running:
+                exiftool.terminate()
+        except Exception:
+            logging.exception("Failed to terminate an exiftool process")
+
+    def get_metadata(self, files: Any, **kwargs) -> list[dict[str, Any]]:
+        with self.checkout() as exiftool:
+            return exiftool.get_metadata(files, **kwargs)
+
+    def set_tags(self, files: Any, tags: dict[str, Any], **kwargs):
+        with self.checkout() as exiftool:
+            return exiftool.set_tags(files, tags, **kwargs)
+
+    def clear(self, files: Any):
+        with self.checkout() as exiftool:
+            return exiftool.clear(files)  # type: ignore
+
+    def close(self):
+        """
+        Terminates every process in the pool. Processes still checked out are
+        terminated as they are returned.
+        """
+
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+
+        for exiftool in idle:
+            self._terminate(exiftool)
@@ -0,0 +1,82 @@
+"""
+The engines that can be used to hash images. Every engine ignores metadata, so
+an image's hash is stable when its tags are edited, but each engine produces
+different hashes for the same image. The engine used is recorded in the
+manifest, so hashes from different engines are never compared.
+
+pixels: SHA-256 of the decoded pixel data. Stable across lossless
+    re-encodes, but requires fully decoding every image.
+scan: SHA-256 of every JPEG segment other than APPn/COM, including the entropy
+    coded scan data. Never decodes the image, so is many times faster and uses
+    no more memory than the file's page cache, but a lossless re-encode (or
+    exiftool rewriting the quantisation tables) changes the hash.
+"""
+
+import hashlib
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal
+
+from photosite_backend.image.jpeg import is_metadata_marker, iter_segments, open_jpeg
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+HashEngine = Literal["pixels", "scan"]
+
+DEFAULT_HASH_ENGINE: HashEngine = "pixels"
+
+# roughly how much of the decoded image to convert to bytes at a time when
+# hashing pixels
+PIXEL_STRIP_SIZE = 4 * 2**20
+
+
+def hash_pixels(image_path: Path):
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        img.load()
+        return hash_decoded(img)
+
+
+def hash_decoded(img: "Image.Image"):
+    """
+    The pixels engine's hash of an image which has already been decoded.
+    """
+
+    # feed the hasher a strip of rows at a time rather than converting the
+    # whole image to one huge bytes object. this hashes exactly the same
+    # bytes as img.tobytes() would.
+    sha256_hash = hashlib.sha256()
+    row_size = max(1, len(img.crop((0, 0, img.width, 1)).tobytes()))
+    rows_per_strip = max(1, PIXEL_STRIP_SIZE // row_size)
+
+    for top in range(0, img.height, rows_per_strip):
+        bottom = min(top + rows_per_strip, img.height)
+        sha256_hash.update(img.crop((0, top, img.width, bottom)).tobytes())
+
+    return sha256_hash.hexdigest()
+
+
+def hash_scan(image_path: Path):
+    sha256_hash = hashlib.sha256()
+
+    with open_jpeg(image_path) as data, memoryview(data) as view:
+        for segment in iter_segments(data):
+            if not is_metadata_marker(segment.marker):
+                sha256_hash.update(view[segment.start : segment.end])
+
+    return sha256_hash.hexdigest()
+
+
+HASH_ENGINES = {
+    "pixels": hash_pixels,
+    "scan": hash_scan,
+}
+
+
+def compute_hash(image_path: Path, engine: HashEngine = DEFAULT_HASH_ENGINE):
+    """
+    Hashes an image with the given engine, bypassing any caching.
+    """
+
+    return HASH_ENGINES[engine](image_path)
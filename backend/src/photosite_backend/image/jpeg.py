@@ -0,0 +1,299 @@
+"""
+Helpers for walking the marker segments of a JPEG file without decoding it.
+
+A JPEG is a sequence of segments, each starting with a 0xFF byte and a marker
+byte, most followed by a two byte big endian length (which includes itself)
+and that many bytes of payload. The entropy coded image data following an SOS
+segment has no length, any 0xFF byte within it is either followed by 0x00
+(a stuffed byte) or a restart marker, so the next real marker can be found by
+searching for a 0xFF followed by anything else.
+
+Also walks the metadata held in the APP1 EXIF and APP13 Photoshop segments:
+the TIFF structure EXIF is stored in, and the IPTC datasets held in a Photoshop
+image resource.
+"""
+
+import mmap
+import struct
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+SOI = 0xD8
+EOI = 0xD9
+SOS = 0xDA
+APP0 = 0xE0
+APP1 = 0xE1
+APP2 = 0xE2
+APP13 = 0xED
+APP14 = 0xEE
+APP15 = 0xEF
+COM = 0xFE
+
+# restart markers may appear within entropy coded data, and have no length
+RST_MARKERS = range(0xD0, 0xD8)
+
+# what the payload of each kind of metadata segment starts with
+EXIF_HEADER = b"Exif\x00\x00"
+XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+PHOTOSHOP_HEADER = b"Photoshop 3.0\x00"
+
+EXIF_IFD_POINTER = 0x8769
+
+TIFF_BYTE_ORDERS = {b"II": "<", b"MM": ">"}
+TIFF_ASCII = 2
+TIFF_LONG = 4
+# the size of a single value of each TIFF type, entries of any other type are
+# skipped
+TIFF_TYPE_SIZES = {
+    1: 1,
+    2: 1,
+    3: 2,
+    4: 4,
+    5: 8,
+    6: 1,
+    7: 1,
+    8: 2,
+    9: 4,
+    10: 8,
+    11: 4,
+    12: 8,
+}
+
+PHOTOSHOP_IPTC_RESOURCE = 0x0404
+
+
+class Segment(NamedTuple):
+    marker: int
+    # offset of the segment's 0xFF byte in the file
+    start: int
+    # offset just past the end of the segment, for SOS this includes the
+    # entropy coded data following it
+    end: int
+    # offset and length of the segment's payload, not including its length
+    payload_start: int
+    payload_length: int
+
+
+class IfdEntry(NamedTuple):
+    tag: int
+    type: int
+    value_count: int
+    value: bytes
+
+
+class ExifIfds(NamedTuple):
+    # the struct byte order of the TIFF structure, `<` or `>`
+    order: str
+    ifd0: list[IfdEntry]
+    # the EXIF IFD IFD0 points to, empty if there isn't one
+    exif_ifd: list[IfdEntry]
+
+
+class IptcDataset(NamedTuple):
+    record: int
+    dataset: int
+    value: bytes
+    # whether the dataset has an extended (longer than 32767 bytes) length
+    extended: bool
+
+
+def is_metadata_marker(marker: int):
+    """
+    APPn and COM segments only hold metadata, everything else describes the
+    image itself.
+    """
+
+    return APP0 <= marker <= APP15 or marker == COM
+
+
+def _entropy_data_end(data: mmap.mmap | bytes, offset: int):
+    """
+    Returns the offset of the first marker after the entropy coded data
+    starting at offset.
+    """
+
+    while True:
+        offset = data.find(b"\xff", offset)  # type: ignore
+        if offset == -1 or offset + 1 >= len(data):
+            raise ValueError("JPEG ended without an EOI marker")
+
+        next_byte = data[offset + 1]
+        if next_byte == 0x00 or next_byte in RST_MARKERS or next_byte == 0xFF:
+            offset += 1
+            continue
+
+        return offset
+
+
+def iter_segments(
+    data: mmap.mmap | bytes, stop_at_sos: bool = False
+) -> Iterator[Segment]:
+    """
+    Yields the segments of the JPEG in data, from SOI up to and including EOI,
+    or the first SOS if stop_at_sos is set.
+
+    Raises ValueError if data isn't a JPEG or is truncated.
+    """
+
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("Not a JPEG, missing SOI marker")
+
+    yield Segment(SOI, 0, 2, 2, 0)
+    offset = 2
+
+    while True:
+        if offset + 2 > len(data) or data[offset] != 0xFF:
+            raise ValueError(f"Expected a JPEG marker at offset {offset}")
+
+        marker = data[offset + 1]
+
+        # any number of 0xFF fill bytes may precede a marker
+        if marker == 0xFF:
+            offset += 1
+            continue
+
+        if marker == EOI:
+            yield Segment(EOI, offset, offset + 2, offset + 2, 0)
+            return
+
+        if marker in RST_MARKERS:
+            yield Segment(marker, offset, offset + 2, offset + 2, 0)
+            offset += 2
+            continue
+
+        if offset + 4 > len(data):
+            raise ValueError("JPEG truncated in a segment header")
+
+        length = int.from_bytes(data[offset + 2 : offset + 4], "big")
+        payload_start = offset + 4
+        end = offset + 2 + length
+        if length < 2 or end > len(data):
+            raise ValueError(f"JPEG segment at offset {offset} is truncated")
+
+        if marker == SOS:
+            if stop_at_sos:
+                yield Segment(marker, offset, end, payload_start, length - 2)
+                return
+            end = _entropy_data_end(data, end)
+
+        yield Segment(marker, offset, end, payload_start, length - 2)
+        offset = end
+
+
+def open_jpeg(image_path: Path):
+    """
+    Memory maps a file for reading, so segments can be walked and sliced
+    without reading the whole file up front.
+    """
+
+    with image_path.open("rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_ifd(tiff: bytes, order: str, offset: int):
+    """
+    Reads the entries of the IFD at offset in tiff, with their values whether
+    they're held in the entry or elsewhere in tiff.
+    """
+
+    (entry_count,) = struct.unpack_from(f"{order}H", tiff, offset)
+    entries: list[IfdEntry] = []
+
+    for index in range(entry_count):
+        tag, tiff_type, value_count, raw = struct.unpack_from(
+            f"{order}HHI4s", tiff, offset + 2 + index * 12
+        )
+        size = TIFF_TYPE_SIZES.get(tiff_type)
+        if size is None:
+            continue
+
+        length = size * value_count
+        if length <= 4:
+            value = raw[:length]
+        else:
+            (value_offset,) = struct.unpack(f"{order}I", raw)
+            value = tiff[value_offset : value_offset + length]
+            if len(value) != length:
+                raise ValueError(f"EXIF tag {tag:#06x} runs past the end of the TIFF")
+
+        entries.append(IfdEntry(tag, tiff_type, value_count, value))
+
+    return entries
+
+
+def read_exif(payload: bytes):
+    """
+    Reads IFD0 and the EXIF IFD out of an APP1 EXIF payload. The thumbnail
+    (IFD1) and the GPS IFD aren't read.
+
+    Raises ValueError if the payload isn't valid EXIF.
+    """
+
+    tiff = payload[len(EXIF_HEADER) :]
+    order = TIFF_BYTE_ORDERS.get(tiff[:2])
+    if order is None:
+        raise ValueError("EXIF has an unknown byte order")
+
+    (ifd0_offset,) = struct.unpack_from(f"{order}I", tiff, 4)
+    ifd0 = read_ifd(tiff, order, ifd0_offset)
+
+    exif_ifd: list[IfdEntry] = []
+    for entry in ifd0:
+        if entry.tag == EXIF_IFD_POINTER and entry.type == TIFF_LONG:
+            (exif_ifd_offset,) = struct.unpack(f"{order}I", entry.value)
+            exif_ifd = read_ifd(tiff, order, exif_ifd_offset)
+
+    return ExifIfds(order, ifd0, exif_ifd)
+
+
+def iter_photoshop_resources(payload: bytes) -> Iterator[tuple[int, bytes]]:
+    """
+    Yields the (resource id, data) of each image resource in an APP13
+    Photoshop payload.
+
+    Raises ValueError if the payload isn't a valid list of resources.
+    """
+
+    resources = payload[len(PHOTOSHOP_HEADER) :]
+
+    offset = 0
+    while offset < len(resources):
+        if resources[offset : offset + 4] != b"8BIM":
+            raise ValueError("Photoshop resource has no 8BIM signature")
+
+        resource_id, name_length = struct.unpack_from(">HB", resources, offset + 4)
+        # the name is a pascal string padded to an even length
+        name_size = name_length + 1 + (name_length + 1) % 2
+        (size,) = struct.unpack_from(">I", resources, offset + 6 + name_size)
+        data_start = offset + 6 + name_size + 4
+        offset = data_start + size + size % 2
+
+        yield resource_id, resources[data_start : data_start + size]
+
+
+def iter_iptc_datasets(records: bytes) -> Iterator[IptcDataset]:
+    """
+    Yields each dataset in the IPTC records of a Photoshop IPTC resource.
+
+    Raises ValueError if a dataset runs past the end of the records.
+    """
+
+    offset = 0
+    # anything after the last dataset is padding
+    while offset + 5 <= len(records) and records[offset] == 0x1C:
+        record, dataset, length = struct.unpack_from(">BBH", records, offset + 1)
+        offset += 5
+
+        extended = bool(length & 0x8000)
+        if extended:
+            # the length is held in the following (length & 0x7fff) bytes
+            length_size = length & 0x7FFF
+            length = int.from_bytes(records[offset : offset + length_size], "big")
+            offset += length_size
+
+        value = records[offset : offset + length]
+        offset += length
+        if len(value) != length:
+            raise ValueError("IPTC dataset runs past the end of the record")
+
+        yield IptcDataset(record, dataset, value, extended)
@@ -0,0 +1,244 @@
+"""
+Reads the few tags the manifest needs straight out of a JPEG's metadata
+segments, in process, rather than round tripping through exiftool for hundreds
+of tags only a handful of which are used.
+
+Only the segments before the image data are read (the file is memory mapped
+and the walk stops at SOS), and only the tags in MANIFEST_TAGS are returned,
+named and shaped the way exiftool returns them: a single value on its own, more
+than one as a list, and values which look like numbers or booleans as those.
+
+Anything out of the ordinary (a file which isn't a JPEG, metadata split across
+segments, extended XMP, text in an unknown character set, values with odd
+whitespace, a segment that doesn't parse) isn't guessed at. The file is left
+for exiftool to read instead, so either way the tags come out the same.
+"""
+
+import json
+import re
+import struct
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Any
+
+from photosite_backend.image.jpeg import (
+    APP1,
+    APP13,
+    EXIF_HEADER,
+    PHOTOSHOP_HEADER,
+    PHOTOSHOP_IPTC_RESOURCE,
+    SOS,
+    TIFF_ASCII,
+    XMP_HEADER,
+    iter_iptc_datasets,
+    iter_photoshop_resources,
+    iter_segments,
+    open_jpeg,
+    read_exif,
+)
+from photosite_backend.image.scan import ALLOWED_EXTENSIONS
+from photosite_backend.image.strip import RDF_CONTAINERS, RDF_NAMESPACE
+from photosite_backend.metrics import count
+
+# every tag generate_manifest_entry reads
+MANIFEST_TAGS = (
+    "EXIF:DateTimeOriginal",
+    "EXIF:CreateDate",
+    "IPTC:Keywords",
+    "XMP:Subject",
+    "XMP:HierarchicalSubject",
+)
+
+EXIF_SUB_IFD_TAGS = {
+    0x9003: "EXIF:DateTimeOriginal",
+    0x9004: "EXIF:CreateDate",
+}
+IPTC_KEYWORDS = (2, 25)
+# the envelope dataset saying which character set the IPTC text is in
+IPTC_CODED_CHARACTER_SET = (1, 90)
+IPTC_UTF8 = b"\x1b%G"
+
+XMP_PROPERTIES = {
+    "{http://purl.org/dc/elements/1.1/}subject": "XMP:Subject",
+    "{http://ns.adobe.com/lightroom/1.0/}hierarchicalSubject": (
+        "XMP:HierarchicalSubject"
+    ),
+}
+# other properties exiftool would report under the same names
+XMP_CLASHING_NAMES = {"subject", "hierarchicalSubject"}
+XMP_EXTENSION_HEADER = b"http://ns.adobe.com/xmp/extension/\x00"
+
+# exiftool writes values matching this as JSON numbers or booleans rather than
+# strings
+JSON_LITERAL = re.compile(
+    r"-?(\d|[1-9]\d{1,14})(\.\d{1,16})?(e[-+]?\d{1,3})?|true|false", re.I
+)
+
+
+class UnusualMetadataError(ValueError):
+    """
+    Raised for metadata this reader doesn't handle exactly like exiftool.
+    """
+
+
+def _text(value: str):
+    if not value or value != value.strip() or "\x00" in value:
+        raise UnusualMetadataError(f"Unusual tag value {value!r}")
+
+    return value
+
+
+def _exiftool_value(values: list[str]):
+    converted = [
+        json.loads(value.lower()) if JSON_LITERAL.fullmatch(value) else value
+        for value in values
+    ]
+    return converted[0] if len(converted) == 1 else converted
+
+
+def _read_exif(payload: bytes):
+    _, ifd0, exif_ifd = read_exif(payload)
+    if any(entry.tag in EXIF_SUB_IFD_TAGS for entry in ifd0):
+        raise UnusualMetadataError("EXIF has dates outside the EXIF IFD")
+
+    tags: dict[str, list[str]] = {}
+    for entry in exif_ifd:
+        name = EXIF_SUB_IFD_TAGS.get(entry.tag)
+        if name is None:
+            continue
+        if entry.type != TIFF_ASCII:
+            raise UnusualMetadataError(f"{name} isn't ASCII")
+
+        value = entry.value.split(b"\x00", 1)[0]
+        if not value.isascii():
+            raise UnusualMetadataError(f"{name} isn't ASCII")
+        tags[name] = [_text(value.decode())]
+
+    return tags
+
+
+def _read_photoshop(payload: bytes):
+    records = None
+    for resource_id, data in iter_photoshop_resources(payload):
+        if resource_id == PHOTOSHOP_IPTC_RESOURCE:
+            if records is not None:
+                raise UnusualMetadataError("More than one IPTC resource")
+            records = data
+
+    if records is None:
+        return {}
+
+    datasets = list(iter_iptc_datasets(records))
+    if any(dataset.extended for dataset in datasets):
+        raise UnusualMetadataError("IPTC has an extended dataset")
+
+    utf8 = any(
+        (record, dataset) == IPTC_CODED_CHARACTER_SET and value == IPTC_UTF8
+        for record, dataset, value, _ in datasets
+    )
+    keywords = []
+    for record, dataset, value, _ in datasets:
+        if (record, dataset) != IPTC_KEYWORDS:
+            continue
+        if not utf8 and not value.isascii():
+            # latin-1 or whatever exiftool is configured to read it as
+            raise UnusualMetadataError("IPTC text in an unknown character set")
+        keywords.append(_text(value.decode()))
+
+    return {"IPTC:Keywords": keywords} if keywords else {}
+
+
+def _xmp_values(prop: ET.Element):
+    if prop.attrib or ((prop.text or "").strip() and len(prop)):
+        raise UnusualMetadataError("XMP property has qualifiers")
+
+    if not len(prop):
+        return [_text(prop.text or "")]
+
+    (container,) = prop
+    if container.tag not in RDF_CONTAINERS or container.attrib:
+        raise UnusualMetadataError("XMP property isn't a plain list")
+
+    values = []
+    for item in container:
+        if item.tag != f"{{{RDF_NAMESPACE}}}li" or item.attrib or len(item):
+            raise UnusualMetadataError("XMP list item isn't plain text")
+        values.append(_text(item.text or ""))
+
+    if not values:
+        raise UnusualMetadataError("XMP list is empty")
+
+    return values
+
+
+def _read_xmp(payload: bytes):
+    root = ET.fromstring(payload[len(XMP_HEADER) :])
+    tags: dict[str, list[str]] = {}
+
+    for description in root.iter(f"{{{RDF_NAMESPACE}}}Description"):
+        properties = [
+            (name, value)
+            for name, value in description.attrib.items()
+            if not name.startswith(f"{{{RDF_NAMESPACE}}}")
+        ] + [(prop.tag, prop) for prop in description]
+
+        for name, value in properties:
+            tag = XMP_PROPERTIES.get(name)
+            if tag is None:
+                if name.rsplit("}", 1)[-1] in XMP_CLASHING_NAMES:
+                    raise UnusualMetadataError(f"XMP has another {name}")
+                continue
+            if tag in tags:
+                raise UnusualMetadataError(f"XMP has more than one {tag}")
+
+            tags[tag] = [_text(value)] if isinstance(value, str) else _xmp_values(value)
+
+    return tags
+
+
+def read_jpeg_tags(image_path: Path) -> dict[str, Any] | None:
+    """
+    Returns the MANIFEST_TAGS an image has, the same as exiftool would, or
+    None if it isn't a JPEG this can read them from exactly, in which case
+    exiftool should be asked instead.
+    """
+
+    if image_path.suffix.lower() not in ALLOWED_EXTENSIONS:
+        return None
+
+    seen = set()
+    tags: dict[str, list[str]] = {}
+    try:
+        with open_jpeg(image_path) as data:
+            for segment in iter_segments(data, stop_at_sos=True):
+                if segment.marker == SOS:
+                    break
+                if segment.marker not in (APP1, APP13):
+                    continue
+
+                payload = data[
+                    segment.payload_start : segment.payload_start
+                    + segment.payload_length
+                ]
+                for header, read in (
+                    (EXIF_HEADER, _read_exif),
+                    (XMP_HEADER, _read_xmp),
+                    (PHOTOSHOP_HEADER, _read_photoshop),
+                ):
+                    if not payload.startswith(header):
+                        continue
+                    if header in seen:
+                        raise UnusualMetadataError("Metadata split across segments")
+                    seen.add(header)
+                    tags.update(read(payload))
+
+                if payload.startswith(XMP_EXTENSION_HEADER):
+                    raise UnusualMetadataError("XMP is extended")
+    except (ValueError, struct.error, ET.ParseError, OSError):
+        # UnusualMetadataError included, exiftool can make sense of it or fail
+        # with a proper error
+        count("metadata.fallbacks")
+        return None
+
+    count("metadata.files")
+    return {tag: _exiftool_value(tags[tag]) for tag in MANIFEST_TAGS if tag in tags}
@@ -0,0 +1,239 @@
+"""
+This file contains the perceptual hashing used to find near duplicate images,
+e.g. re-exports or resized copies of the same shot, which the content hashes
+treat as unrelated images.
+
+The hash is a 64 bit difference hash (dHash): the image is shrunk to a 9x8 grey
+thumbnail, and each bit records whether a pixel is brighter than the one to its
+right. Similar images have hashes only a few bits apart. It's computed from the
+reduced decode each image's preview is made from (see preview.py), so hashing
+is cheap.
+
+Near duplicates are found with a multi-index hamming index, which only
+compares a query against the few images sharing a nearly equal chunk of their
+hash with it, rather than every image.
+"""
+
+import logging
+from collections.abc import Iterator
+from functools import cache
+from itertools import combinations
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+from photosite_backend.metrics import count, phase
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# the thumbnail is DHASH_SIZE + 1 wide and DHASH_SIZE tall, for a hash of
+# DHASH_SIZE**2 bits
+DHASH_SIZE = 8
+
+# how many bits two hashes may differ by and still be near duplicates
+DEFAULT_MAX_DISTANCE = 6
+
+# the index splits hashes into this many chunks, 16 bits each for a 64 bit
+# hash, which keeps buckets small up to millions of images
+INDEX_CHUNKS = 4
+CHUNK_BITS = DHASH_SIZE**2 // INDEX_CHUNKS
+
+
+class NearDuplicateOptions(NamedTuple):
+    max_distance: int = DEFAULT_MAX_DISTANCE
+    # the perceptual hashes of the images already in dest, by image hash
+    published: dict[str, str] = {}
+    # whether dest is being made to mirror the images picked from, so published
+    # images which aren't among them are about to be removed and don't count
+    mirror: bool = False
+
+
+def perceptual_hash(img: "Image.Image"):
+    """
+    Returns the dHash of an opened image as a hex string. The image should
+    already have its EXIF orientation applied, so rotated copies match, and
+    can be a reduced decode of it as long as it's larger than the thumbnail.
+    """
+
+    from PIL import Image
+
+    thumbnail = img.convert("L").resize(
+        (DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.BOX
+    )
+
+    pixels = thumbnail.tobytes()
+    bits = 0
+    for row in range(DHASH_SIZE):
+        for column in range(DHASH_SIZE):
+            left = pixels[row * (DHASH_SIZE + 1) + column]
+            bits = bits << 1 | (left > pixels[row * (DHASH_SIZE + 1) + column + 1])
+
+    return f"{bits:0{DHASH_SIZE**2 // 4}x}"
+
+
+def hamming_distance(a: int, b: int):
+    return (a ^ b).bit_count()
+
+
+class HammingIndex:
+    """
+    An index of perceptual hashes, each with the keys of the images that have
+    it, which finds every key whose hash is within some distance of a query.
+
+    Each hash is split into INDEX_CHUNKS chunks, with a table of hashes by each
+    chunk. Two hashes within max_distance of each other must have some chunk
+    within max_distance // INDEX_CHUNKS bits of each other, so only hashes in
+    the buckets that close to one of the query's chunks are compared.
+    """
+
+    def __init__(self):
+        self._tables: list[dict[int, list[int]]] = [{} for _ in range(INDEX_CHUNKS)]
+        self._keys: dict[int, list[str]] = {}
+
+    def add(self, perceptual_hash: int, key: str):
+        keys = self._keys.get(perceptual_hash)
+        if keys is not None:
+            keys.append(key)
+            return
+
+        self._keys[perceptual_hash] = [key]
+        for table, chunk in zip(self._tables, _chunks(perceptual_hash)):
+            table.setdefault(chunk, []).append(perceptual_hash)
+
+    def find(
+        self, perceptual_hash: int, max_distance: int
+    ) -> Iterator[tuple[str, int]]:
+        """
+        Yields (key, distance) for every key within max_distance of
+        perceptual_hash, in no particular order.
+        """
+
+        masks = _chunk_masks(max_distance // INDEX_CHUNKS)
+        seen = set()
+        for table, chunk in zip(self._tables, _chunks(perceptual_hash)):
+            for mask in masks:
+                for candidate in table.get(chunk ^ mask, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+
+                    distance = hamming_distance(perceptual_hash, candidate)
+                    if distance <= max_distance:
+                        for key in self._keys[candidate]:
+                            yield key, distance
+
+
+def _chunks(perceptual_hash: int):
+    chunk_mask = (1 << CHUNK_BITS) - 1
+    return [
+        (perceptual_hash >> (CHUNK_BITS * chunk)) & chunk_mask
+        for chunk in range(INDEX_CHUNKS)
+    ]
+
+
+@cache
+def _chunk_masks(radius: int):
+    """
+    Every chunk sized mask with at most radius bits set.
+    """
+
+    return [
+        sum(1 << bit for bit in bits)
+        for flipped in range(min(radius, CHUNK_BITS) + 1)
+        for bits in combinations(range(CHUNK_BITS), flipped)
+    ]
+
+
+def select_distinct(
+    image_hashes: dict[Path, str],
+    perceptual_hashes: dict[str, str],
+    options: NearDuplicateOptions = NearDuplicateOptions(),
+):
+    """
+    Picks which images to publish, skipping any within max_distance of an image
+    already picked. Images already published are picked first, so a new copy
+    of an image in dest is skipped rather than replacing it, then the rest in
+    path order. Unless mirroring, published images which aren't being picked
+    from count too.
+
+    Returns the image_hashes of the images to publish.
+    """
+
+    max_distance = options.max_distance
+    published = options.published
+    index = HammingIndex()
+    if not options.mirror:
+        for image_hash in published.keys() - set(image_hashes.values()):
+            index.add(int(published[image_hash], 16), image_hash)
+
+    picked = {}
+    picked_hashes = set()
+    for image_path, image_hash in sorted(
+        image_hashes.items(),
+        key=lambda item: (item[1] not in published, str(item[0])),
+    ):
+        # another copy of the same pixels is the same manifest entry
+        if image_hash in picked_hashes:
+            picked[image_path] = image_hash
+            continue
+
+        perceptual = int(perceptual_hashes[image_hash], 16)
+        near = [
+            (distance, key)
+            for key, distance in index.find(perceptual, max_distance)
+            if key != image_hash
+        ]
+        if near:
+            distance, duplicate = min(near)
+            logging.info(
+                "Skipping `%s`, a near duplicate of `%s` (distance %d)",
+                image_path,
+                duplicate,
+                distance,
+            )
+            count("near_duplicates.skipped")
+            continue
+
+        index.add(perceptual, image_hash)
+        picked[image_path] = image_hash
+        picked_hashes.add(image_hash)
+
+    return picked
+
+
+def find_near_duplicates(
+    perceptual_hashes: dict[str, str], max_distance: int = DEFAULT_MAX_DISTANCE
+):
+    """
+    Groups the images (keyed by hash) which are within max_distance of another
+    image in the group. Returns the groups of two or more images, each sorted,
+    largest group first.
+    """
+
+    with phase("near_duplicates_index"):
+        index = HammingIndex()
+        for image_hash, perceptual in perceptual_hashes.items():
+            index.add(int(perceptual, 16), image_hash)
+
+    # union find over every near pair
+    parents = {image_hash: image_hash for image_hash in perceptual_hashes}
+
+    def root(image_hash: str):
+        while parents[image_hash] != image_hash:
+            parents[image_hash] = parents[parents[image_hash]]
+            image_hash = parents[image_hash]
+        return image_hash
+
+    with phase("near_duplicates_query"):
+        for image_hash, perceptual in perceptual_hashes.items():
+            for key, _ in index.find(int(perceptual, 16), max_distance):
+                parents[root(key)] = root(image_hash)
+
+    groups: dict[str, list[str]] = {}
+    for image_hash in perceptual_hashes:
+        groups.setdefault(root(image_hash), []).append(image_hash)
+
+    return sorted(
+        (sorted(group) for group in groups.values() if len(group) > 1),
+        key=lambda group: (-len(group), group),
+    )
@@ -0,0 +1,136 @@
+"""
+This file contains the previews of images stored in the manifest, so the
+frontend can lay the gallery out and show something before any image loads:
+the image's dimensions, and a tiny blurry placeholder of it as a WebP data URI.
+
+Everything derived from a small version of an image is computed from one
+reduced decode of it: JPEGs are decoded at 1/8 scale or so (draft mode) rather
+than in full, and the dimensions come from the header. The perceptual hash is
+computed from the same decode. Images hashed with the pixels engine are decoded
+in full anyway, so they're previewed from a reduced copy of that decode.
+"""
+
+import base64
+import io
+from collections.abc import Iterable
+from concurrent.futures import as_completed
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+from photosite_backend.image.derivatives import oriented_size
+from photosite_backend.image.hashing import hash_decoded
+from photosite_backend.image.perceptual import DHASH_SIZE, perceptual_hash
+from photosite_backend.metrics import count, phase
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# the longest side of the placeholder, it's blurred when shown so only the
+# general colours need to survive. at this size one is ~100-200 characters.
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_QUALITY = 40
+
+# decode at the smallest scale which is still larger than both the placeholder
+# and the perceptual hash's thumbnail
+PREVIEW_DECODE_SIZE = max(PLACEHOLDER_SIZE, DHASH_SIZE) * 8
+
+
+class ImagePreview(NamedTuple):
+    # with the EXIF orientation applied, like the image is shown
+    width: int
+    height: int
+    perceptual_hash: str
+    # a data URI of a tiny WebP of the image
+    placeholder: str
+
+
+def preview_image(image_path: Path):
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        width, height = oriented_size(img)
+        img.draft("RGB", (PREVIEW_DECODE_SIZE, PREVIEW_DECODE_SIZE))
+        return _preview(img, width, height)
+
+
+def hash_and_preview(image_path: Path):
+    """
+    Hashes an image with the pixels engine and previews it from the same
+    decode, rather than decoding it again at a reduced scale to preview it.
+
+    Returns the image hash and the preview.
+    """
+
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        width, height = oriented_size(img)
+        img.load()
+        image_hash = hash_decoded(img)
+
+        # reduced about as far as the decoder would have in preview_image, the
+        # copy keeps the image's EXIF so it's still oriented
+        factor = min(img.size) // PREVIEW_DECODE_SIZE
+        reduced = img.reduce(factor) if factor > 1 else img
+        return image_hash, _preview(reduced, width, height)
+
+
+def _preview(img: "Image.Image", width: int, height: int):
+    from PIL import Image, ImageOps
+
+    oriented = ImageOps.exif_transpose(img)
+    if oriented.mode != "RGB":
+        oriented = oriented.convert("RGB")
+
+    thumbnail = oriented.copy()
+    thumbnail.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.Resampling.BOX)
+    placeholder = io.BytesIO()
+    thumbnail.save(placeholder, format="WEBP", quality=PLACEHOLDER_QUALITY)
+    encoded = base64.b64encode(placeholder.getvalue()).decode()
+
+    return ImagePreview(
+        width=width,
+        height=height,
+        perceptual_hash=perceptual_hash(oriented),
+        placeholder=f"data:image/webp;base64,{encoded}",
+    )
+
+
+def preview_images(
+    images: Iterable[tuple[Path, str]],
+    known: dict[str, ImagePreview],
+    jobs: int = 1,
+):
+    """
+    Previews many (image_path, image_hash) pairs across up to `jobs` worker
+    processes. A preview only depends on the image's pixels, so images whose
+    (content) hash is in known aren't decoded again.
+
+    Returns a dict of image hash to preview.
+    """
+
+    previews = {}
+    pending = {}
+    for image_path, image_hash in images:
+        if image_hash in known:
+            previews[image_hash] = known[image_hash]
+        else:
+            pending[image_hash] = image_path
+
+    if jobs <= 1 or len(pending) <= 1:
+        for image_hash, image_path in pending.items():
+            with phase("preview"):
+                previews[image_hash] = preview_image(image_path)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=min(jobs, len(pending))) as executor:
+            futures = {
+                executor.submit(preview_image, image_path): image_hash
+                for image_hash, image_path in pending.items()
+            }
+            for future in as_completed(futures):
+                previews[futures[future]] = future.result()
+
+    count("preview.files", len(pending))
+    return previews
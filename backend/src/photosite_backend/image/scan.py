@@ -0,0 +1,162 @@
+"""
+This file contains the scanner which finds the images in a source directory.
+
+The directory is walked recursively, with each subdirectory listed by a pool of
+threads so the round trips to slow (network) filesystems overlap. Images are
+yielded as soon as their directory has been listed, so hashing and uploading
+can get started while the rest of the tree is still being walked.
+
+Each image found is yielded along with the stat result from the walk, so the
+hash cache can be checked without statting every file a second time.
+"""
+
+import logging
+import os
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from fnmatch import fnmatchcase
+from pathlib import Path
+from stat import S_ISREG
+from typing import NamedTuple
+
+from photosite_backend.metrics import count, phase
+
+# compared against the lowercased extension, so .JPG and .Jpeg are found too
+ALLOWED_EXTENSIONS = (".jpg", ".jpeg")
+
+# listing directories is mostly waiting on the filesystem, not the cpu
+DEFAULT_SCAN_THREADS = 8
+
+
+class ScannedImage(NamedTuple):
+    path: Path
+    stat: os.stat_result
+
+
+def stat_image(image_path: Path):
+    """
+    Stats an image found other than by scanning (e.g. given on the command
+    line), returning None if it isn't a file.
+    """
+
+    try:
+        image_stat = image_path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not S_ISREG(image_stat.st_mode):
+        return None
+
+    return ScannedImage(image_path, image_stat)
+
+
+class ScanOptions(NamedTuple):
+    """
+    Which files in the source directory are images to publish. Globs are
+    matched against each path relative to the source directory, with `/`
+    separators, and `*` also matches across directories. A directory matching
+    an exclude glob isn't walked at all.
+    """
+
+    include: tuple[str, ...] = ()
+    exclude: tuple[str, ...] = ()
+    extensions: tuple[str, ...] = ALLOWED_EXTENSIONS
+
+    def excludes(self, relative_path: str):
+        """
+        Whether relative_path, or any directory it's in, matches an exclude glob.
+        """
+
+        if not self.exclude:
+            return False
+
+        parts = relative_path.split("/")
+        return any(
+            fnmatchcase("/".join(parts[:depth]), pattern)
+            for depth in range(1, len(parts) + 1)
+            for pattern in self.exclude
+        )
+
+    def includes(self, relative_path: str):
+        """
+        Whether the file at relative_path is an image to publish.
+        """
+
+        if os.path.splitext(relative_path)[1].lower() not in self.extensions:
+            return False
+        if self.include and not any(
+            fnmatchcase(relative_path, pattern) for pattern in self.include
+        ):
+            return False
+
+        return not self.excludes(relative_path)
+
+
+class _Listing(NamedTuple):
+    images: list[ScannedImage]
+    # (path, relative path with a trailing /) of each subdirectory to walk
+    directories: list[tuple[str, str]]
+
+
+def _list_directory(directory: str, relative_dir: str, options: ScanOptions):
+    listing = _Listing([], [])
+
+    with phase("scan"), os.scandir(directory) as entries:
+        for entry in entries:
+            relative_path = relative_dir + entry.name
+            try:
+                # symlinked directories aren't followed, as they could loop
+                if entry.is_dir(follow_symlinks=False):
+                    if not options.excludes(relative_path):
+                        listing.directories.append((entry.path, relative_path + "/"))
+                elif entry.is_file() and options.includes(relative_path):
+                    listing.images.append(ScannedImage(Path(entry.path), entry.stat()))
+            except OSError as error:
+                # e.g. removed since the directory was listed
+                logging.warning("Can't read `%s` (%s), skipping it", entry.path, error)
+
+    count("scan.directories")
+    return listing
+
+
+def get_images(
+    input_path: Path,
+    options: ScanOptions = ScanOptions(),
+    threads: int = DEFAULT_SCAN_THREADS,
+) -> Iterator[ScannedImage]:
+    """
+    Yields the path and stat result of every image under input_path, in no
+    particular order. Subdirectories which can't be read are skipped with a
+    warning.
+    """
+
+    with ThreadPoolExecutor(threads) as executor:
+        root = executor.submit(_list_directory, str(input_path), "", options)
+        directories: dict[Future[_Listing], str] = {root: str(input_path)}
+        try:
+            while directories:
+                done, _ = wait(directories, return_when=FIRST_COMPLETED)
+                for future in done:
+                    directory = directories.pop(future)
+                    try:
+                        listing = future.result()
+                    except OSError as error:
+                        if future is root:
+                            raise
+                        logging.warning(
+                            "Can't read `%s` (%s), skipping it", directory, error
+                        )
+                        continue
+
+                    # queued before yielding, so the walk carries on meanwhile
+                    for path, relative_dir in listing.directories:
+                        subdirectory = executor.submit(
+                            _list_directory, path, relative_dir, options
+                        )
+                        directories[subdirectory] = path
+
+                    count("scan.images", len(listing.images))
+                    yield from listing.images
+        finally:
+            # stopped early, don't walk the rest of the tree
+            for future in directories:
+                future.cancel()
@@ -0,0 +1,529 @@
+"""
+Strips the metadata from a JPEG as it's copied, by rewriting its APPn and COM
+segments in process rather than re-encoding it or shelling out to exiftool.
+
+Only the tags in an allow-list survive, named the way exiftool names them
+(e.g. `EXIF:Orientation`, `IPTC:Keywords`, `XMP:Rights`), and the values of
+those can be rewritten with regexes first, a value rewritten to nothing is
+removed. The EXIF, IPTC and XMP segments are rebuilt holding just those tags,
+everything else which isn't needed to display the image (GPS, maker notes,
+thumbnails, photoshop resources, extended XMP, MPF and any APPn this doesn't
+understand) is dropped, along with anything after the EOI marker. A metadata
+segment which can't be parsed is dropped too, rather than copied as it is.
+
+The image data itself, and the JFIF, ICC profile and Adobe segments, are copied
+verbatim.
+"""
+
+import io
+import logging
+import mmap
+import re
+import struct
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import NamedTuple, Protocol, cast
+
+from photosite_backend.image.jpeg import (
+    APP0,
+    APP1,
+    APP2,
+    APP13,
+    APP14,
+    COM,
+    EXIF_HEADER,
+    EXIF_IFD_POINTER,
+    PHOTOSHOP_HEADER,
+    PHOTOSHOP_IPTC_RESOURCE,
+    TIFF_ASCII,
+    TIFF_LONG,
+    XMP_HEADER,
+    IfdEntry,
+    is_metadata_marker,
+    iter_iptc_datasets,
+    iter_photoshop_resources,
+    iter_segments,
+    open_jpeg,
+    read_exif,
+)
+from photosite_backend.metrics import count
+
+ICC_HEADER = b"ICC_PROFILE\x00"
+JFIF_HEADER = b"JFIF\x00"
+ADOBE_HEADER = b"Adobe"
+
+# the most a segment's payload can hold, its length field includes itself
+MAX_PAYLOAD_LENGTH = 0xFFFF - 2
+
+# kept by default, what's needed to display the image the right way up and in
+# the right colours, and who it belongs to
+DEFAULT_KEPT_TAGS = frozenset(
+    {
+        "EXIF:Orientation",
+        "EXIF:ColorSpace",
+        "EXIF:DateTimeOriginal",
+        "EXIF:Artist",
+        "EXIF:Copyright",
+        "IPTC:By-line",
+        "IPTC:CopyrightNotice",
+        "XMP:Creator",
+        "XMP:Rights",
+    }
+)
+
+# the TIFF tags in IFD0 and the EXIF IFD which can be kept. the GPS IFD, IFD1
+# (the thumbnail) and the maker note (whose offsets break when it's moved) are
+# always dropped.
+EXIF_IFD0_TAGS = {
+    0x010E: "EXIF:ImageDescription",
+    0x010F: "EXIF:Make",
+    0x0110: "EXIF:Model",
+    0x0112: "EXIF:Orientation",
+    0x011A: "EXIF:XResolution",
+    0x011B: "EXIF:YResolution",
+    0x0128: "EXIF:ResolutionUnit",
+    0x0131: "EXIF:Software",
+    0x0132: "EXIF:ModifyDate",
+    0x013B: "EXIF:Artist",
+    0x0213: "EXIF:YCbCrPositioning",
+    0x8298: "EXIF:Copyright",
+}
+EXIF_SUB_IFD_TAGS = {
+    0x829A: "EXIF:ExposureTime",
+    0x829D: "EXIF:FNumber",
+    0x8822: "EXIF:ExposureProgram",
+    0x8827: "EXIF:ISO",
+    0x9000: "EXIF:ExifVersion",
+    0x9003: "EXIF:DateTimeOriginal",
+    0x9004: "EXIF:CreateDate",
+    0x9010: "EXIF:OffsetTime",
+    0x9011: "EXIF:OffsetTimeOriginal",
+    0x9201: "EXIF:ShutterSpeedValue",
+    0x9202: "EXIF:ApertureValue",
+    0x9204: "EXIF:ExposureCompensation",
+    0x9207: "EXIF:MeteringMode",
+    0x9209: "EXIF:Flash",
+    0x920A: "EXIF:FocalLength",
+    0x9286: "EXIF:UserComment",
+    0x9290: "EXIF:SubSecTime",
+    0x9291: "EXIF:SubSecTimeOriginal",
+    0xA001: "EXIF:ColorSpace",
+    0xA002: "EXIF:ExifImageWidth",
+    0xA003: "EXIF:ExifImageHeight",
+    0xA405: "EXIF:FocalLengthIn35mmFormat",
+    0xA420: "EXIF:ImageUniqueID",
+    0xA430: "EXIF:OwnerName",
+    0xA431: "EXIF:SerialNumber",
+    0xA432: "EXIF:LensInfo",
+    0xA433: "EXIF:LensMake",
+    0xA434: "EXIF:LensModel",
+    0xA435: "EXIF:LensSerialNumber",
+}
+# the IPTC datasets (record, dataset) which can be kept
+IPTC_TAGS = {
+    (2, 5): "IPTC:ObjectName",
+    (2, 15): "IPTC:Category",
+    (2, 25): "IPTC:Keywords",
+    (2, 40): "IPTC:SpecialInstructions",
+    (2, 55): "IPTC:DateCreated",
+    (2, 60): "IPTC:TimeCreated",
+    (2, 80): "IPTC:By-line",
+    (2, 85): "IPTC:By-lineTitle",
+    (2, 90): "IPTC:City",
+    (2, 92): "IPTC:Sub-location",
+    (2, 95): "IPTC:Province-State",
+    (2, 101): "IPTC:Country-PrimaryLocationName",
+    (2, 105): "IPTC:Headline",
+    (2, 110): "IPTC:Credit",
+    (2, 115): "IPTC:Source",
+    (2, 116): "IPTC:CopyrightNotice",
+    (2, 120): "IPTC:Caption-Abstract",
+}
+# the character set and record version, kept along with any other dataset
+IPTC_ENVELOPE_DATASETS = {(1, 90), (2, 0)}
+
+RDF_NAMESPACE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+RDF_CONTAINERS = {f"{{{RDF_NAMESPACE}}}{name}" for name in ("Bag", "Seq", "Alt")}
+XMP_PACKET_START = '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+XMP_PACKET_END = '<?xpacket end="w"?>'
+
+
+class TagRewrite(NamedTuple):
+    tag: str
+    pattern: re.Pattern
+    replacement: str
+
+
+class StripOptions(NamedTuple):
+    keep_tags: frozenset[str] = DEFAULT_KEPT_TAGS
+    rewrites: tuple[TagRewrite, ...] = ()
+
+
+class Writable(Protocol):
+    """
+    Anything stripped images can be written to, a file or e.g. a checksum.
+    """
+
+    def write(self, data: bytes | memoryview, /) -> int: ...
+
+
+def parse_rewrite(rule: str):
+    """
+    Parses a rewrite rule of the form `TAG/PATTERN/REPLACEMENT`, with an
+    optional trailing `/`, e.g. `IPTC:Keywords/^private.*//`. Any character
+    which can't be part of a tag name can be used in place of the `/`s.
+    """
+
+    match = re.fullmatch(r"([\w:-]+)(.)(.*)", rule, re.DOTALL)
+    if not match:
+        raise ValueError(f"`{rule}` isn't a TAG/PATTERN/REPLACEMENT rewrite")
+
+    tag, delimiter, rest = match.groups()
+    parts = rest.split(delimiter)
+    if len(parts) == 3 and not parts[2]:
+        parts.pop()
+    if len(parts) != 2:
+        raise ValueError(f"`{rule}` isn't a TAG/PATTERN/REPLACEMENT rewrite")
+
+    try:
+        pattern = re.compile(parts[0])
+    except re.error as error:
+        raise ValueError(f"`{rule}` has an invalid pattern: {error}") from error
+
+    return TagRewrite(tag, pattern, parts[1])
+
+
+def _rewrite(tag: str, value: str, options: StripOptions):
+    for rewrite in options.rewrites:
+        if rewrite.tag == tag:
+            value = rewrite.pattern.sub(rewrite.replacement, value)
+
+    return value
+
+
+def _keep_text(tag: str, value: bytes, options: StripOptions):
+    """
+    Returns the value of a text tag after rewriting it, or None if the tag
+    isn't kept or was rewritten to nothing.
+    """
+
+    if tag not in options.keep_tags:
+        return None
+
+    text = value.decode("utf-8", "surrogateescape")
+    rewritten = _rewrite(tag, text, options)
+    if not rewritten:
+        return None
+
+    return value if rewritten == text else rewritten.encode("utf-8", "surrogateescape")
+
+
+def _filter_ifd(entries: list[IfdEntry], names: dict[int, str], options: StripOptions):
+    kept: list[IfdEntry] = []
+    for entry in entries:
+        name = names.get(entry.tag)
+        if name is None or name not in options.keep_tags:
+            continue
+
+        if entry.type == TIFF_ASCII:
+            value = _keep_text(name, entry.value.rstrip(b"\x00"), options)
+            if value is None:
+                continue
+            entry = entry._replace(value_count=len(value) + 1, value=value + b"\x00")
+
+        kept.append(entry)
+
+    return kept
+
+
+def _append_ifd(tiff: bytearray, order: str, entries: list[IfdEntry]):
+    """
+    Appends an IFD holding entries to tiff, followed by the values which don't
+    fit in the entries themselves, returning the IFD's offset.
+    """
+
+    offset = len(tiff)
+    data_offset = offset + 2 + 12 * len(entries) + 4
+
+    table = bytearray(struct.pack(f"{order}H", len(entries)))
+    data = bytearray()
+    for entry in sorted(entries):
+        if len(entry.value) <= 4:
+            raw = entry.value.ljust(4, b"\x00")
+        else:
+            raw = struct.pack(f"{order}I", data_offset + len(data))
+            data += entry.value
+            # values start on a word boundary
+            if len(data) % 2:
+                data += b"\x00"
+
+        table += (
+            struct.pack(f"{order}HHI", entry.tag, entry.type, entry.value_count) + raw
+        )
+
+    # no next IFD, IFD1 (the thumbnail) is never kept
+    table += struct.pack(f"{order}I", 0)
+    tiff += table + data
+
+    return offset
+
+
+def _strip_exif(payload: bytes, options: StripOptions):
+    # values are copied as they are, so the byte order has to stay the same
+    order, ifd0, sub_ifd = read_exif(payload)
+    kept_ifd0 = _filter_ifd(ifd0, EXIF_IFD0_TAGS, options)
+    kept_sub_ifd = _filter_ifd(sub_ifd, EXIF_SUB_IFD_TAGS, options)
+
+    tiff = payload[len(EXIF_HEADER) :]
+    stripped = bytearray(tiff[:4] + b"\x00" * 4)
+    if kept_sub_ifd:
+        sub_ifd_offset = _append_ifd(stripped, order, kept_sub_ifd)
+        kept_ifd0.append(
+            IfdEntry(
+                EXIF_IFD_POINTER,
+                TIFF_LONG,
+                1,
+                struct.pack(f"{order}I", sub_ifd_offset),
+            )
+        )
+    if not kept_ifd0:
+        return None
+
+    struct.pack_into(f"{order}I", stripped, 4, _append_ifd(stripped, order, kept_ifd0))
+    return EXIF_HEADER + bytes(stripped)
+
+
+def _filter_iptc(records: bytes, options: StripOptions):
+    envelope = bytearray()
+    kept = bytearray()
+
+    for record, dataset, value, extended in iter_iptc_datasets(records):
+        if (record, dataset) in IPTC_ENVELOPE_DATASETS and not extended:
+            envelope += struct.pack(">BBBH", 0x1C, record, dataset, len(value))
+            envelope += value
+            continue
+
+        name = IPTC_TAGS.get((record, dataset))
+        if extended or name is None:
+            continue
+
+        new_value = _keep_text(name, value, options)
+        if new_value is None or len(new_value) >= 0x8000:
+            continue
+
+        kept += struct.pack(">BBBH", 0x1C, record, dataset, len(new_value))
+        kept += new_value
+
+    return envelope + kept if kept else None
+
+
+def _strip_photoshop(payload: bytes, options: StripOptions):
+    stripped = bytearray()
+
+    for resource_id, data in iter_photoshop_resources(payload):
+        if resource_id != PHOTOSHOP_IPTC_RESOURCE:
+            continue
+
+        records = _filter_iptc(data, options)
+        if records:
+            stripped += struct.pack(">4sHHI", b"8BIM", resource_id, 0, len(records))
+            stripped += records + b"\x00" * (len(records) % 2)
+
+    return PHOTOSHOP_HEADER + bytes(stripped) if stripped else None
+
+
+def _xmp_tag(element_name: str):
+    # exiftool names XMP tags after the property, e.g. dc:rights is XMP:Rights
+    local_name = element_name.rsplit("}", 1)[-1]
+    return f"XMP:{local_name[:1].upper()}{local_name[1:]}"
+
+
+def _filter_xmp_property(tag: str, prop: ET.Element, options: StripOptions):
+    """
+    Rewrites the values of an XMP property in place, returning whether it has
+    any values left.
+    """
+
+    containers = [child for child in prop if child.tag in RDF_CONTAINERS]
+    if containers:
+        has_values = False
+        for container in containers:
+            for item in list(container):
+                if len(item) == 0:
+                    item.text = _rewrite(tag, item.text or "", options)
+                    if not item.text:
+                        container.remove(item)
+                        continue
+                has_values = True
+
+        return has_values
+
+    # structures are kept as they are
+    if len(prop):
+        return True
+
+    prop.text = _rewrite(tag, prop.text or "", options)
+    return bool(prop.text or prop.attrib)
+
+
+def _xmp_prefixes(packet: bytes):
+    """
+    Returns the prefix the packet declares for each of its namespaces, by
+    namespace URI, to write it back out with.
+    """
+
+    prefixes = {XML_NAMESPACE: "xml"}
+    for _, namespace in ET.iterparse(io.BytesIO(packet), events=("start-ns",)):
+        # start-ns events are of a (prefix, uri) pair
+        prefix, uri = cast(tuple[str, str], namespace)
+        # default namespaces, and prefixes bound to more than one namespace, are
+        # given a prefix of their own by _prefixed
+        if prefix and uri not in prefixes and prefix not in prefixes.values():
+            prefixes[uri] = prefix
+
+    return prefixes
+
+
+def _prefixed(name: str, prefixes: dict[str, str]):
+    if not name.startswith("{"):
+        return name
+
+    uri, local_name = name[1:].split("}", 1)
+    if uri not in prefixes:
+        number = len(prefixes)
+        while f"ns{number}" in prefixes.values():
+            number += 1
+        prefixes[uri] = f"ns{number}"
+
+    return f"{prefixes[uri]}:{local_name}"
+
+
+def _xmp_to_string(root: ET.Element, prefixes: dict[str, str]):
+    """
+    Writes the XMP back out with the prefixes it was read with. ElementTree
+    only knows the prefixes registered with it, which are global to the
+    process, so elements are renamed to their prefixed names instead and the
+    namespaces declared on the root.
+    """
+
+    for element in root.iter():
+        element.tag = _prefixed(element.tag, prefixes)
+        element.attrib = {
+            _prefixed(name, prefixes): value for name, value in element.attrib.items()
+        }
+    for uri, prefix in prefixes.items():
+        if uri != XML_NAMESPACE:
+            root.set(f"xmlns:{prefix}", uri)
+
+    return ET.tostring(root, encoding="unicode")
+
+
+def _strip_xmp(payload: bytes, options: StripOptions):
+    packet = payload[len(XMP_HEADER) :]
+
+    root = ET.fromstring(packet)
+    rdf_tag = f"{{{RDF_NAMESPACE}}}RDF"
+    rdf = root if root.tag == rdf_tag else root.find(rdf_tag)
+    if rdf is None:
+        raise ValueError("XMP has no rdf:RDF element")
+
+    kept = 0
+    for description in rdf.findall(f"{{{RDF_NAMESPACE}}}Description"):
+        for attribute in list(description.attrib):
+            if attribute.startswith(f"{{{RDF_NAMESPACE}}}"):
+                continue
+
+            tag = _xmp_tag(attribute)
+            value = description.attrib[attribute]
+            value = _rewrite(tag, value, options) if tag in options.keep_tags else ""
+            if value:
+                description.set(attribute, value)
+                kept += 1
+            else:
+                del description.attrib[attribute]
+
+        for prop in list(description):
+            tag = _xmp_tag(prop.tag)
+            if tag in options.keep_tags and _filter_xmp_property(tag, prop, options):
+                kept += 1
+            else:
+                description.remove(prop)
+
+    if not kept:
+        return None
+
+    xml = _xmp_to_string(root, _xmp_prefixes(packet))
+    return XMP_HEADER + f"{XMP_PACKET_START}{xml}{XMP_PACKET_END}".encode()
+
+
+def strip_segment(marker: int, payload: bytes, options: StripOptions):
+    """
+    Returns the new payload of a metadata segment, or None if the segment
+    should be dropped.
+    """
+
+    try:
+        if marker == APP0 and payload.startswith(JFIF_HEADER) and len(payload) >= 14:
+            # without its thumbnail, if it has one
+            return payload[:12] + b"\x00\x00"
+        if marker == APP1 and payload.startswith(EXIF_HEADER):
+            return _strip_exif(payload, options)
+        if marker == APP1 and payload.startswith(XMP_HEADER):
+            return _strip_xmp(payload, options)
+        if marker == APP2 and payload.startswith(ICC_HEADER):
+            return payload
+        if marker == APP13 and payload.startswith(PHOTOSHOP_HEADER):
+            return _strip_photoshop(payload, options)
+        if marker == APP14 and payload.startswith(ADOBE_HEADER):
+            return payload
+        if marker == COM:
+            return _keep_text("File:Comment", payload, options)
+    except (ValueError, struct.error, ET.ParseError) as error:
+        logging.warning(
+            "Dropping a metadata segment which couldn't be parsed: %s", error
+        )
+
+    return None
+
+
+def write_stripped(data: mmap.mmap | bytes, dest: Writable, options: StripOptions):
+    """
+    Writes the JPEG in data to dest with its metadata stripped, the image data
+    is written straight from data without being copied.
+    """
+
+    with memoryview(data) as view:
+        for segment in iter_segments(data):
+            if not is_metadata_marker(segment.marker):
+                dest.write(view[segment.start : segment.end])
+                continue
+
+            payload_end = segment.payload_start + segment.payload_length
+            payload = strip_segment(
+                segment.marker,
+                bytes(view[segment.payload_start : payload_end]),
+                options,
+            )
+            if payload is None:
+                continue
+            if len(payload) > MAX_PAYLOAD_LENGTH:
+                logging.warning("Dropping a metadata segment too big to write back")
+                continue
+
+            dest.write(
+                bytes([0xFF, segment.marker]) + struct.pack(">H", len(payload) + 2)
+            )
+            dest.write(payload)
+
+
+def strip_metadata(source_path: Path, dest: Writable, options: StripOptions):
+    """
+    Writes the JPEG at source_path to dest with its metadata stripped, memory
+    mapping it rather than reading it all in up front.
+    """
+
+    with open_jpeg(source_path) as data:
+        write_stripped(data, dest, options)
+
+    count("strip.files")
@@ -0,0 +1,223 @@
+"""
+This file contains the journal sync keeps of its progress, so a sync which dies
+halfway through (a dropped connection, a CI timeout) can be picked up again
+with `--resume` rather than starting over with dest's manifest never written.
+
+The journal is an append-only file of JSON lines, kept in the cache dir with
+one per source and dest. It records the options the sync was run with (a
+resume with different ones starts over), each image hashed along with the stat
+of the file at the time, each preview computed and each file which has landed
+in dest. Resuming skips all of that work for files which haven't changed.
+
+Once everything has landed, the manifest about to be written is kept alongside
+the journal along with the files in dest it no longer refers to, and then the
+journal records that it was written. Dest is only changed in an order which
+keeps it consistent: files land before any manifest referring to them is
+written, and are only removed once the manifest no longer refers to them, so a
+sync which dies after writing the manifest still removes them on resume.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from photosite_backend.image.preview import ImagePreview
+from photosite_backend.manifest import Manifest
+from photosite_backend.manifest.encoding import dumps, loads
+
+# within the cache dir
+JOURNALS_DIRNAME = "journals"
+JOURNAL_FILENAME = "journal.jsonl"
+PENDING_MANIFEST_FILENAME = "pending_manifest.json"
+
+
+class _JournaledHash(NamedTuple):
+    size: int
+    mtime_ns: int
+    inode: int
+    hash: str
+
+
+def journal_dir(cache_dir: Path, source_path: Path, dest: str, dest_type: str):
+    key = dumps([str(source_path.absolute()), dest_type, dest])
+    return cache_dir / JOURNALS_DIRNAME / hashlib.sha256(key).hexdigest()[:16]
+
+
+class SyncJournal:
+    """
+    Use it as a context manager, the journal is closed (but kept) on leaving
+    the block unless finish was called.
+    """
+
+    def __init__(self, path: Path, options: dict[str, Any], resume: bool = False):
+        self.dir = path
+        self.path = path / JOURNAL_FILENAME
+        self.pending_path = path / PENDING_MANIFEST_FILENAME
+
+        # what was journaled by the run being resumed
+        self.landed: set[str] = set()
+        self.previews: dict[str, ImagePreview] = {}
+        self.stale: set[str] = set()
+        self.pending_manifest: Manifest | None = None
+        self._hashes: dict[str, _JournaledHash] = {}
+        # the paths whose hash this run took from the journal
+        self._resumed_paths: set[str] = set()
+
+        self._lock = threading.Lock()
+        path.mkdir(parents=True, exist_ok=True)
+        if resume and self._load(options):
+            self._file = self.path.open("ab")
+            return
+
+        self.pending_path.unlink(missing_ok=True)
+        self._file = self.path.open("wb")
+        self._append({"type": "options", "options": options})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load(self, options: dict[str, Any]):
+        """
+        Reads in the journal of an earlier run, returning whether it can be
+        resumed from.
+        """
+
+        if not self.path.exists():
+            logging.info("No interrupted sync to resume, starting over")
+            return False
+
+        records = []
+        valid_length = 0
+        with self.path.open("rb") as file:
+            for line in file:
+                # a run killed mid-write leaves a partial last line behind
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records.append(loads(line))
+                except ValueError:
+                    break
+                valid_length += len(line)
+
+        if not records or records[0] != {"type": "options", "options": options}:
+            logging.warning(
+                "The interrupted sync was run with different options, starting over"
+            )
+            return False
+
+        for record in records[1:]:
+            if record["type"] == "hashed":
+                self._hashes[record["path"]] = _JournaledHash(
+                    record["size"], record["mtime_ns"], record["inode"], record["hash"]
+                )
+            elif record["type"] == "previewed":
+                self.previews[record["hash"]] = ImagePreview(*record["preview"])
+            elif record["type"] == "landed":
+                self.landed.add(record["filename"])
+            elif record["type"] == "pending":
+                self.stale = set(record["stale"])
+                self.pending_manifest = loads(self.pending_path.read_bytes())
+
+        # so appended records start on a line of their own
+        os.truncate(self.path, valid_length)
+        logging.info(
+            "Resuming an interrupted sync, %d images hashed and %d files landed",
+            len(self._hashes),
+            len(self.landed),
+        )
+        return True
+
+    def _append(self, record: dict[str, Any]):
+        with self._lock:
+            self._file.write(dumps(record) + b"\n")
+            # written through to the OS, which is enough to survive the process
+            # dying. the journal only saves work, so isn't fsynced.
+            self._file.flush()
+
+    def hash_of(self, image_path: Path, stat: os.stat_result):
+        """
+        The hash journaled for image_path, or None if it wasn't hashed or has
+        changed since (going by stat, its current stat result).
+        """
+
+        key = str(image_path.absolute())
+        journaled = self._hashes.get(key)
+        if journaled is None:
+            return None
+
+        if journaled[:3] != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return None
+
+        self._resumed_paths.add(key)
+        return journaled.hash
+
+    def hashed(self, image_path: Path, image_hash: str, stat: os.stat_result):
+        key = str(image_path.absolute())
+        self._append(
+            {
+                "type": "hashed",
+                "path": key,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "inode": stat.st_ino,
+                "hash": image_hash,
+            }
+        )
+
+    def previewed(self, image_hash: str, preview: ImagePreview):
+        self._append(
+            {"type": "previewed", "hash": image_hash, "preview": list(preview)}
+        )
+
+    def landed_in_dest(self, filename: str):
+        self._append({"type": "landed", "filename": filename})
+
+    def unchanged(self, image_hashes: dict[Path, str]):
+        """
+        Whether image_hashes are the very images (down to their stat) the
+        pending manifest was generated from, so it can be committed as it is.
+        """
+
+        if self.pending_manifest is None:
+            return False
+
+        return {
+            str(image_path.absolute()) for image_path in image_hashes
+        } == self._resumed_paths == self._hashes.keys() and set(
+            image_hashes.values()
+        ) == self.pending_manifest["images"].keys()
+
+    def pending(self, manifest: Manifest, stale: set[str]):
+        """
+        Records the manifest about to be written to dest, once everything it
+        refers to has landed, and the files it no longer refers to.
+        """
+
+        partial_path = self.pending_path.with_name(f".{self.pending_path.name}.partial")
+        partial_path.write_bytes(dumps(manifest))
+        partial_path.replace(self.pending_path)
+
+        self._append({"type": "pending", "stale": sorted(stale)})
+
+    def committed(self):
+        self._append({"type": "committed"})
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def finish(self):
+        """
+        Throws the journal away, once the sync it records is complete.
+        """
+
+        self.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -1,23 +1,532 @@
-import json
+import contextlib
+import glob
+import itertools
 import logging
+import os
 import pathlib
-from typing import Annotated
+import shutil
+import sys
+import time
+from typing import TYPE_CHECKING, Annotated, Iterable, cast, get_args
 
 import typer
 
 from photosite_backend.backends import dest_type_options, get_fs
-from photosite_backend.image import get_images, hash_image, write_image
+from photosite_backend.image import (
+    DEFAULT_EXIFTOOL_CHUNK_SIZE,
+    DEFAULT_EXIFTOOL_PROCESSES,
+    close_exiftool,
+    get_hash_cache,
+    hash_image,
+    hash_images,
+    image_filename,
+    read_tags,
+    remove_images,
+    set_exiftool_processes,
+    set_hash_cache,
+)
+from photosite_backend.image.cache import HashCache, default_cache_dir
+from photosite_backend.image.derivatives import (
+    DEFAULT_DERIVATIVE_FORMATS,
+    DERIVATIVE_CACHE_DIRNAME,
+    Derivative,
+    DerivativeFormat,
+    DerivativeSpec,
+    derivative_output_dir,
+    derivative_specs,
+    render_all_derivatives,
+)
+from photosite_backend.image.hashing import DEFAULT_HASH_ENGINE, HashEngine
+from photosite_backend.image.perceptual import (
+    DEFAULT_MAX_DISTANCE,
+    NearDuplicateOptions,
+    find_near_duplicates,
+    select_distinct,
+)
+from photosite_backend.image.preview import ImagePreview, preview_images
+from photosite_backend.image.scan import (
+    DEFAULT_SCAN_THREADS,
+    ScannedImage,
+    ScanOptions,
+    get_images,
+    stat_image,
+)
+from photosite_backend.image.strip import (
+    DEFAULT_KEPT_TAGS,
+    StripOptions,
+    parse_rewrite,
+)
+from photosite_backend.journal import SyncJournal, journal_dir
 from photosite_backend.manifest import (
+    MANIFEST_VERSION,
     Manifest,
+    ManifestFormat,
+    diff_manifests,
     generate_manifest,
-    generate_manifest_entry,
+    generate_manifest_entries,
+    manifest_derivatives,
+    manifest_filenames,
+    manifest_hash_engine,
+    manifest_perceptual_hashes,
+    manifest_previews,
+    read_manifest,
+    update_manifest,
     write_manifest,
 )
+from photosite_backend.manifest.encoding import Compression, compression_available
+from photosite_backend.manifest.keywords import (
+    KeywordIndex,
+    add_to_keyword_index,
+    build_keyword_index,
+    read_keyword_index,
+    remove_from_keyword_index,
+    update_keyword_index,
+    write_keyword_index,
+)
+from photosite_backend.manifest.sharded import DEFAULT_SHARD_SIZE, ShardOptions
+from photosite_backend.metrics import (
+    count,
+    get_metrics,
+    log_summary,
+    phase,
+    reset_metrics,
+    write_summary,
+)
+from photosite_backend.metrics import profile as profile_run
+from photosite_backend.upload import DEFAULT_UPLOAD_CONCURRENCY, Uploader
+from photosite_backend.upload.listing import DestListing, VerifyMode
+from photosite_backend.watch import DEFAULT_DEBOUNCE, create_watcher, watch_changes
+
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
 
 logging.basicConfig(level=logging.INFO)
 
 
 app = typer.Typer()
+cache_app = typer.Typer(help="Inspect and maintain the persistent hash cache.")
+app.add_typer(cache_app, name="cache")
+
+
+def _validate_derivative_formats(formats: list[str] | None):
+    allowed = get_args(DerivativeFormat)
+    for derivative_format in formats or []:
+        if derivative_format not in allowed:
+            raise typer.BadParameter(
+                f"'{derivative_format}' is not one of {', '.join(allowed)}"
+            )
+
+    return formats
+
+
+def _validate_compressions(compressions: list[str] | None) -> list[Compression]:
+    allowed = get_args(Compression)
+    # typer can't parse lists of Literals, so they're checked here instead
+    checked = cast(list[Compression], compressions or [])
+    for compression in checked:
+        if compression not in allowed:
+            raise typer.BadParameter(
+                f"'{compression}' is not one of {', '.join(allowed)}"
+            )
+        if not compression_available(compression):
+            raise typer.BadParameter(f"'{compression}' needs the brotli package")
+
+    return checked
+
+
+def _validate_rewrites(rewrites: list[str] | None):
+    for rule in rewrites or []:
+        try:
+            parse_rewrite(rule)
+        except ValueError as error:
+            raise typer.BadParameter(str(error)) from error
+
+    return rewrites
+
+
+DerivativeWidthsOption = Annotated[
+    list[int] | None,
+    typer.Option(
+        "--derivative-width",
+        min=1,
+        help="Render a resized copy of each image at this width, can be repeated",
+    ),
+]
+DerivativeFormatsOption = Annotated[
+    list[str] | None,
+    typer.Option(
+        "--derivative-format",
+        callback=_validate_derivative_formats,
+        help="Format to render derivatives in, can be repeated [default: webp]",
+    ),
+]
+
+StripMetadataOption = Annotated[
+    bool,
+    typer.Option(
+        "--strip-metadata",
+        help="Strip the metadata from uploaded images, keeping only --keep-tag tags",
+    ),
+]
+KeepTagsOption = Annotated[
+    list[str] | None,
+    typer.Option(
+        "--keep-tag",
+        help="Tag to keep when stripping metadata, e.g. IPTC:Keywords, can be"
+        " repeated [default: orientation, colour space, capture date and"
+        " copyright]",
+    ),
+]
+RewriteTagsOption = Annotated[
+    list[str] | None,
+    typer.Option(
+        "--rewrite-tag",
+        callback=_validate_rewrites,
+        help="TAG/PATTERN/REPLACEMENT regex rewrite of a kept tag's values when"
+        " stripping metadata, values rewritten to nothing are removed, can be"
+        " repeated",
+    ),
+]
+IncludeOption = Annotated[
+    list[str] | None,
+    typer.Option(
+        "--include",
+        help="Glob of the images to publish, matched against their path relative"
+        " to source_path where `*` also matches `/`, can be repeated [default:"
+        " every image]",
+    ),
+]
+ExcludeOption = Annotated[
+    list[str] | None,
+    typer.Option(
+        "--exclude",
+        help="Glob of the images or directories in source_path to skip, matched"
+        " like --include, can be repeated",
+    ),
+]
+MaxDistanceOption = Annotated[
+    int,
+    typer.Option(
+        min=0,
+        max=64,
+        help="How many bits of their perceptual hashes two images can differ by"
+        " and still be near duplicates",
+    ),
+]
+ScanThreadsOption = Annotated[
+    int, typer.Option(min=1, help="Number of directories to list at once")
+]
+VerifyOption = Annotated[
+    VerifyMode,
+    typer.Option(
+        help="How files already in dest are checked before skipping them, size and"
+        " checksum upload any that don't match again (checksum reads every file)"
+    ),
+]
+
+
+def _scan_options(include: list[str] | None, exclude: list[str] | None):
+    return ScanOptions(include=tuple(include or ()), exclude=tuple(exclude or ()))
+
+
+def _strip_options(
+    strip_metadata: bool, keep_tags: list[str] | None, rewrites: list[str] | None
+):
+    if not strip_metadata:
+        return None
+
+    return StripOptions(
+        keep_tags=frozenset(keep_tags) if keep_tags else DEFAULT_KEPT_TAGS,
+        rewrites=tuple(parse_rewrite(rule) for rule in rewrites or []),
+    )
+
+
+def _derivative_specs(widths: list[int] | None, formats: list[str] | None):
+    return derivative_specs(
+        widths or [],
+        # already checked by _validate_derivative_formats
+        cast(list[DerivativeFormat], formats) or DEFAULT_DERIVATIVE_FORMATS,
+    )
+
+
+def _empty_manifest():
+    return Manifest(
+        version=MANIFEST_VERSION, hash_engine=DEFAULT_HASH_ENGINE, images={}
+    )
+
+
+def _derivative_cache_dir():
+    hash_cache = get_hash_cache()
+    return hash_cache.cache_dir if hash_cache else None
+
+
+@app.callback()
+def main(
+    ctx: typer.Context,
+    no_cache: Annotated[
+        bool,
+        typer.Option(
+            "--no-cache",
+            help="Don't read or write the persistent hash and derivative caches",
+        ),
+    ] = False,
+    cache_dir: Annotated[
+        pathlib.Path | None,
+        typer.Option(help="Directory to keep the hash and derivative caches in"),
+    ] = None,
+    profile: Annotated[
+        pathlib.Path | None,
+        typer.Option(
+            help="Profile the main thread with cProfile, writing the stats to this"
+            " file and logging the slowest functions"
+        ),
+    ] = None,
+    metrics_json: Annotated[
+        pathlib.Path | None,
+        typer.Option(
+            help="Write a summary of the run's phase timings and counters to this"
+            " JSON file"
+        ),
+    ] = None,
+    exiftool_processes: Annotated[
+        int,
+        typer.Option(
+            min=1, help="How many exiftool processes to read and write tags with"
+        ),
+    ] = DEFAULT_EXIFTOOL_PROCESSES,
+):
+    set_exiftool_processes(exiftool_processes)
+    ctx.call_on_close(close_exiftool)
+
+    if not no_cache:
+        hash_cache = HashCache(cache_dir or default_cache_dir())
+        set_hash_cache(hash_cache)
+        ctx.call_on_close(hash_cache.close)
+        ctx.call_on_close(lambda: set_hash_cache(None))
+
+    reset_metrics()
+    if metrics_json or profile:
+        ctx.call_on_close(lambda: _finish_metrics(ctx.invoked_subcommand, metrics_json))
+    if profile:
+        ctx.with_resource(profile_run(profile))
+
+
+def _finish_metrics(command: str | None, metrics_json: pathlib.Path | None):
+    metrics = get_metrics()
+    for name, function in (("hash_image", hash_image), ("read_tags", read_tags)):
+        info = function.cache_info()
+        metrics.count(f"{name}.memo_hits", info.hits)
+        metrics.count(f"{name}.memo_misses", info.misses)
+
+    summary = metrics.summary(command)
+    log_summary(summary)
+    if metrics_json:
+        write_summary(metrics_json, summary)
+
+
+def _read_arguments(values: list[str]):
+    """
+    Replaces a `-` argument with the lines read from stdin.
+    """
+
+    arguments = []
+    for value in values:
+        if value == "-":
+            arguments.extend(line.strip() for line in sys.stdin if line.strip())
+        else:
+            arguments.append(value)
+
+    return arguments
+
+
+def _expand_image_paths(patterns: list[str]):
+    """
+    Expands the image arguments of a command into the images they name, along
+    with their stat results. Patterns containing glob characters are expanded,
+    in case they weren't by the shell, and `-` reads paths from stdin, only the
+    images a glob matches are kept, not e.g. their .xmp sidecars. Exits if any
+    path doesn't exist.
+    """
+
+    scan = ScanOptions()
+    images: dict[pathlib.Path, ScannedImage] = {}
+    for pattern in _read_arguments(patterns):
+        # a path which exists is taken as is, even if it looks like a glob
+        if glob.has_magic(pattern) and not pathlib.Path(pattern).exists():
+            matches = sorted(
+                match
+                for match in glob.glob(pattern, recursive=True)
+                if scan.includes(match)
+            )
+            if not matches:
+                logging.error("`%s` didn't match any images!", pattern)
+                exit(1)
+            for match in matches:
+                # not a directory which happens to be named like an image
+                image = stat_image(pathlib.Path(match))
+                if image is not None:
+                    images[image.path] = image
+            continue
+
+        image_path = pathlib.Path(pattern)
+        image = stat_image(image_path)
+        if image is None:
+            logging.error("`%s` doesn't exist!", image_path)
+            exit(1)
+        images[image_path] = image
+
+    return list(images.values())
+
+
+def _sync_journal(
+    source_path: pathlib.Path,
+    dest: str,
+    dest_type: str,
+    resume: bool,
+    options: dict,
+):
+    """
+    Opens the journal of syncing source_path to dest in the cache dir, reading
+    in the interrupted sync's if resuming. Without a cache dir there is nowhere
+    to keep one, so nothing is journaled.
+    """
+
+    hash_cache = get_hash_cache()
+    if hash_cache is None:
+        if resume:
+            logging.error("--resume needs the cache dir to keep the journal in!")
+            exit(1)
+        return contextlib.nullcontext()
+
+    return SyncJournal(
+        journal_dir(hash_cache.cache_dir, source_path, dest, dest_type),
+        options,
+        resume,
+    )
+
+
+def _upload_images(
+    dest_fs: "DirFileSystem",
+    images: Iterable[ScannedImage],
+    listing: DestListing,
+    jobs: int,
+    hash_engine: HashEngine,
+    specs: list[DerivativeSpec],
+    upload_concurrency: int,
+    strip: StripOptions | None = None,
+    known_previews: dict[str, ImagePreview] | None = None,
+    near_duplicates: NearDuplicateOptions | None = None,
+    journal: SyncJournal | None = None,
+    published_derivatives: dict[str, list[Derivative]] | None = None,
+):
+    """
+    Hashes the images (which can be fed in as they're found, see get_images)
+    and renders their derivatives, uploading each file that isn't already in
+    dest (going by listing) as soon as it is ready. The images have their
+    metadata stripped on the way if strip is given.
+
+    Given a journal, the hashes, previews and files landed in dest are recorded
+    in it, and images it already has a hash for aren't hashed again.
+
+    Derivatives which dest already holds aren't rendered again, those in
+    published_derivatives (by image hash) are taken from there. The images are
+    previewed too (from the same decode as they're hashed with, if any), other
+    than those whose hash is in known_previews. Near duplicates are skipped if
+    near_duplicates is given, in which case images are only uploaded once
+    they've all been previewed.
+
+    Returns the hash of each image, the derivatives of each image and the
+    preview of each image by its hash.
+    """
+
+    image_hashes: dict[pathlib.Path, str] = {}
+    image_derivatives: dict[pathlib.Path, list[Derivative]] = {}
+    journaled: dict[pathlib.Path, str] = {}
+    # of the images hashed, to journal them with
+    stats: dict[pathlib.Path, os.stat_result] = {}
+
+    def unjournaled(images: Iterable[ScannedImage]):
+        for image in images:
+            if journal is None:
+                yield image
+                continue
+
+            image_hash = journal.hash_of(image.path, image.stat)
+            if image_hash is None:
+                stats[image.path] = image.stat
+                yield image
+            else:
+                journaled[image.path] = image_hash
+
+    with (
+        derivative_output_dir(_derivative_cache_dir()) as render_dir,
+        Uploader(
+            dest_fs, upload_concurrency, listing=listing, journal=journal
+        ) as uploader,
+    ):
+        # previewed while they're hashed, if hashing decodes them
+        hashed_previews: dict[str, ImagePreview] = {}
+        with phase("hash_images"):
+            # the journaled images are only known once the rest are all found
+            for image_path, image_hash in itertools.chain(
+                hash_images(unjournaled(images), jobs, hash_engine, hashed_previews),
+                journaled.items(),
+            ):
+                if journal and image_path not in journaled:
+                    journal.hashed(image_path, image_hash, stats.pop(image_path))
+                image_hashes[image_path] = image_hash
+                if near_duplicates is None:
+                    uploader.submit(
+                        image_path, image_filename(image_path, image_hash), strip
+                    )
+
+        with phase("preview_images"):
+            known_previews = known_previews or {}
+            previews = preview_images(
+                image_hashes.items(), known_previews | hashed_previews, jobs
+            )
+            if journal:
+                for image_hash in previews.keys() - known_previews.keys():
+                    journal.previewed(image_hash, previews[image_hash])
+
+        if near_duplicates is not None:
+            with phase("near_duplicates"):
+                image_hashes = select_distinct(
+                    image_hashes,
+                    {
+                        image_hash: preview.perceptual_hash
+                        for image_hash, preview in previews.items()
+                    },
+                    near_duplicates,
+                )
+            for image_path, image_hash in image_hashes.items():
+                uploader.submit(
+                    image_path, image_filename(image_path, image_hash), strip
+                )
+
+        if specs:
+            with phase("render_derivatives"):
+                for image_path, derivatives in render_all_derivatives(
+                    image_hashes.items(),
+                    specs,
+                    render_dir,
+                    jobs,
+                    listing.holds,
+                    published_derivatives,
+                ):
+                    image_derivatives[image_path] = derivatives
+                    count("derivatives.files", len(derivatives))
+                    for derivative in derivatives:
+                        if derivative.path is not None:
+                            uploader.submit(derivative.path, derivative.filename)
+
+        with phase("upload_wait"):
+            uploader.wait()
+
+    if uploader.skipped_files:
+        logging.info("%d files were already in dest", uploader.skipped_files)
+
+    return image_hashes, image_derivatives, previews
 
 
 @app.command()
@@ -27,87 +536,643 @@ def sync(
     ],
     dest: Annotated[str, typer.Argument(help="Destination path or bucket name")],
     dest_type: dest_type_options = "dir",
+    include: IncludeOption = None,
+    exclude: ExcludeOption = None,
+    scan_threads: ScanThreadsOption = DEFAULT_SCAN_THREADS,
+    exiftool_chunk_size: Annotated[
+        int, typer.Option(min=1, help="Number of files to read tags from per call")
+    ] = DEFAULT_EXIFTOOL_CHUNK_SIZE,
+    jobs: Annotated[
+        int, typer.Option(min=1, help="Number of processes to hash images with")
+    ] = 1,
+    incremental: Annotated[
+        bool,
+        typer.Option(
+            "--incremental/--full",
+            help="Skip rewriting dest's manifest when it is unchanged",
+        ),
+    ] = True,
+    upload_concurrency: Annotated[
+        int, typer.Option(min=1, help="Number of images to upload at once")
+    ] = DEFAULT_UPLOAD_CONCURRENCY,
+    hash_engine: HashEngine = DEFAULT_HASH_ENGINE,
+    derivative_widths: DerivativeWidthsOption = None,
+    derivative_formats: DerivativeFormatsOption = None,
+    strip_metadata: StripMetadataOption = False,
+    keep_tags: KeepTagsOption = None,
+    rewrite_tags: RewriteTagsOption = None,
+    verify: VerifyOption = "exists",
+    skip_near_duplicates: Annotated[
+        bool,
+        typer.Option(
+            help="Only publish one of each group of near duplicate images, keeping"
+            " any already in dest"
+        ),
+    ] = False,
+    max_distance: MaxDistanceOption = DEFAULT_MAX_DISTANCE,
+    manifest_format: Annotated[
+        ManifestFormat,
+        typer.Option(
+            help="v3 splits the manifest into shards for large galleries, columnar"
+            " stores it a field at a time to save space"
+        ),
+    ] = "v2",
+    shard_size: Annotated[
+        int, typer.Option(min=1, help="Number of images per v3 manifest shard")
+    ] = DEFAULT_SHARD_SIZE,
+    keyword_shards: Annotated[
+        bool, typer.Option(help="Also write a v3 manifest shard per keyword")
+    ] = False,
+    keyword_index: Annotated[
+        bool,
+        typer.Option(
+            help="Write a keyword index alongside the manifest, it is always kept"
+            " up to date if dest already has one"
+        ),
+    ] = False,
+    precompress: Annotated[
+        list[str] | None,
+        typer.Option(
+            callback=_validate_compressions,
+            help="Also write a compressed copy of each manifest file, e.g. `.br`,"
+            " can be repeated",
+        ),
+    ] = None,
+    resume: Annotated[
+        bool,
+        typer.Option(
+            help="Pick up where an interrupted sync to dest left off, skipping the"
+            " images it hashed and the files it uploaded"
+        ),
+    ] = False,
 ):
     """
     Reads in the images in source_path. Generates a manifest. Writes the images
-    and manifest to the selected dest, deleting any existing contents.
+    (and any derivatives of them) and manifest to the selected dest, removing
+    any images that are no longer in source_path.
+
+    Progress is journaled in the cache dir as it goes, so an interrupted sync
+    can be picked up again with --resume.
     """
 
-    dest_fs = get_fs(dest, dest_type)
-    image_paths = get_images(source_path)
+    dest_fs = get_fs(dest, dest_type, max_connections=upload_concurrency)
 
-    manifest = generate_manifest(image_paths)
+    # anything which changes what ends up in dest, a resumed sync has to match
+    options = {
+        "hash_engine": hash_engine,
+        "derivative_widths": derivative_widths or [],
+        "derivative_formats": derivative_formats or [],
+        "strip_metadata": strip_metadata,
+        "keep_tags": keep_tags or [],
+        "rewrite_tags": rewrite_tags or [],
+        "skip_near_duplicates": skip_near_duplicates,
+        "max_distance": max_distance,
+        "manifest_format": manifest_format,
+        "shard_size": shard_size,
+        "keyword_shards": keyword_shards,
+        "precompress": precompress or [],
+    }
+    with _sync_journal(source_path, dest, dest_type, resume, options) as journal:
+        _sync(
+            dest_fs,
+            source_path,
+            journal,
+            _scan_options(include, exclude),
+            scan_threads,
+            exiftool_chunk_size,
+            jobs,
+            incremental,
+            upload_concurrency,
+            hash_engine,
+            _derivative_specs(derivative_widths, derivative_formats),
+            _strip_options(strip_metadata, keep_tags, rewrite_tags),
+            verify,
+            max_distance if skip_near_duplicates else None,
+            manifest_format,
+            ShardOptions(shard_size=shard_size, keyword_shards=keyword_shards),
+            keyword_index,
+            # already checked by _validate_compressions
+            cast(list[Compression], precompress or []),
+        )
 
-    for image_path in image_paths:
-        write_image(dest_fs, image_path)
 
-    write_manifest(dest_fs, manifest)
+def _sync(
+    dest_fs: "DirFileSystem",
+    source_path: pathlib.Path,
+    journal: SyncJournal | None,
+    scan: ScanOptions,
+    scan_threads: int,
+    exiftool_chunk_size: int,
+    jobs: int,
+    incremental: bool,
+    upload_concurrency: int,
+    hash_engine: HashEngine,
+    specs: list[DerivativeSpec],
+    strip: StripOptions | None,
+    verify: VerifyMode,
+    max_distance: int | None,
+    manifest_format: ManifestFormat,
+    sharding: ShardOptions,
+    keyword_index: bool,
+    precompress: list[Compression],
+):
+    with phase("read_manifest"):
+        existing_manifest = read_manifest(dest_fs)
+
+    listing = DestListing(dest_fs, verify)
+    if journal:
+        # landed whole (uploads are atomic), so aren't verified again
+        listing.landed(journal.landed)
+
+    # images are hashed and uploaded as they're found
+    published_perceptual_hashes = (
+        manifest_perceptual_hashes(existing_manifest) if existing_manifest else {}
+    )
+    known_previews = manifest_previews(existing_manifest) if existing_manifest else {}
+    if journal:
+        known_previews.update(journal.previews)
+    image_hashes, image_derivatives, previews = _upload_images(
+        dest_fs,
+        get_images(source_path, scan, scan_threads),
+        listing,
+        jobs,
+        hash_engine,
+        specs,
+        upload_concurrency,
+        strip,
+        known_previews,
+        NearDuplicateOptions(max_distance, published_perceptual_hashes, mirror=True)
+        if max_distance is not None
+        else None,
+        journal,
+        published_derivatives=manifest_derivatives(existing_manifest)
+        if existing_manifest
+        else None,
+    )
+    image_paths = list(image_hashes)
+    count("images", len(image_paths))
+
+    pending_manifest = journal.pending_manifest if journal else None
+    if journal and pending_manifest is not None and journal.unchanged(image_hashes):
+        logging.info("Images are unchanged since the interrupted sync")
+        manifest = pending_manifest
+    else:
+        with phase("generate_manifest"):
+            manifest = generate_manifest(
+                image_paths,
+                exiftool_chunk_size,
+                image_hashes,
+                hash_engine,
+                image_derivatives if specs else None,
+                manifest_format,
+                sharding,
+                precompress,
+                previews,
+            )
+
+    diff = diff_manifests(existing_manifest, manifest)
+    logging.info(
+        "%d images added, %d removed, %d unchanged",
+        len(diff.added),
+        len(diff.removed),
+        len(diff.unchanged),
+    )
+
+    # files the interrupted sync was going to remove, or uploaded for images
+    # which have been removed since, are as stale as the old manifest's
+    stale = manifest_filenames(existing_manifest) if existing_manifest else set()
+    if journal:
+        stale |= journal.stale | journal.landed
+    stale -= manifest_filenames(manifest)
+    if journal:
+        journal.pending(manifest, stale)
+
+    with phase("keyword_index"):
+        existing_keyword_index = read_keyword_index(dest_fs)
+        if keyword_index or existing_keyword_index:
+            new_keyword_index = build_keyword_index(manifest)
+            if new_keyword_index != existing_keyword_index:
+                write_keyword_index(
+                    dest_fs, new_keyword_index, manifest.get("precompressed", [])
+                )
+
+    if incremental and manifest == existing_manifest:
+        logging.info("Manifest is unchanged, not rewriting it")
+    else:
+        with phase("write_manifest"):
+            write_manifest(dest_fs, manifest)
+    if journal:
+        journal.committed()
+
+    # only remove the files once the manifest no longer refers to them
+    with phase("remove_images"):
+        remove_images(dest_fs, stale)
+
+    if journal:
+        journal.finish()
 
 
 @app.command()
-def hash(image_path: pathlib.Path):
+def hash(image_path: pathlib.Path, engine: HashEngine = DEFAULT_HASH_ENGINE):
     """
     Get the hash of a provided image file. This only takes into account the image
     bytes themselves, not metadata, so is stable when changing tags.
     """
 
-    logging.info("Hash of `%s`: `%s`", image_path.name, hash_image(image_path))
+    logging.info("Hash of `%s`: `%s`", image_path.name, hash_image(image_path, engine))
 
 
 @app.command()
 def add(
     dest: Annotated[str, typer.Argument(help="Destination path or bucket name")],
-    image_path: pathlib.Path,
+    image_paths: Annotated[
+        list[str],
+        typer.Argument(
+            help="Images to add, globs are expanded and `-` reads paths from stdin"
+        ),
+    ],
     dest_type: dest_type_options = "dir",
+    exiftool_chunk_size: Annotated[
+        int, typer.Option(min=1, help="Number of files to read tags from per call")
+    ] = DEFAULT_EXIFTOOL_CHUNK_SIZE,
+    jobs: Annotated[
+        int, typer.Option(min=1, help="Number of processes to hash images with")
+    ] = 1,
+    upload_concurrency: Annotated[
+        int, typer.Option(min=1, help="Number of images to upload at once")
+    ] = DEFAULT_UPLOAD_CONCURRENCY,
+    derivative_widths: DerivativeWidthsOption = None,
+    derivative_formats: DerivativeFormatsOption = None,
+    strip_metadata: StripMetadataOption = False,
+    keep_tags: KeepTagsOption = None,
+    rewrite_tags: RewriteTagsOption = None,
+    verify: VerifyOption = "exists",
 ):
     """
-    Add a single image to dest.
+    Add images to dest, writing the manifest once they have all been added.
+    The images are hashed with the same engine as the rest of dest's manifest.
     """
 
-    dest_fs = get_fs(dest, dest_type)
+    dest_fs = get_fs(dest, dest_type, max_connections=upload_concurrency)
+    images = _expand_image_paths(image_paths)
 
-    write_image(dest_fs, image_path)
+    manifest = read_manifest(dest_fs) or _empty_manifest()
+    hash_engine = manifest_hash_engine(manifest)
 
-    manifest: Manifest | None = None
+    specs = _derivative_specs(derivative_widths, derivative_formats)
+    image_hashes, image_derivatives, previews = _upload_images(
+        dest_fs,
+        images,
+        DestListing(dest_fs, verify),
+        jobs,
+        hash_engine,
+        specs,
+        upload_concurrency,
+        _strip_options(strip_metadata, keep_tags, rewrite_tags),
+        manifest_previews(manifest),
+        published_derivatives=manifest_derivatives(manifest),
+    )
 
-    try:
-        with dest_fs.open("manifest.json", "rb") as file:
-            manifest = json.load(file)
+    with phase("generate_manifest"):
+        entries = generate_manifest_entries(
+            [image.path for image in images],
+            exiftool_chunk_size,
+            image_hashes,
+            hash_engine,
+            image_derivatives if specs else None,
+            previews,
+        )
 
-        manifest["images"][hash_image(image_path)] = generate_manifest_entry(image_path)
-    except FileNotFoundError:
-        pass
+    def add_entries(manifest: Manifest | None):
+        manifest = manifest or _empty_manifest()
+        manifest["images"].update(entries)
+        return manifest
+
+    # merged into whatever the manifest holds by then, so images added or
+    # removed by anything else at the same time are kept
+    with phase("write_manifest"):
+        manifest, _ = update_manifest(dest_fs, add_entries)
 
-    if not manifest:
-        manifest = generate_manifest([image_path])
+    def add_keywords(keyword_index: KeywordIndex):
+        for image_hash, entry in entries.items():
+            add_to_keyword_index(keyword_index, image_hash, entry)
 
-    write_manifest(dest_fs, manifest)
+    with phase("keyword_index"):
+        update_keyword_index(dest_fs, add_keywords, manifest.get("precompressed", []))
 
 
 @app.command()
 def remove(
     dest: Annotated[str, typer.Argument(help="Destination path or bucket name")],
-    hash: Annotated[str, typer.Argument(help="Image hash of image to remove")],
+    hashes: Annotated[
+        list[str],
+        typer.Argument(
+            help="Image hashes of images to remove, `-` reads hashes from stdin"
+        ),
+    ],
     dest_type: dest_type_options = "dir",
 ):
     """
-    Remove an image by hash from the dest.
+    Remove images by hash from the dest, writing the manifest once they have all
+    been removed.
     """
 
     dest_fs = get_fs(dest, dest_type)
 
-    with dest_fs.open("manifest.json", "rb") as file:
-        manifest: Manifest = json.load(file)
+    manifest = read_manifest(dest_fs)
+    if manifest is None:
+        raise FileNotFoundError(f"`{dest}` has no manifest")
 
-    entry = manifest["images"].get(hash)
-    if not entry:
-        logging.error("Provided hash `%s` not found in the manifest!", hash)
+    hashes = list(dict.fromkeys(_read_arguments(hashes)))
+    missing = [hash for hash in hashes if hash not in manifest["images"]]
+    if missing:
+        for hash in missing:
+            logging.error("Provided hash `%s` not found in the manifest!", hash)
         exit(1)
 
-    dest_fs.rm(entry["filename"])
-    del manifest["images"][hash]
+    def remove_entries(manifest: Manifest | None):
+        if manifest is None:
+            raise FileNotFoundError(f"`{dest}` has no manifest")
+
+        # anything removed at the same time by something else is already gone
+        for hash in hashes:
+            manifest["images"].pop(hash, None)
+        return manifest
+
+    # only remove the files once the manifest no longer refers to them
+    with phase("write_manifest"):
+        manifest, removed_filenames = update_manifest(dest_fs, remove_entries)
+    with phase("remove_images"):
+        remove_images(dest_fs, removed_filenames)
+
+    def remove_keywords(keyword_index: KeywordIndex):
+        for hash in hashes:
+            remove_from_keyword_index(keyword_index, hash)
+
+    with phase("keyword_index"):
+        update_keyword_index(
+            dest_fs, remove_keywords, manifest.get("precompressed", [])
+        )
+
+
+@app.command()
+def duplicates(
+    dest: Annotated[str, typer.Argument(help="Destination path or bucket name")],
+    dest_type: dest_type_options = "dir",
+    max_distance: MaxDistanceOption = DEFAULT_MAX_DISTANCE,
+):
+    """
+    List the groups of near duplicate images in dest, e.g. re-exports or
+    resized copies of the same shot, going by the perceptual hashes in its
+    manifest.
+    """
+
+    dest_fs = get_fs(dest, dest_type)
+
+    manifest = read_manifest(dest_fs)
+    if manifest is None:
+        raise FileNotFoundError(f"`{dest}` has no manifest")
+
+    perceptual_hashes = manifest_perceptual_hashes(manifest)
+    missing = len(manifest["images"]) - len(perceptual_hashes)
+    if missing:
+        logging.warning(
+            "%d images have no perceptual hash, sync dest to add them", missing
+        )
+
+    groups = find_near_duplicates(perceptual_hashes, max_distance)
+    for group in groups:
+        logging.info(
+            "Near duplicates: %s",
+            " ".join(
+                f"`{manifest['images'][image_hash]['filename']}`"
+                for image_hash in group
+            ),
+        )
+    logging.info("%d groups of near duplicates", len(groups))
+
+
+@app.command()
+def watch(
+    source_path: Annotated[
+        pathlib.Path, typer.Argument(help="Path to source directory")
+    ],
+    dest: Annotated[str, typer.Argument(help="Destination path or bucket name")],
+    dest_type: dest_type_options = "dir",
+    include: IncludeOption = None,
+    exclude: ExcludeOption = None,
+    scan_threads: ScanThreadsOption = DEFAULT_SCAN_THREADS,
+    exiftool_chunk_size: Annotated[
+        int, typer.Option(min=1, help="Number of files to read tags from per call")
+    ] = DEFAULT_EXIFTOOL_CHUNK_SIZE,
+    jobs: Annotated[
+        int, typer.Option(min=1, help="Number of processes to hash images with")
+    ] = 1,
+    upload_concurrency: Annotated[
+        int, typer.Option(min=1, help="Number of images to upload at once")
+    ] = DEFAULT_UPLOAD_CONCURRENCY,
+    derivative_widths: DerivativeWidthsOption = None,
+    derivative_formats: DerivativeFormatsOption = None,
+    strip_metadata: StripMetadataOption = False,
+    keep_tags: KeepTagsOption = None,
+    rewrite_tags: RewriteTagsOption = None,
+    verify: VerifyOption = "exists",
+    debounce: Annotated[
+        float,
+        typer.Option(
+            min=0, help="Seconds to wait for changes to stop before applying them"
+        ),
+    ] = DEFAULT_DEBOUNCE,
+    poll: Annotated[
+        bool,
+        typer.Option(help="Poll source_path for changes rather than using inotify"),
+    ] = False,
+):
+    """
+    Syncs source_path to dest, then keeps running and applies any images added
+    to, changed in or removed from source_path to dest as they happen.
+
+    dest's manifest keeps its format, and its images are hashed with the same
+    engine as before.
+    """
+
+    dest_fs = get_fs(dest, dest_type, max_connections=upload_concurrency)
+    specs = _derivative_specs(derivative_widths, derivative_formats)
+    strip = _strip_options(strip_metadata, keep_tags, rewrite_tags)
+    scan = _scan_options(include, exclude)
+    # listed once, and kept up to date with what's uploaded and removed after
+    listing = DestListing(dest_fs, verify)
+
+    manifest = read_manifest(dest_fs) or _empty_manifest()
+    keyword_index = read_keyword_index(dest_fs)
+    # the hash of each image in source_path
+    path_hashes: dict[pathlib.Path, str] = {}
+
+    # scanned has any of the images just found by scanning, so they needn't be
+    # statted again
+    def apply_changes(
+        changed_paths: set[pathlib.Path],
+        scanned: dict[pathlib.Path, ScannedImage] | None = None,
+    ):
+        start = time.perf_counter()
+
+        # a changed file at the same path must be hashed and read again
+        hash_image.cache_clear()
+        read_tags.cache_clear()
+
+        images = []
+        removed_paths = set()
+        for image_path in changed_paths:
+            relative_path = image_path.relative_to(source_path).as_posix()
+            image = None
+            if scan.includes(relative_path):
+                image = (scanned or {}).get(image_path) or stat_image(image_path)
+            if image is not None:
+                images.append(image)
+            else:
+                removed_paths.add(image_path)
+        image_paths = [image.path for image in images]
+        # a removed directory takes every image under it with it
+        if removed_paths:
+            for image_path in list(path_hashes):
+                if image_path in removed_paths or not removed_paths.isdisjoint(
+                    image_path.parents
+                ):
+                    del path_hashes[image_path]
+
+        hash_engine = manifest_hash_engine(manifest)
+        filenames = manifest_filenames(manifest)
+        image_hashes, image_derivatives, previews = _upload_images(
+            dest_fs,
+            images,
+            listing,
+            jobs,
+            hash_engine,
+            specs,
+            upload_concurrency,
+            strip,
+            manifest_previews(manifest),
+            published_derivatives=manifest_derivatives(manifest),
+        )
+        path_hashes.update(image_hashes)
+
+        # the in memory manifest is only updated once the new one is written
+        images = dict(manifest["images"])
+        # entries are regenerated even if the hash is unchanged, as the image's
+        # tags may have been edited
+        images.update(
+            generate_manifest_entries(
+                image_paths,
+                exiftool_chunk_size,
+                image_hashes,
+                hash_engine,
+                image_derivatives if specs else None,
+                previews,
+            )
+        )
+        # dest mirrors source_path, so anything no image there has is removed
+        removed = set(images) - set(path_hashes.values())
+        for image_hash in removed:
+            del images[image_hash]
+
+        if images == manifest["images"]:
+            return
+
+        old_images = manifest["images"]
+        manifest["images"] = images
+        write_manifest(dest_fs, manifest)
+        removed_filenames = filenames - manifest_filenames(manifest)
+        remove_images(dest_fs, removed_filenames)
+        listing.removed(removed_filenames)
+
+        if keyword_index:
+            for image_hash in removed:
+                remove_from_keyword_index(keyword_index, image_hash)
+            for image_hash, entry in manifest["images"].items():
+                if old_images.get(image_hash) != entry:
+                    add_to_keyword_index(keyword_index, image_hash, entry)
+            write_keyword_index(
+                dest_fs, keyword_index, manifest.get("precompressed", [])
+            )
+
+        logging.info(
+            "%d images added, %d removed, published in %.2fs",
+            len(images.keys() - old_images.keys()),
+            len(removed),
+            time.perf_counter() - start,
+        )
+
+    # start watching before the first sync, so nothing changed during it is missed
+    watcher = create_watcher(source_path, poll, scan)
+    try:
+        scanned = {
+            image.path: image for image in get_images(source_path, scan, scan_threads)
+        }
+        apply_changes(set(scanned), scanned)
+        logging.info("Watching `%s` for changes", source_path)
+
+        for changed_paths in watch_changes(watcher, debounce):
+            scanned = None
+            if changed_paths is None:
+                logging.warning("Missed some changes, checking every image")
+                scanned = {
+                    image.path: image
+                    for image in get_images(source_path, scan, scan_threads)
+                }
+                changed_paths = set(scanned) | set(path_hashes)
+
+            try:
+                apply_changes(changed_paths, scanned)
+            except Exception:
+                # keep watching, the images will be retried when next changed
+                logging.exception("Failed to apply changes to `%s`", dest)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def _require_hash_cache():
+    hash_cache = get_hash_cache()
+    if not hash_cache:
+        logging.error("The hash cache is disabled!")
+        exit(1)
+
+    return hash_cache
+
+
+@cache_app.command("stats")
+def cache_stats():
+    """
+    Show where the hash cache is and how much it holds.
+    """
+
+    stats = _require_hash_cache().stats()
+    logging.info(
+        "Hash cache `%s`: %d entries, %d bytes", stats.path, stats.entries, stats.size
+    )
+
+
+@cache_app.command("prune")
+def cache_prune():
+    """
+    Remove hash cache entries for files which no longer exist or have changed.
+    """
+
+    removed = _require_hash_cache().prune()
+    logging.info("Pruned %d stale entries from the hash cache", removed)
+
+
+@cache_app.command("clear")
+def cache_clear():
+    """
+    Remove every entry from the hash cache, and every rendered derivative.
+    """
 
-    write_manifest(dest_fs, manifest)
+    hash_cache = _require_hash_cache()
+    hash_cache.clear()
+    shutil.rmtree(hash_cache.cache_dir / DERIVATIVE_CACHE_DIRNAME, ignore_errors=True)
+    logging.info("Cleared the hash and derivative caches")
 
 
 if __name__ == "__main__":
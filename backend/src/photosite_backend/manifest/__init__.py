@@ -3,45 +3,212 @@ This file contains the functions that will generate the manifest file from
 the parsed image metadata.
 """
 
-import json
 import logging
 import pathlib
-from typing import Iterable, TypedDict
-
-from fsspec.implementations.dirfs import DirFileSystem
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Iterable,
+    Literal,
+    NamedTuple,
+    NotRequired,
+    TypedDict,
+)
 
+from photosite_backend.backends.conditional import (
+    DEFAULT_COMMIT_ATTEMPTS,
+    FileVersion,
+    read_versioned,
+    retry_on_conflict,
+)
 from photosite_backend.image import (
+    DEFAULT_EXIFTOOL_CHUNK_SIZE,
     hash_image,
-    read_tags,
+    read_manifest_tags,
+    read_manifest_tags_bulk,
+)
+from photosite_backend.image.derivatives import Derivative, DerivativeFormat
+from photosite_backend.image.hashing import DEFAULT_HASH_ENGINE, HashEngine
+from photosite_backend.image.preview import ImagePreview
+from photosite_backend.manifest.columnar import (
+    COLUMNAR_MANIFEST_VERSION,
+    from_columnar,
+    to_columnar,
+)
+from photosite_backend.manifest.encoding import (
+    Compression,
+    dumps,
+    loads,
+    write_encoded,
 )
+from photosite_backend.manifest.sharded import (
+    DEFAULT_SHARD_SIZE,
+    SHARD_PREFIX,
+    SHARDED_MANIFEST_VERSION,
+    ShardOptions,
+    read_sharded_manifest,
+    write_sharded_manifest,
+)
+
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
 
 MANIFEST_VERSION = 2
+MANIFEST_FILENAME = "manifest.json"
+
+# v2 is a single file holding every image, v3 is sharded and columnar is a
+# single file with the images stored a field at a time
+ManifestFormat = Literal["v2", "v3", "columnar"]
+
+
+class DerivativeEntry(TypedDict):
+    filename: str
+    width: int
+    height: int
+    format: DerivativeFormat
 
 
 class ManifestEntry(TypedDict):
     filename: str
     created_date: str | None
     keyword_tags: list[str]
+    # only present if the image has XMP:HierarchicalSubject tags, e.g.
+    # `animal|cat`
+    hierarchical_subjects: NotRequired[list[str]]
+    # only present when derivatives were generated
+    derivatives: NotRequired[list[DerivativeEntry]]
+    # hex dHash of the image for finding near duplicates, only present if it
+    # was computed
+    perceptual_hash: NotRequired[str]
+    # the rest of the image's preview, present along with its perceptual hash
+    # in manifests written since previews were: its size as shown (with the
+    # EXIF orientation applied) and a tiny placeholder to show while it loads
+    width: NotRequired[int]
+    height: NotRequired[int]
+    placeholder: NotRequired[str]
 
 
 class Manifest(TypedDict):
     version: int
+    # the engine the image hashes were made with, manifests written before
+    # this was recorded all used pixels.
+    hash_engine: NotRequired[HashEngine]
+    # only present in sharded (v3) manifests, how the images are split up
+    sharding: NotRequired[ShardOptions]
+    # the compressed siblings written alongside each manifest file, if any
+    precompressed: NotRequired[list[Compression]]
     images: dict[str, ManifestEntry]
 
 
-def generate_manifest(image_paths: Iterable[pathlib.Path]):
-    return Manifest(
-        version=MANIFEST_VERSION,
-        images={
-            hash_image(image_path): generate_manifest_entry(image_path)
-            for image_path in image_paths
-        },
+class ManifestDiff(NamedTuple):
+    added: set[str]
+    removed: set[str]
+    unchanged: set[str]
+
+
+def generate_manifest(
+    image_paths: Iterable[pathlib.Path],
+    exiftool_chunk_size: int = DEFAULT_EXIFTOOL_CHUNK_SIZE,
+    image_hashes: dict[pathlib.Path, str] | None = None,
+    hash_engine: HashEngine = DEFAULT_HASH_ENGINE,
+    image_derivatives: dict[pathlib.Path, list[Derivative]] | None = None,
+    manifest_format: ManifestFormat = "v2",
+    sharding: ShardOptions | None = None,
+    precompress: Iterable[Compression] = (),
+    previews: dict[str, ImagePreview] | None = None,
+):
+    """
+    Generates a manifest for the given images. Any hashes already computed for
+    them with hash_engine can be passed in as image_hashes so they aren't
+    decoded again, any derivatives rendered for them as image_derivatives and
+    their previews (by image hash) as previews.
+
+    manifest_format decides how the manifest will be written, sharding only
+    applies to the v3 format. Each manifest file is written along with
+    precompressed siblings for every compression in precompress.
+    """
+
+    images = generate_manifest_entries(
+        image_paths,
+        exiftool_chunk_size,
+        image_hashes,
+        hash_engine,
+        image_derivatives,
+        previews,
     )
 
+    manifest = Manifest(
+        version=MANIFEST_VERSION, hash_engine=hash_engine, images=images
+    )
+    if manifest_format == "v3":
+        manifest["version"] = SHARDED_MANIFEST_VERSION
+        manifest["sharding"] = sharding or ShardOptions(
+            shard_size=DEFAULT_SHARD_SIZE, keyword_shards=False
+        )
+    elif manifest_format == "columnar":
+        manifest["version"] = COLUMNAR_MANIFEST_VERSION
+
+    precompress = list(precompress)
+    if precompress:
+        manifest["precompressed"] = precompress
+
+    return manifest
+
 
-def generate_manifest_entry(image_path: pathlib.Path):
-    image_hash = hash_image(image_path)
-    image_tags = read_tags(image_path)
+def generate_manifest_entries(
+    image_paths: Iterable[pathlib.Path],
+    exiftool_chunk_size: int = DEFAULT_EXIFTOOL_CHUNK_SIZE,
+    image_hashes: dict[pathlib.Path, str] | None = None,
+    hash_engine: HashEngine = DEFAULT_HASH_ENGINE,
+    image_derivatives: dict[pathlib.Path, list[Derivative]] | None = None,
+    previews: dict[str, ImagePreview] | None = None,
+):
+    """
+    Generates the manifest entries of many images, reading all their tags with
+    one exiftool process. Returns a dict of image hash to entry.
+    """
+
+    image_paths = list(image_paths)
+    image_tags = read_manifest_tags_bulk(image_paths, exiftool_chunk_size)
+    image_hashes = image_hashes or {}
+    previews = previews or {}
+
+    images: dict[str, ManifestEntry] = {}
+    for image_path in image_paths:
+        image_hash = image_hashes.get(image_path) or hash_image(image_path, hash_engine)
+        images[image_hash] = generate_manifest_entry(
+            image_path,
+            image_tags[image_path],
+            image_hash,
+            hash_engine,
+            image_derivatives.get(image_path)
+            if image_derivatives is not None
+            else None,
+            previews.get(image_hash),
+        )
+
+    return images
+
+
+def generate_manifest_entry(
+    image_path: pathlib.Path,
+    image_tags: dict[str, Any] | None = None,
+    image_hash: str | None = None,
+    hash_engine: HashEngine = DEFAULT_HASH_ENGINE,
+    derivatives: list[Derivative] | None = None,
+    preview: ImagePreview | None = None,
+):
+    """
+    Generates the manifest entry for an image. If the image's tags or hash have
+    already been computed (e.g. in bulk), they can be passed in as image_tags
+    and image_hash to save doing the work again. Its preview is only included
+    if passed in, as computing it needs the image decoded.
+    """
+
+    image_hash = image_hash or hash_image(image_path, hash_engine)
+    if image_tags is None:
+        image_tags = read_manifest_tags(image_path)
 
     # in order of preference, check all these tags for the date
     possible_date_tags = ["EXIF:DateTimeOriginal", "EXIF:CreateDate"]
@@ -59,17 +226,244 @@ def generate_manifest_entry(image_path: pathlib.Path):
     # deduplicate
     keywords = list(set(keywords))
 
-    return ManifestEntry(
-        filename=f"{image_hash}{image_path.suffix}",
+    entry = ManifestEntry(
+        filename=f"{image_hash}{image_path.suffix.lower()}",
         created_date=created_date,
         keyword_tags=sorted(keywords),
     )
 
+    if "XMP:HierarchicalSubject" in image_tags:
+        subjects = image_tags["XMP:HierarchicalSubject"]
+        # exiftool only returns a list if the tag has more than one value
+        if isinstance(subjects, str):
+            subjects = [subjects]
+        entry["hierarchical_subjects"] = sorted(set(subjects))
+
+    if derivatives is not None:
+        entry["derivatives"] = [
+            DerivativeEntry(
+                filename=derivative.filename,
+                width=derivative.width,
+                height=derivative.height,
+                format=derivative.format,
+            )
+            for derivative in derivatives
+        ]
+
+    if preview is not None:
+        entry["perceptual_hash"] = preview.perceptual_hash
+        entry["width"] = preview.width
+        entry["height"] = preview.height
+        entry["placeholder"] = preview.placeholder
+
+    return entry
+
+
+def manifest_hash_engine(manifest: Manifest) -> HashEngine:
+    return manifest.get("hash_engine", "pixels")
+
+
+def manifest_perceptual_hashes(manifest: Manifest):
+    """
+    Returns the perceptual hash of every image in the manifest which has one,
+    by image hash.
+    """
+
+    return {
+        image_hash: entry["perceptual_hash"]
+        for image_hash, entry in manifest["images"].items()
+        if "perceptual_hash" in entry
+    }
+
+
+def manifest_previews(manifest: Manifest):
+    """
+    Returns the preview of every image in the manifest which has a complete
+    one, by image hash.
+    """
+
+    return {
+        image_hash: ImagePreview(
+            entry["width"],
+            entry["height"],
+            entry["perceptual_hash"],
+            entry["placeholder"],
+        )
+        for image_hash, entry in manifest["images"].items()
+        if all(field in entry for field in ImagePreview._fields)
+    }
+
+
+def manifest_derivatives(manifest: Manifest):
+    """
+    Returns the derivatives of every image in the manifest which has them, by
+    image hash. They have no local path, as they weren't rendered this run.
+    """
+
+    return {
+        image_hash: [
+            Derivative(
+                derivative["filename"],
+                None,
+                derivative["width"],
+                derivative["height"],
+                derivative["format"],
+            )
+            for derivative in entry["derivatives"]
+        ]
+        for image_hash, entry in manifest["images"].items()
+        if "derivatives" in entry
+    }
+
+
+def manifest_filenames(manifest: Manifest):
+    """
+    Returns every file in dest that the manifest refers to.
+    """
+
+    filenames = set()
+    for entry in manifest["images"].values():
+        filenames.add(entry["filename"])
+        filenames.update(
+            derivative["filename"] for derivative in entry.get("derivatives", [])
+        )
+
+    return filenames
+
+
+def diff_manifests(old_manifest: Manifest | None, new_manifest: Manifest):
+    """
+    Compares the image hashes of two manifests. old_manifest may be None if
+    there wasn't one before, in which case every image has been added.
+    """
+
+    old_hashes = set(old_manifest["images"] if old_manifest else ())
+    new_hashes = set(new_manifest["images"])
+
+    return ManifestDiff(
+        added=new_hashes - old_hashes,
+        removed=old_hashes - new_hashes,
+        unchanged=new_hashes & old_hashes,
+    )
+
+
+def _read_manifest_file(dest_fs: "DirFileSystem") -> Any:
+    try:
+        with dest_fs.open(MANIFEST_FILENAME, "rb") as file:
+            return loads(file.read())
+    except FileNotFoundError:
+        return None
+
+
+def _expand_manifest(dest_fs: "DirFileSystem", manifest) -> Manifest:
+    if manifest["version"] == SHARDED_MANIFEST_VERSION:
+        return read_sharded_manifest(dest_fs, manifest)
+    if manifest["version"] == COLUMNAR_MANIFEST_VERSION:
+        return from_columnar(manifest)
+
+    return manifest
+
+
+def read_manifest(dest_fs: "DirFileSystem") -> Manifest | None:
+    """
+    Reads the manifest from dest, or returns None if dest doesn't have one yet.
+    Sharded and columnar manifests are converted back into a single manifest of
+    image entries.
+    """
+
+    manifest = _read_manifest_file(dest_fs)
+    if not manifest:
+        return None
+
+    return _expand_manifest(dest_fs, manifest)
+
+
+def read_manifest_versioned(
+    dest_fs: "DirFileSystem",
+) -> tuple[Manifest | None, FileVersion | None]:
+    """
+    Reads the manifest from dest like read_manifest, along with the version of
+    it to pass to write_manifest.
+    """
+
+    contents, version = read_versioned(dest_fs, MANIFEST_FILENAME)
+    if contents is None:
+        return None, version
+
+    return _expand_manifest(dest_fs, loads(contents)), version
+
+
+def write_manifest(
+    dest_fs: "DirFileSystem",
+    manifest_contents: Manifest,
+    version: FileVersion | None = None,
+):
+    """
+    Writes the manifest to dest, in the format given by its version. If the
+    version read_manifest_versioned returned is given, it's only written if
+    dest's manifest hasn't been changed since, raising PreconditionFailedError
+    otherwise.
+    """
+
+    precompress = manifest_contents.get("precompressed", [])
+
+    if manifest_contents["version"] == SHARDED_MANIFEST_VERSION:
+        old_index = _read_manifest_file(dest_fs)
+        if old_index and old_index["version"] != SHARDED_MANIFEST_VERSION:
+            old_index = None
+
+        write_sharded_manifest(
+            dest_fs,
+            manifest_contents,
+            MANIFEST_FILENAME,
+            old_index,
+            precompress,
+            version,
+        )
+        return
+
+    if manifest_contents["version"] == COLUMNAR_MANIFEST_VERSION:
+        contents = dumps(to_columnar(manifest_contents))
+    else:
+        contents = dumps(manifest_contents)
+    write_encoded(
+        dest_fs,
+        {MANIFEST_FILENAME: contents},
+        precompress,
+        expected={MANIFEST_FILENAME: version} if version else None,
+    )
+
+    # clean up after a sharded manifest this one replaced
+    stale_shards = dest_fs.glob(f"{SHARD_PREFIX}*")
+    if stale_shards:
+        dest_fs.rm(stale_shards)
+
+    logging.info("Wrote manifest to `%s/%s`", dest_fs.path, MANIFEST_FILENAME)
+
+
+def update_manifest(
+    dest_fs: "DirFileSystem",
+    update: Callable[[Manifest | None], Manifest],
+    attempts: int = DEFAULT_COMMIT_ATTEMPTS,
+):
+    """
+    Read-modify-writes dest's manifest without losing changes made to it at the
+    same time by anything else. update is given the current manifest (None if
+    there isn't one yet) and returns the new one. If the manifest is changed
+    before the new one is written, update is applied again to the newer
+    manifest, so update must only depend on the manifest it is given.
+
+    Returns the new manifest, and the files only the replaced manifest referred
+    to, which can then be removed from dest.
+    """
+
+    def attempt():
+        manifest, version = read_manifest_versioned(dest_fs)
+        old_filenames = manifest_filenames(manifest) if manifest else set()
 
-def write_manifest(dest_fs: DirFileSystem, manifest_contents: Manifest):
-    manifest_filename = "manifest.json"
+        new_manifest = update(manifest)
+        write_manifest(dest_fs, new_manifest, version)
 
-    with dest_fs.open(manifest_filename, "w") as file:
-        json.dump(manifest_contents, file)
+        return new_manifest, old_filenames - manifest_filenames(new_manifest)
 
-    logging.info("Wrote manifest to `%s/%s`", dest_fs.path, manifest_filename)
+    return retry_on_conflict(attempt, attempts)
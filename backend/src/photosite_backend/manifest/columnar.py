@@ -0,0 +1,202 @@
+"""
+This file contains the columnar (v4) manifest layout, which stores each field
+of the images as its own array rather than an object per image, so keys aren't
+repeated for every image. Keywords are stored as ids into a shared list of
+tags, and filenames only as the suffix after the image's hash.
+
+Images are ordered oldest first, same as the manifest shards.
+"""
+
+from typing import TYPE_CHECKING, Any, NotRequired, TypedDict
+
+from photosite_backend.image.hashing import HashEngine
+from photosite_backend.manifest.encoding import Compression
+
+if TYPE_CHECKING:
+    from photosite_backend.manifest import Manifest, ManifestEntry
+
+COLUMNAR_MANIFEST_VERSION = 4
+
+
+class ImageColumns(TypedDict):
+    hash: list[str]
+    # filename is hash + suffix, unless any filename isn't of that form, in
+    # which case the whole filename is stored instead
+    suffix: NotRequired[list[str]]
+    filename: NotRequired[list[str]]
+    created_date: list[str | None]
+    # ids into tags
+    keyword_tags: list[list[int]]
+    # only present if any image has them, None for images which don't
+    hierarchical_subjects: NotRequired[list[list[int] | None]]
+    # [suffix, width, height, format], the suffix again following the hash
+    derivatives: NotRequired[list[list[list] | None]]
+    # each only present if any image has one
+    perceptual_hash: NotRequired[list[str | None]]
+    width: NotRequired[list[int | None]]
+    height: NotRequired[list[int | None]]
+    placeholder: NotRequired[list[str | None]]
+
+
+class ColumnarManifest(TypedDict):
+    version: int
+    hash_engine: NotRequired[HashEngine]
+    precompressed: NotRequired[list[Compression]]
+    tags: list[str]
+    images: ImageColumns
+
+
+def to_columnar(manifest: "Manifest") -> ColumnarManifest:
+    images = sorted(
+        manifest["images"].items(),
+        key=lambda item: (item[1]["created_date"] or "", item[0]),
+    )
+
+    tags = sorted(
+        {tag for _, entry in images for tag in entry["keyword_tags"]}
+        | {
+            subject
+            for _, entry in images
+            for subject in entry.get("hierarchical_subjects", [])
+        }
+    )
+    tag_ids = {tag: tag_id for tag_id, tag in enumerate(tags)}
+
+    columns = ImageColumns(
+        hash=[image_hash for image_hash, _ in images],
+        created_date=[entry["created_date"] for _, entry in images],
+        keyword_tags=[
+            [tag_ids[tag] for tag in entry["keyword_tags"]] for _, entry in images
+        ],
+    )
+
+    if all(entry["filename"].startswith(image_hash) for image_hash, entry in images):
+        columns["suffix"] = [
+            entry["filename"][len(image_hash) :] for image_hash, entry in images
+        ]
+    else:
+        columns["filename"] = [entry["filename"] for _, entry in images]
+
+    if any("hierarchical_subjects" in entry for _, entry in images):
+        columns["hierarchical_subjects"] = [
+            [tag_ids[subject] for subject in entry["hierarchical_subjects"]]
+            if "hierarchical_subjects" in entry
+            else None
+            for _, entry in images
+        ]
+
+    if any("derivatives" in entry for _, entry in images):
+        columns["derivatives"] = [
+            [
+                [
+                    derivative["filename"].removeprefix(image_hash),
+                    derivative["width"],
+                    derivative["height"],
+                    derivative["format"],
+                ]
+                for derivative in entry["derivatives"]
+            ]
+            if "derivatives" in entry
+            else None
+            for image_hash, entry in images
+        ]
+
+    # the optional fields are stored as is, in a column of None for images
+    # without them
+    perceptual_hashes = _optional_column(images, "perceptual_hash")
+    if perceptual_hashes is not None:
+        columns["perceptual_hash"] = perceptual_hashes
+    widths = _optional_column(images, "width")
+    if widths is not None:
+        columns["width"] = widths
+    heights = _optional_column(images, "height")
+    if heights is not None:
+        columns["height"] = heights
+    placeholders = _optional_column(images, "placeholder")
+    if placeholders is not None:
+        columns["placeholder"] = placeholders
+
+    columnar = ColumnarManifest(
+        version=COLUMNAR_MANIFEST_VERSION, tags=tags, images=columns
+    )
+    if "hash_engine" in manifest:
+        columnar["hash_engine"] = manifest["hash_engine"]
+    if "precompressed" in manifest:
+        columnar["precompressed"] = manifest["precompressed"]
+
+    return columnar
+
+
+def _optional_column(
+    images: list[tuple[str, "ManifestEntry"]], field: str
+) -> list[Any] | None:
+    """
+    The column of field, or None if no image has it.
+    """
+
+    if any(field in entry for _, entry in images):
+        return [entry.get(field) for _, entry in images]
+
+    return None
+
+
+def from_columnar(columnar: ColumnarManifest) -> "Manifest":
+    tags = columnar["tags"]
+    columns = columnar["images"]
+
+    missing = [None] * len(columns["hash"])
+    subjects_column = columns.get("hierarchical_subjects", missing)
+    derivatives_column = columns.get("derivatives", missing)
+    perceptual_hashes = columns.get("perceptual_hash", missing)
+    widths = columns.get("width", missing)
+    heights = columns.get("height", missing)
+    placeholders = columns.get("placeholder", missing)
+
+    images: dict[str, "ManifestEntry"] = {}
+    for row, image_hash in enumerate(columns["hash"]):
+        entry: "ManifestEntry" = {
+            "filename": image_hash + columns["suffix"][row]
+            if "suffix" in columns
+            else columns["filename"][row],
+            "created_date": columns["created_date"][row],
+            "keyword_tags": [tags[tag_id] for tag_id in columns["keyword_tags"][row]],
+        }
+
+        subjects = subjects_column[row]
+        if subjects is not None:
+            entry["hierarchical_subjects"] = [tags[tag_id] for tag_id in subjects]
+
+        derivatives = derivatives_column[row]
+        if derivatives is not None:
+            entry["derivatives"] = [
+                {
+                    "filename": image_hash + suffix,
+                    "width": width,
+                    "height": height,
+                    "format": derivative_format,
+                }
+                for suffix, width, height, derivative_format in derivatives
+            ]
+
+        perceptual_hash = perceptual_hashes[row]
+        if perceptual_hash is not None:
+            entry["perceptual_hash"] = perceptual_hash
+        width = widths[row]
+        if width is not None:
+            entry["width"] = width
+        height = heights[row]
+        if height is not None:
+            entry["height"] = height
+        placeholder = placeholders[row]
+        if placeholder is not None:
+            entry["placeholder"] = placeholder
+
+        images[image_hash] = entry
+
+    manifest: "Manifest" = {"version": columnar["version"], "images": images}
+    if "hash_engine" in columnar:
+        manifest["hash_engine"] = columnar["hash_engine"]
+    if "precompressed" in columnar:
+        manifest["precompressed"] = columnar["precompressed"]
+
+    return manifest
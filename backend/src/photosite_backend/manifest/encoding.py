@@ -0,0 +1,185 @@
+"""
+This file contains how the manifest files are serialised and compressed.
+
+JSON is encoded with orjson if it's installed, falling back to ujson. Both
+produce the same compact output.
+
+Files can also be uploaded alongside precompressed siblings (e.g.
+`manifest.json.br`) for servers and CDNs to serve as is. On s3 the siblings are
+uploaded with a Content-Encoding, so browsers transparently decompress them.
+brotli compression needs the brotli package to be installed.
+"""
+
+import gzip
+from typing import TYPE_CHECKING, Any, Iterable, Literal, get_args
+
+import ujson
+
+from photosite_backend.backends import is_local
+from photosite_backend.backends.conditional import (
+    FileVersion,
+    read_versioned,
+    write_conditional,
+)
+
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+Compression = Literal["gz", "br"]
+
+CONTENT_ENCODINGS: dict[Compression, str] = {
+    "gz": "gzip",
+    "br": "br",
+}
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(obj)
+
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode()
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson:
+        return orjson.loads(data)
+
+    return ujson.loads(data)
+
+
+def compression_available(compression: Compression):
+    return compression != "br" or brotli is not None
+
+
+def compress(data: bytes, compression: Compression) -> bytes:
+    if compression == "gz":
+        # a fixed mtime, so the same contents always compress the same
+        return gzip.compress(data, compresslevel=9, mtime=0)
+
+    if brotli is None:
+        raise RuntimeError("brotli compression needs the brotli package installed")
+
+    return brotli.compress(data, mode=brotli.MODE_TEXT, quality=11)
+
+
+def _upload_kwargs(dest_fs: "DirFileSystem", compression: Compression | None):
+    if is_local(dest_fs):
+        return {}
+
+    kwargs = dict(ContentType="application/json")
+    if compression:
+        kwargs["ContentEncoding"] = CONTENT_ENCODINGS[compression]
+
+    return kwargs
+
+
+def _write_siblings(
+    dest_fs: "DirFileSystem", files: dict[str, bytes], precompress: list[Compression]
+):
+    if not files:
+        return
+
+    # one batch per compression, as they are uploaded with different metadata.
+    # each batch is uploaded concurrently on async filesystems.
+    for compression in precompress:
+        dest_fs.pipe(
+            {
+                f"{filename}.{compression}": compress(contents, compression)
+                for filename, contents in files.items()
+            },
+            **_upload_kwargs(dest_fs, compression),
+        )
+
+
+def write_encoded(
+    dest_fs: "DirFileSystem",
+    files: dict[str, bytes],
+    precompress: Iterable[Compression] = (),
+    remove_stale: bool = True,
+    expected: dict[str, FileVersion] | None = None,
+):
+    """
+    Writes files (a dict of filename to contents) into dest, each along with
+    its precompressed siblings. Any siblings left behind from earlier writes
+    with other compressions are removed if remove_stale is set, so they can
+    never be served out of date.
+
+    Files in expected are written first, and only if they are still at the
+    version given, raising PreconditionFailedError before anything else is
+    written otherwise. Their siblings always end up compressed from the
+    committed file, even if another writer commits one in the meantime.
+    """
+
+    precompress = list(precompress)
+    expected = expected or {}
+
+    for filename, version in expected.items():
+        write_conditional(
+            dest_fs, filename, files[filename], version, **_upload_kwargs(dest_fs, None)
+        )
+
+    unconditional = {
+        filename: contents
+        for filename, contents in files.items()
+        if filename not in expected
+    }
+    if unconditional:
+        dest_fs.pipe(unconditional, **_upload_kwargs(dest_fs, None))
+    _write_siblings(dest_fs, files, precompress)
+
+    # another writer can commit between this commit and these siblings being
+    # written, and have its own siblings overwritten by these older ones. so
+    # they're compressed again from whatever has been committed since, until
+    # nothing has, and whichever writer writes them last leaves them matching
+    written = {filename: files[filename] for filename in expected if precompress}
+    while written:
+        committed = {
+            filename: read_versioned(dest_fs, filename)[0] for filename in written
+        }
+        written = {
+            filename: contents
+            for filename, contents in committed.items()
+            if contents is not None and contents != written[filename]
+        }
+        _write_siblings(dest_fs, written, precompress)
+
+    if remove_stale:
+        stale = [
+            f"{filename}.{compression}"
+            for filename in files
+            for compression in get_args(Compression)
+            if compression not in precompress
+        ]
+        stale = [filename for filename in stale if dest_fs.exists(filename)]
+        if stale:
+            dest_fs.rm(stale)
+
+
+def remove_encoded(dest_fs: "DirFileSystem", filenames: Iterable[str]):
+    """
+    Removes files from dest along with any precompressed siblings of them.
+    """
+
+    filenames = set(filenames)
+    siblings = {
+        f"{filename}.{compression}"
+        for filename in filenames
+        for compression in get_args(Compression)
+    }
+    existing = [
+        filename
+        for filename in sorted(filenames | siblings)
+        if filename in filenames or dest_fs.exists(filename)
+    ]
+    if existing:
+        dest_fs.rm(existing)
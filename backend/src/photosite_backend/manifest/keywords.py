@@ -0,0 +1,214 @@
+"""
+This file contains the keyword index, an inverted index from each keyword to
+the images tagged with it, written alongside the manifest so clients can find
+every image with a keyword without scanning the whole manifest.
+
+Images are referred to by compact integer ids, indexes into the list of image
+hashes. A full build assigns ids oldest first, so each keyword's (sorted) ids
+are in date order. Images added afterwards are given the next id, and removed
+images leave a None behind, so the ids of other images never change.
+
+Hierarchical subjects (e.g. `animal|cat|tabby` from XMP:HierarchicalSubject)
+are indexed under every level of the hierarchy, so `animal` includes every
+image tagged with any kind of animal. Each level records its parent and
+children, so clients can browse the hierarchy.
+"""
+
+import bisect
+import logging
+from typing import TYPE_CHECKING, Callable, Iterable, NotRequired, TypedDict
+
+from photosite_backend.backends.conditional import (
+    DEFAULT_COMMIT_ATTEMPTS,
+    read_versioned,
+    retry_on_conflict,
+)
+from photosite_backend.manifest.encoding import Compression, dumps, loads, write_encoded
+
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
+
+KEYWORD_INDEX_VERSION = 1
+KEYWORD_INDEX_FILENAME = "keywords.json"
+
+HIERARCHY_SEPARATOR = "|"
+
+
+class KeywordEntry(TypedDict):
+    count: int
+    # sorted
+    ids: list[int]
+    # only for levels of a hierarchical subject
+    parent: NotRequired[str]
+    children: NotRequired[list[str]]
+
+
+class KeywordIndex(TypedDict):
+    version: int
+    # image hash by id, None for images which have been removed
+    images: list[str | None]
+    keywords: dict[str, KeywordEntry]
+
+
+def _hierarchy_levels(subject: str):
+    """
+    Returns every level of a hierarchical subject, from the root down.
+    """
+
+    parts = subject.split(HIERARCHY_SEPARATOR)
+    return [HIERARCHY_SEPARATOR.join(parts[: depth + 1]) for depth in range(len(parts))]
+
+
+def _link_hierarchy(keywords: dict[str, KeywordEntry], levels: list[str]):
+    for parent, child in zip(levels, levels[1:]):
+        keywords[child]["parent"] = parent
+
+        children = keywords[parent].setdefault("children", [])
+        position = bisect.bisect_left(children, child)
+        if position == len(children) or children[position] != child:
+            children.insert(position, child)
+
+
+def _add_image(index: KeywordIndex, image_id: int, entry):
+    keywords = index["keywords"]
+    hierarchies = [
+        _hierarchy_levels(subject) for subject in entry.get("hierarchical_subjects", [])
+    ]
+
+    names = set(entry["keyword_tags"])
+    for levels in hierarchies:
+        names.update(levels)
+
+    for name in names:
+        keyword = keywords.setdefault(name, KeywordEntry(count=0, ids=[]))
+        # ids are almost always handed out in increasing order
+        if keyword["ids"] and keyword["ids"][-1] > image_id:
+            bisect.insort(keyword["ids"], image_id)
+        else:
+            keyword["ids"].append(image_id)
+        keyword["count"] += 1
+
+    for levels in hierarchies:
+        _link_hierarchy(keywords, levels)
+
+
+def build_keyword_index(manifest):
+    """
+    Builds the keyword index of every image in the manifest.
+    """
+
+    # oldest first, same as the manifest shards
+    images = sorted(
+        manifest["images"].items(),
+        key=lambda item: (item[1]["created_date"] or "", item[0]),
+    )
+
+    index = KeywordIndex(
+        version=KEYWORD_INDEX_VERSION,
+        images=[image_hash for image_hash, _ in images],
+        keywords={},
+    )
+    for image_id, (_, entry) in enumerate(images):
+        _add_image(index, image_id, entry)
+
+    return index
+
+
+def add_to_keyword_index(index: KeywordIndex, image_hash: str, entry):
+    """
+    Adds an image to the index in place, replacing it if it's already there.
+    """
+
+    remove_from_keyword_index(index, image_hash)
+
+    index["images"].append(image_hash)
+    _add_image(index, len(index["images"]) - 1, entry)
+
+
+def remove_from_keyword_index(index: KeywordIndex, image_hash: str):
+    """
+    Removes an image from the index in place, if it's there.
+    """
+
+    try:
+        image_id = index["images"].index(image_hash)
+    except ValueError:
+        return
+
+    index["images"][image_id] = None
+
+    keywords = index["keywords"]
+    emptied = []
+    for name, keyword in keywords.items():
+        ids = keyword["ids"]
+        position = bisect.bisect_left(ids, image_id)
+        if position < len(ids) and ids[position] == image_id:
+            del ids[position]
+            keyword["count"] -= 1
+            if not ids:
+                emptied.append(name)
+
+    for name in emptied:
+        parent = keywords.pop(name).get("parent")
+        if parent is not None and parent in keywords:
+            keywords[parent]["children"].remove(name)
+            if not keywords[parent]["children"]:
+                del keywords[parent]["children"]
+
+
+def read_keyword_index(dest_fs: "DirFileSystem"):
+    """
+    Reads the keyword index from dest, or returns None if dest doesn't have one.
+    """
+
+    try:
+        with dest_fs.open(KEYWORD_INDEX_FILENAME, "rb") as file:
+            index: KeywordIndex = loads(file.read())
+    except FileNotFoundError:
+        return None
+
+    return index
+
+
+def write_keyword_index(
+    dest_fs: "DirFileSystem",
+    index: KeywordIndex,
+    precompress: Iterable[Compression] = (),
+):
+    write_encoded(dest_fs, {KEYWORD_INDEX_FILENAME: dumps(index)}, precompress)
+
+    logging.info("Wrote keyword index to `%s/%s`", dest_fs.path, KEYWORD_INDEX_FILENAME)
+
+
+def update_keyword_index(
+    dest_fs: "DirFileSystem",
+    update: Callable[[KeywordIndex], None],
+    precompress: Iterable[Compression] = (),
+    attempts: int = DEFAULT_COMMIT_ATTEMPTS,
+):
+    """
+    Read-modify-writes dest's keyword index, if it has one, without losing
+    changes made to it at the same time by anything else. update changes the
+    index it is given in place, and is applied again to the newer index if the
+    index is changed before it's written.
+
+    Returns the new index, or None if dest doesn't have one.
+    """
+
+    def attempt():
+        contents, version = read_versioned(dest_fs, KEYWORD_INDEX_FILENAME)
+        if contents is None:
+            return None
+
+        index: KeywordIndex = loads(contents)
+        update(index)
+        write_encoded(
+            dest_fs,
+            {KEYWORD_INDEX_FILENAME: dumps(index)},
+            precompress,
+            expected={KEYWORD_INDEX_FILENAME: version},
+        )
+
+        return index
+
+    return retry_on_conflict(attempt, attempts)
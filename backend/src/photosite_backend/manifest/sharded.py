@@ -0,0 +1,233 @@
+"""
+This file contains the sharded (v3) manifest format, for galleries too large to
+fetch as a single file before showing anything.
+
+manifest.json becomes a small index listing the shards, each holding up to
+shard_size images sorted by created_date, oldest first. Appending newer images
+therefore only changes the last shard, which is also the first one the frontend
+fetches. Optionally there is also a shard per keyword, holding every image
+tagged with it.
+
+Shards are named after a hash of their contents, so an unchanged shard is never
+rewritten and a cached copy of one is never stale.
+"""
+
+import hashlib
+import logging
+from typing import TYPE_CHECKING, Iterable, NotRequired, TypedDict
+
+from photosite_backend.backends.conditional import FileVersion
+from photosite_backend.image.hashing import HashEngine
+from photosite_backend.manifest.encoding import (
+    Compression,
+    dumps,
+    loads,
+    remove_encoded,
+    write_encoded,
+)
+
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
+
+    from photosite_backend.manifest import Manifest
+
+SHARDED_MANIFEST_VERSION = 3
+DEFAULT_SHARD_SIZE = 500
+SHARD_PREFIX = "manifest-"
+
+
+class ShardOptions(TypedDict):
+    shard_size: int
+    keyword_shards: bool
+
+
+class ShardEntry(TypedDict):
+    filename: str
+    count: int
+    # the range of created_dates in the shard, None if no image in it has one
+    first_date: str | None
+    last_date: str | None
+
+
+class KeywordShardEntry(TypedDict):
+    filename: str
+    count: int
+
+
+class ManifestIndex(TypedDict):
+    version: int
+    hash_engine: NotRequired[HashEngine]
+    sharding: ShardOptions
+    image_count: int
+    # oldest first
+    shards: list[ShardEntry]
+    keywords: NotRequired[dict[str, KeywordShardEntry]]
+    # the compressed siblings each file has, if any
+    precompressed: NotRequired[list[Compression]]
+
+
+def _sort_key(item):
+    image_hash, entry = item
+    # undated images sort before everything else, same as the frontend
+    return entry["created_date"] or "", image_hash
+
+
+def _encode_shard(images: dict):
+    contents = dumps({"images": images})
+    digest = hashlib.sha256(contents).hexdigest()[:16]
+
+    return f"{SHARD_PREFIX}{digest}.json", contents
+
+
+def build_shards(
+    manifest, sharding: ShardOptions, precompress: Iterable[Compression] = ()
+):
+    """
+    Splits a manifest into its index and shards. Returns the index, and a dict
+    of shard filename to encoded contents.
+    """
+
+    images = sorted(manifest["images"].items(), key=_sort_key)
+    shard_size = sharding["shard_size"]
+
+    shard_files: dict[str, bytes] = {}
+    shards = []
+    for start in range(0, len(images), shard_size):
+        page = images[start : start + shard_size]
+        filename, contents = _encode_shard(dict(page))
+        shard_files[filename] = contents
+
+        dates = [entry["created_date"] for _, entry in page if entry["created_date"]]
+        shards.append(
+            ShardEntry(
+                filename=filename,
+                count=len(page),
+                first_date=min(dates, default=None),
+                last_date=max(dates, default=None),
+            )
+        )
+
+    index = ManifestIndex(
+        version=SHARDED_MANIFEST_VERSION,
+        sharding=sharding,
+        image_count=len(images),
+        shards=shards,
+    )
+    if "hash_engine" in manifest:
+        index["hash_engine"] = manifest["hash_engine"]
+    if precompress:
+        index["precompressed"] = list(precompress)
+
+    if sharding["keyword_shards"]:
+        keyword_images: dict[str, dict] = {}
+        for image_hash, entry in images:
+            for keyword in entry["keyword_tags"]:
+                keyword_images.setdefault(keyword, {})[image_hash] = entry
+
+        index["keywords"] = {}
+        for keyword in sorted(keyword_images):
+            filename, contents = _encode_shard(keyword_images[keyword])
+            shard_files[filename] = contents
+            index["keywords"][keyword] = KeywordShardEntry(
+                filename=filename, count=len(keyword_images[keyword])
+            )
+
+    return index, shard_files
+
+
+def index_filenames(index: ManifestIndex):
+    """
+    Returns every shard file the index refers to.
+    """
+
+    filenames = {shard["filename"] for shard in index["shards"]}
+    filenames.update(shard["filename"] for shard in index.get("keywords", {}).values())
+
+    return filenames
+
+
+def read_sharded_manifest(dest_fs: "DirFileSystem", index: ManifestIndex) -> "Manifest":
+    """
+    Fetches every date shard the index refers to, and reassembles them into a
+    single manifest.
+    """
+
+    filenames = [shard["filename"] for shard in index["shards"]]
+    # fetches the shards concurrently on async filesystems
+    shard_contents = dest_fs.cat(filenames) if filenames else {}
+
+    images = {}
+    for filename in filenames:
+        images.update(loads(shard_contents[filename])["images"])
+
+    manifest: "Manifest" = {
+        "version": index["version"],
+        "sharding": index["sharding"],
+        "images": images,
+    }
+    if "hash_engine" in index:
+        manifest["hash_engine"] = index["hash_engine"]
+    if "precompressed" in index:
+        manifest["precompressed"] = index["precompressed"]
+
+    return manifest
+
+
+def write_sharded_manifest(
+    dest_fs: "DirFileSystem",
+    manifest,
+    manifest_filename: str,
+    old_index: ManifestIndex | None,
+    precompress: Iterable[Compression] = (),
+    version: FileVersion | None = None,
+):
+    """
+    Writes the manifest's shards and then its index, so the index never refers
+    to a shard which doesn't exist yet. Shards already referred to by old_index
+    aren't rewritten, and any it referred to that are no longer needed are
+    removed once the new index is in place.
+
+    Every file is written along with the precompress siblings of it. If
+    version is given, the index is only written if it's still at that version.
+    """
+
+    sharding = manifest.get("sharding") or ShardOptions(
+        shard_size=DEFAULT_SHARD_SIZE, keyword_shards=False
+    )
+    precompress = list(precompress)
+    index, shard_files = build_shards(manifest, sharding, precompress)
+
+    old_filenames = index_filenames(old_index) if old_index else set()
+    # every shard needs rewriting if its compressed siblings have changed
+    compression_changed = (
+        old_index is not None and old_index.get("precompressed", []) != precompress
+    )
+
+    new_shards = {
+        filename: contents
+        for filename, contents in shard_files.items()
+        if compression_changed or filename not in old_filenames
+    }
+    if new_shards:
+        write_encoded(
+            dest_fs, new_shards, precompress, remove_stale=compression_changed
+        )
+
+    write_encoded(
+        dest_fs,
+        {manifest_filename: dumps(index)},
+        precompress,
+        expected={manifest_filename: version} if version else None,
+    )
+
+    stale_shards = old_filenames - set(shard_files)
+    if stale_shards:
+        remove_encoded(dest_fs, stale_shards)
+
+    logging.info(
+        "Wrote manifest index and %d of %d shards to `%s`, removed %d stale shards",
+        len(new_shards),
+        len(shard_files),
+        dest_fs.path,
+        len(stale_shards),
+    )
@@ -0,0 +1,155 @@
+"""
+This file contains the run metrics, how long each phase of a command took and
+counters of the work done, e.g. files hashed, exiftool calls or s3 requests.
+
+They are always recorded, as doing so is cheap, and can be written out at the
+end of a run with `--metrics-json`.
+
+Phase times are summed across threads, so a phase run on several threads at
+once (e.g. upload) can add up to more than the run's wall time. Work done in
+worker processes is only counted by the process which handed it out.
+"""
+
+import cProfile
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TypedDict
+
+METRICS_VERSION = 1
+
+# how many functions to log when profiling, slowest (cumulatively) first
+PROFILE_TOP_FUNCTIONS = 30
+
+
+class PhaseSummary(TypedDict):
+    seconds: float
+    # how many times the phase was entered
+    count: int
+
+
+class MetricsSummary(TypedDict):
+    version: int
+    command: str | None
+    started_at: str
+    seconds: float
+    phases: dict[str, PhaseSummary]
+    counters: dict[str, int]
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.perf_counter()
+
+        self.phase_seconds: dict[str, float] = defaultdict(float)
+        self.phase_counts: dict[str, int] = defaultdict(int)
+        self.counters: dict[str, int] = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phase_seconds[name] += elapsed
+                self.phase_counts[name] += 1
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def summary(self, command: str | None = None):
+        with self._lock:
+            return MetricsSummary(
+                version=METRICS_VERSION,
+                command=command,
+                started_at=self.started_at.isoformat(),
+                seconds=time.perf_counter() - self._started,
+                phases={
+                    name: PhaseSummary(
+                        seconds=self.phase_seconds[name],
+                        count=self.phase_counts[name],
+                    )
+                    for name in sorted(self.phase_seconds)
+                },
+                counters=dict(sorted(self.counters.items())),
+            )
+
+
+# the metrics of the current run
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def reset_metrics():
+    global _metrics
+
+    _metrics = Metrics()
+    return _metrics
+
+
+def phase(name: str):
+    """
+    Times the block as part of the named phase.
+    """
+
+    return _metrics.phase(name)
+
+
+def count(name: str, amount: int = 1):
+    _metrics.count(name, amount)
+
+
+def log_summary(summary: MetricsSummary):
+    logging.info("Finished in %.2fs", summary["seconds"])
+    for name, phase_summary in summary["phases"].items():
+        logging.info(
+            "  %-24s %9.3fs %7dx",
+            name,
+            phase_summary["seconds"],
+            phase_summary["count"],
+        )
+    for name, value in summary["counters"].items():
+        logging.info("  %-24s %10d", name, value)
+
+
+def write_summary(path: Path, summary: MetricsSummary):
+    path.write_text(json.dumps(summary, indent=2))
+    logging.info("Wrote run metrics to `%s`", path)
+
+
+@contextmanager
+def profile(path: Path):
+    """
+    Profiles the block with cProfile, which only sees the thread it's started
+    on. The stats are written to path for pstats or snakeviz, and the slowest
+    functions are logged.
+    """
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_FUNCTIONS)
+        logging.info("%s", stream.getvalue())
+        logging.info("Wrote profile to `%s`", path)
@@ -0,0 +1,100 @@
+import os
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from photosite_backend.image import hash_image, set_hash_cache
+from photosite_backend.image.cache import HashCache
+from photosite_backend.tests import create_test_datafile
+
+PHOTO_1_HASH = "f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24"
+
+
+@pytest.fixture
+def hash_cache(tmp_path: Path):
+    hash_cache = HashCache(tmp_path / "cache")
+    set_hash_cache(hash_cache)
+
+    yield hash_cache
+
+    set_hash_cache(None)
+    hash_cache.close()
+
+
+class TestHashCache:
+    def test_miss(self, tmp_path: Path, hash_cache: HashCache):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+
+        assert hash_cache.get(image_path) is None
+
+    def test_hit(self, tmp_path: Path, hash_cache: HashCache):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+
+        hash_cache.set(image_path, "asdf", image_path.stat())
+
+        assert hash_cache.get(image_path) == "asdf"
+
+    def test_modified_file_is_invalidated(self, tmp_path: Path, hash_cache: HashCache):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        stat = image_path.stat()
+        hash_cache.set(image_path, "asdf", stat)
+
+        os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+        assert hash_cache.get(image_path) is None
+
+    def test_engines_cached_separately(self, tmp_path: Path, hash_cache: HashCache):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+
+        hash_cache.set(image_path, "asdf", image_path.stat(), "pixels")
+
+        assert hash_cache.get(image_path, engine="scan") is None
+
+    def test_persists_between_instances(self, tmp_path: Path):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+
+        first = HashCache(tmp_path / "cache")
+        first.set(image_path, "asdf", image_path.stat())
+        first.close()
+
+        second = HashCache(tmp_path / "cache")
+        assert second.get(image_path) == "asdf"
+        second.close()
+
+    def test_prune(self, tmp_path: Path, hash_cache: HashCache):
+        kept = create_test_datafile(tmp_path, "photo_1.jpg")
+        removed = create_test_datafile(tmp_path, "photo_2.jpg")
+        hash_cache.set(kept, "asdf", kept.stat())
+        hash_cache.set(removed, "hjkl", removed.stat())
+
+        removed.unlink()
+
+        assert hash_cache.prune() == 1
+        assert hash_cache.stats().entries == 1
+        assert hash_cache.get(kept) == "asdf"
+
+    def test_clear(self, tmp_path: Path, hash_cache: HashCache):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        hash_cache.set(image_path, "asdf", image_path.stat())
+
+        hash_cache.clear()
+
+        assert hash_cache.stats().entries == 0
+
+
+class TestHashImageWithCache:
+    def test_populates_cache(self, tmp_path: Path, hash_cache: HashCache):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+
+        assert hash_image(image_path) == PHOTO_1_HASH
+        assert hash_cache.get(image_path) == PHOTO_1_HASH
+
+    def test_cached_hash_skips_decoding(self, tmp_path: Path, hash_cache: HashCache):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        hash_cache.set(image_path, "asdf", image_path.stat())
+
+        with mock.patch("PIL.Image.open") as image_open:
+            assert hash_image(image_path) == "asdf"
+
+        image_open.assert_not_called()
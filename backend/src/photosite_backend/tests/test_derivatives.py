@@ -0,0 +1,134 @@
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image
+
+from photosite_backend.image.derivatives import (
+    DerivativeSpec,
+    derivative_filename,
+    derivative_specs,
+    render_all_derivatives,
+    render_derivatives,
+)
+from photosite_backend.tests import create_test_datafile
+
+PHOTO_1_HASH = "f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24"
+
+
+class TestDerivativeSpecs:
+    def test_sorted_and_deduplicated(self):
+        assert derivative_specs([1200, 400, 1200], ["webp", "avif", "webp"]) == [
+            DerivativeSpec(400, "webp"),
+            DerivativeSpec(400, "avif"),
+            DerivativeSpec(1200, "webp"),
+            DerivativeSpec(1200, "avif"),
+        ]
+
+    def test_filename(self):
+        assert (
+            derivative_filename(PHOTO_1_HASH, DerivativeSpec(400, "webp"))
+            == f"{PHOTO_1_HASH}_400w_q80.webp"
+        )
+
+
+class TestRenderDerivatives:
+    def test_renders_widths(self, tmp_path: Path):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        specs = derivative_specs([400, 1200], ["webp"])
+
+        derivatives = render_derivatives(
+            image_path, PHOTO_1_HASH, specs, tmp_path / "out"
+        )
+
+        assert [(d.width, d.height, d.format) for d in derivatives] == [
+            (400, 300, "webp"),
+            (1200, 900, "webp"),
+        ]
+        for derivative in derivatives:
+            assert derivative.path.parent == tmp_path / "out"
+            with Image.open(derivative.path) as img:
+                assert img.format == "WEBP"
+                assert img.size == (derivative.width, derivative.height)
+
+    def test_never_upscales(self, tmp_path: Path):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        specs = derivative_specs([400, 2000, 4000], ["jpeg"])
+
+        derivatives = render_derivatives(
+            image_path, PHOTO_1_HASH, specs, tmp_path / "out"
+        )
+
+        assert [d.width for d in derivatives] == [400]
+
+    def test_rendered_derivatives_are_reused(self, tmp_path: Path):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        specs = derivative_specs([400], ["webp"])
+
+        first = render_derivatives(image_path, PHOTO_1_HASH, specs, tmp_path / "out")
+        with mock.patch("photosite_backend.image.derivatives._render") as render:
+            second = render_derivatives(
+                image_path, PHOTO_1_HASH, specs, tmp_path / "out"
+            )
+
+        render.assert_not_called()
+        assert first == second
+
+    def test_same_hash_rendered_at_once(self, tmp_path: Path):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        (tmp_path / "copy").mkdir()
+        copy_path = create_test_datafile(tmp_path / "copy", "photo_1.jpg")
+        specs = derivative_specs([400], ["webp"])
+        replace = Path.replace
+        renders = []
+
+        def render_copy_meanwhile(path: Path, target: Path):
+            # another worker renders an image with the same pixels (so hash)
+            # before this render is moved into place
+            if not renders:
+                renders.append(copy_path)
+                render_derivatives(copy_path, PHOTO_1_HASH, specs, tmp_path / "out")
+            return replace(path, target)
+
+        with mock.patch.object(Path, "replace", render_copy_meanwhile):
+            derivatives = render_derivatives(
+                image_path, PHOTO_1_HASH, specs, tmp_path / "out"
+            )
+
+        assert [path.name for path in (tmp_path / "out").iterdir()] == [
+            derivatives[0].filename
+        ]
+
+    def test_in_dest_not_rendered(self, tmp_path: Path):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        specs = derivative_specs([400, 1200], ["webp"])
+        rendered = render_derivatives(
+            image_path, PHOTO_1_HASH, specs, tmp_path / "rendered"
+        )
+        published = [rendered[0]._replace(path=None)]
+        in_dest = {derivative.filename for derivative in rendered}
+
+        with mock.patch("photosite_backend.image.derivatives._render") as render:
+            derivatives = render_derivatives(
+                image_path, PHOTO_1_HASH, specs, tmp_path / "out", in_dest, published
+            )
+
+        render.assert_not_called()
+        # the one not published is sized from the image's header
+        assert derivatives == [
+            derivative._replace(path=None) for derivative in rendered
+        ]
+
+    def test_render_all(self, tmp_path: Path):
+        images = [
+            (create_test_datafile(tmp_path, "photo_1.jpg"), "hash_1"),
+            (create_test_datafile(tmp_path, "photo_2.jpg"), "hash_2"),
+        ]
+        specs = derivative_specs([400], ["webp"])
+
+        rendered = dict(render_all_derivatives(images, specs, tmp_path / "out", 2))
+
+        assert sorted(rendered) == sorted(path for path, _ in images)
+        assert sorted(path.name for path in (tmp_path / "out").iterdir()) == [
+            "hash_1_400w_q80.webp",
+            "hash_2_400w_q80.webp",
+        ]
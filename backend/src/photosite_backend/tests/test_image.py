@@ -1,31 +1,107 @@
+import os
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterable
+from unittest import mock
+
+import pytest
+from exiftool.exceptions import ExifToolExecuteError
+from fsspec.implementations.dirfs import DirFileSystem
+from fsspec.implementations.memory import MemoryFileSystem
 
 from photosite_backend.backends import get_fs
 from photosite_backend.image import (
-    ALLOWED_EXTENSIONS,
     PERMANENT_TAGS,
+    TRANSFER_CHUNK_SIZE,
     get_exiftool,
-    get_images,
     hash_image,
+    hash_images,
     read_tags,
+    read_tags_bulk,
+    transfer_file,
     write_image,
 )
+from photosite_backend.image.exiftool_pool import ExifToolPool
+from photosite_backend.image.preview import hash_and_preview
+from photosite_backend.image.scan import (
+    ALLOWED_EXTENSIONS,
+    ScannedImage,
+    ScanOptions,
+    get_images,
+    stat_image,
+)
 from photosite_backend.tests import create_test_datafile
 
 
+def scanned_paths(images: Iterable[ScannedImage]):
+    return {image.path for image in images}
+
+
+def scanned(paths: list[Path]):
+    return [ScannedImage(path, path.stat()) for path in paths]
+
+
 class TestGetImages:
     def test_get_images_empty_dir(self, tmp_path: Path):
-        assert get_images(tmp_path) == set()
+        assert scanned_paths(get_images(tmp_path)) == set()
 
     def test_get_images_wrong_type(self, tmp_path: Path):
         file = tmp_path / "somefile.txt"
         file.touch()
-        assert get_images(tmp_path) == set()
+        assert scanned_paths(get_images(tmp_path)) == set()
 
     def test_get_images_correct_type(self, tmp_path: Path):
         images = {tmp_path / f"somefile{ext}" for ext in ALLOWED_EXTENSIONS}
         [file.touch() for file in images]
-        assert get_images(tmp_path) == images
+        assert scanned_paths(get_images(tmp_path)) == images
+
+    def test_get_images_recursive(self, tmp_path: Path):
+        images = {
+            tmp_path / "top.JPG",
+            tmp_path / "2020" / "01" / "a.jpeg",
+            tmp_path / "2020" / "02" / "b.Jpg",
+            tmp_path / "2021" / "c.jpg",
+        }
+        for image in images:
+            image.parent.mkdir(parents=True, exist_ok=True)
+            image.touch()
+        (tmp_path / "2021" / "notes.txt").touch()
+        (tmp_path / "empty").mkdir()
+
+        assert scanned_paths(get_images(tmp_path, threads=2)) == images
+
+    def test_get_images_globs(self, tmp_path: Path):
+        for name in [
+            "2020/a.jpg",
+            "2020/private/b.jpg",
+            "2020/c_edit.jpg",
+            "2021/d.jpg",
+        ]:
+            (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / name).touch()
+
+        options = ScanOptions(include=("2020/*",), exclude=("*/private", "*_edit.*"))
+        assert scanned_paths(get_images(tmp_path, options)) == {tmp_path / "2020/a.jpg"}
+
+    def test_get_images_stat(self, tmp_path: Path):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+
+        assert list(get_images(tmp_path)) == [(image_path, image_path.stat())]
+
+    def test_stat_image(self, tmp_path: Path):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        (tmp_path / "dir.jpg").mkdir()
+
+        assert stat_image(image_path) == (image_path, image_path.stat())
+        assert stat_image(tmp_path / "dir.jpg") is None
+        assert stat_image(tmp_path / "missing.jpg") is None
+
+    def test_get_images_missing_dir(self, tmp_path: Path):
+        with pytest.raises(FileNotFoundError):
+            list(get_images(tmp_path / "missing"))
 
 
 class TestHashImage:
@@ -73,6 +149,103 @@ class TestHashImage:
             assert hash_image(path_one) != hash_image(path_two)
 
 
+class TestHashImages:
+    def test_matches_hash_image(self, tmp_path: Path):
+        paths = [create_test_datafile(tmp_path, f"photo_{i}.jpg") for i in range(1, 4)]
+
+        assert dict(hash_images(scanned(paths), jobs=2)) == {
+            path: hash_image(path) for path in paths
+        }
+
+    def test_serial(self, tmp_path: Path):
+        paths = [create_test_datafile(tmp_path, "photo_1.jpg")]
+
+        assert dict(hash_images(scanned(paths))) == {
+            path: hash_image(path) for path in paths
+        }
+
+    @mock.patch("photosite_backend.image.HASH_QUEUE_PER_JOB", 1)
+    def test_streams_images(self, tmp_path: Path):
+        paths = [create_test_datafile(tmp_path, f"photo_{i}.jpg") for i in range(1, 4)]
+        taken = []
+
+        def scan():
+            for image in scanned(paths):
+                taken.append(image)
+                yield image
+
+        results = hash_images(scan(), jobs=2)
+        next(results)
+        # hashing got started before the scan finished
+        assert len(taken) < len(paths)
+        assert len(list(results)) == len(paths) - 1
+
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_previews(self, tmp_path: Path, jobs):
+        paths = [create_test_datafile(tmp_path, f"photo_{i}.jpg") for i in (1, 2)]
+
+        previews = {}
+        image_hashes = dict(hash_images(scanned(paths), jobs, previews=previews))
+
+        assert previews.keys() == set(image_hashes.values())
+        for path, image_hash in image_hashes.items():
+            assert previews[image_hash] == hash_and_preview(path)[1]
+
+    def test_no_previews_without_decoding(self, tmp_path: Path):
+        paths = [create_test_datafile(tmp_path, "photo_1.jpg")]
+
+        previews = {}
+        list(hash_images(scanned(paths), engine="scan", previews=previews))
+
+        assert previews == {}
+
+
+def insert_comment(image_path: Path, comment: bytes):
+    # adds a COM segment straight after SOI, as a stand in for a metadata edit
+    data = image_path.read_bytes()
+    segment = b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment
+    image_path.write_bytes(data[:2] + segment + data[2:])
+
+
+class TestHashEngines:
+    @pytest.mark.parametrize("engine", ["pixels", "scan"])
+    def test_ignores_metadata(self, tmp_path: Path, engine):
+        orig = create_test_datafile(tmp_path, "photo_1.jpg")
+        commented = tmp_path / "commented.jpg"
+        commented.write_bytes(orig.read_bytes())
+        insert_comment(commented, b"hello")
+
+        assert hash_image(commented, engine) == hash_image(orig, engine)
+
+    def test_scan_hash(self, tmp_path: Path):
+        image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+
+        assert (
+            hash_image(image_path, "scan")
+            == "4966bed46fcd8a0067bf99cb3bde57426034940f1a71aa2030be787e51e58e6a"
+        )
+
+    def test_scan_hashes_are_different(self, tmp_path: Path):
+        path_one = create_test_datafile(tmp_path, "photo_1.jpg")
+        path_two = create_test_datafile(tmp_path, "photo_2.jpg")
+
+        assert hash_image(path_one, "scan") != hash_image(path_two, "scan")
+
+    def test_scan_not_a_jpeg(self, tmp_path: Path):
+        image_path = tmp_path / "not_a.jpg"
+        image_path.write_bytes(b"definitely not a jpeg")
+
+        with pytest.raises(ValueError):
+            hash_image(image_path, "scan")
+
+    def test_hash_images_engine(self, tmp_path: Path):
+        paths = [create_test_datafile(tmp_path, f"photo_{i}.jpg") for i in range(1, 4)]
+
+        assert dict(hash_images(scanned(paths), jobs=2, engine="scan")) == {
+            path: hash_image(path, "scan") for path in paths
+        }
+
+
 def test_clear_exif_tags(tmp_path):
     with (
         create_test_datafile(tmp_path, "photo_1.jpg").open("rb") as file,
@@ -106,6 +279,162 @@ def test_set_exif_tags(tmp_path):
         assert set(read_tags(cleaned).keys()) == PERMANENT_TAGS | new_tags.keys()
 
 
+class TestReadTagsBulk:
+    def test_chunks(self):
+        paths = [Path(f"photo_{i}.jpg") for i in range(5)]
+        exiftool = mock.Mock()
+        exiftool.get_metadata.side_effect = lambda files: [
+            {"SourceFile": file} for file in files
+        ]
+
+        with mock.patch("photosite_backend.image.get_exiftool", return_value=exiftool):
+            tags = read_tags_bulk(paths, chunk_size=2)
+
+        assert exiftool.get_metadata.call_count == 3
+        assert tags == {path: {"SourceFile": str(path)} for path in paths}
+
+    def test_falls_back_to_individual_files(self):
+        paths = [Path("good.jpg"), Path("bad.jpg")]
+
+        def get_metadata(files):
+            files = [files] if isinstance(files, str) else files
+            if "bad.jpg" in files:
+                if len(files) > 1:
+                    raise ExifToolExecuteError(1, "", "", [])
+                return [{"SourceFile": "bad.jpg", "ExifTool:Error": "bad"}]
+            return [{"SourceFile": file} for file in files]
+
+        exiftool = mock.Mock()
+        exiftool.get_metadata.side_effect = get_metadata
+
+        with mock.patch("photosite_backend.image.get_exiftool", return_value=exiftool):
+            tags = read_tags_bulk(paths)
+
+        assert tags[Path("good.jpg")] == {"SourceFile": "good.jpg"}
+        assert tags[Path("bad.jpg")]["ExifTool:Error"] == "bad"
+
+    def test_chunks_in_parallel(self):
+        paths = [Path(f"photo_{i}.jpg") for i in range(7)]
+        exiftool = mock.Mock()
+
+        def get_metadata(files):
+            # later chunks finish first
+            time.sleep(0.01 * (7 - len(files) - int(files[0][6])))
+            return [{"SourceFile": file} for file in files]
+
+        exiftool.get_metadata.side_effect = get_metadata
+
+        with (
+            mock.patch("photosite_backend.image.get_exiftool", return_value=exiftool),
+            mock.patch("photosite_backend.image._exiftool_processes", 3),
+        ):
+            tags = read_tags_bulk(paths, chunk_size=2)
+
+        assert exiftool.get_metadata.call_count == 4
+        assert tags == {path: {"SourceFile": str(path)} for path in paths}
+
+
+class TestExifToolPool:
+    def fake_exiftool(self):
+        exiftool = mock.Mock()
+        exiftool.running = True
+        exiftool.get_metadata.side_effect = lambda files: [{"SourceFile": files}]
+        return exiftool
+
+    def test_reuses_processes(self):
+        factory = mock.Mock(side_effect=self.fake_exiftool)
+        pool = ExifToolPool(factory, 2)
+
+        for _ in range(3):
+            assert pool.get_metadata("photo.jpg") == [{"SourceFile": "photo.jpg"}]
+
+        assert factory.call_count == 1
+
+    def test_limits_processes(self):
+        in_use = 0
+        most_in_use = 0
+        lock = threading.Lock()
+
+        def get_metadata(files):
+            nonlocal in_use, most_in_use
+            with lock:
+                in_use += 1
+                most_in_use = max(most_in_use, in_use)
+            time.sleep(0.02)
+            with lock:
+                in_use -= 1
+            return [{"SourceFile": files}]
+
+        def factory():
+            exiftool = self.fake_exiftool()
+            exiftool.get_metadata.side_effect = get_metadata
+            return exiftool
+
+        factory = mock.Mock(side_effect=factory)
+        pool = ExifToolPool(factory, 2)
+
+        threads = [
+            threading.Thread(target=pool.get_metadata, args=("photo.jpg",))
+            for _ in range(6)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert most_in_use == 2
+        assert factory.call_count == 2
+
+    def test_keeps_process_after_file_error(self):
+        exiftool = self.fake_exiftool()
+        exiftool.get_metadata.side_effect = ExifToolExecuteError(1, "", "", [])
+        factory = mock.Mock(return_value=exiftool)
+        pool = ExifToolPool(factory, 1)
+
+        for _ in range(2):
+            with pytest.raises(ExifToolExecuteError):
+                pool.get_metadata("bad.jpg")
+
+        assert factory.call_count == 1
+        exiftool.terminate.assert_not_called()
+
+    def test_replaces_crashed_process(self):
+        crashed = self.fake_exiftool()
+        crashed.get_metadata.side_effect = BrokenPipeError()
+        replacement = self.fake_exiftool()
+        pool = ExifToolPool(mock.Mock(side_effect=[crashed, replacement]), 1)
+
+        with pytest.raises(BrokenPipeError):
+            pool.get_metadata("photo.jpg")
+        crashed.terminate.assert_called_once()
+
+        assert pool.get_metadata("photo.jpg") == [{"SourceFile": "photo.jpg"}]
+        replacement.get_metadata.assert_called_once()
+
+    def test_replaces_process_which_died_idle(self):
+        died = self.fake_exiftool()
+        replacement = self.fake_exiftool()
+        pool = ExifToolPool(mock.Mock(side_effect=[died, replacement]), 1)
+
+        pool.get_metadata("photo.jpg")
+        died.running = False
+        pool.get_metadata("photo.jpg")
+
+        assert died.get_metadata.call_count == 1
+        replacement.get_metadata.assert_called_once()
+
+    def test_close(self):
+        exiftool = self.fake_exiftool()
+        pool = ExifToolPool(mock.Mock(return_value=exiftool), 2)
+        pool.get_metadata("photo.jpg")
+
+        pool.close()
+
+        exiftool.terminate.assert_called_once()
+        with pytest.raises(RuntimeError):
+            pool.get_metadata("photo.jpg")
+
+
 def test_write_image(tmp_path: Path):
     image_path = create_test_datafile(tmp_path, "photo_1.jpg")
 
@@ -115,3 +444,54 @@ def test_write_image(tmp_path: Path):
     hash = hash_image(image_path)
     write_image(dest_fs, image_path)
     assert image_path.read_bytes() == dest_fs.read_bytes(f"{hash}.jpg")
+
+
+def test_write_image_streams_locally(tmp_path: Path):
+    # a local copy shouldn't pull the file through python at all
+    image_path = tmp_path / "big.jpg"
+    image_path.write_bytes(os.urandom(4 * TRANSFER_CHUNK_SIZE))
+
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    dest_fs = get_fs(str(output_dir), "dir")
+
+    tracemalloc.start()
+    write_image(dest_fs, image_path, "asdf")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert peak < TRANSFER_CHUNK_SIZE
+    assert list(output_dir.iterdir()) == [output_dir / "asdf.jpg"]
+    assert (output_dir / "asdf.jpg").read_bytes() == image_path.read_bytes()
+
+
+def test_transfer_file_same_filename(tmp_path: Path):
+    # images with the same pixels but other metadata share a filename, and can
+    # be transferred at the same time
+    image_paths = [create_test_datafile(tmp_path, f"photo_{i}.jpg") for i in (1, 2)]
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    dest_fs = get_fs(str(output_dir), "dir")
+
+    with ThreadPoolExecutor(8) as executor:
+        futures = [
+            executor.submit(transfer_file, dest_fs, image_path, "h.jpg")
+            for image_path in image_paths * 8
+        ]
+        for future in futures:
+            future.result()
+
+    assert list(output_dir.iterdir()) == [output_dir / "h.jpg"]
+    assert (output_dir / "h.jpg").read_bytes() in [
+        image_path.read_bytes() for image_path in image_paths
+    ]
+
+
+def test_write_image_streams_remotely(tmp_path: Path):
+    image_path = tmp_path / "big.jpg"
+    image_path.write_bytes(os.urandom(2 * TRANSFER_CHUNK_SIZE + 1))
+
+    dest_fs = DirFileSystem("/out", MemoryFileSystem())
+
+    write_image(dest_fs, image_path, "asdf")
+    assert dest_fs.read_bytes("asdf.jpg") == image_path.read_bytes()
@@ -0,0 +1,116 @@
+import os
+from pathlib import Path
+
+from photosite_backend.image.preview import ImagePreview
+from photosite_backend.journal import SyncJournal, journal_dir
+from photosite_backend.manifest import MANIFEST_VERSION, Manifest, ManifestEntry
+from photosite_backend.tests import create_test_datafile
+
+OPTIONS = {"hash_engine": "pixels", "derivative_widths": [640]}
+PREVIEW = ImagePreview(4, 3, "0123456789abcdef", "data:image/webp;base64,AAAA")
+
+
+def interrupted_journal(tmp_path: Path):
+    """
+    A journal of a sync which hashed and previewed photo_1.jpg, and landed it.
+    """
+
+    image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+    with SyncJournal(tmp_path / "journal", OPTIONS) as journal:
+        journal.hashed(image_path, "hash_1", image_path.stat())
+        journal.previewed("hash_1", PREVIEW)
+        journal.landed_in_dest("hash_1.jpg")
+
+    return image_path
+
+
+def test_journal_dir(tmp_path: Path):
+    path = journal_dir(tmp_path, Path("in"), "out", "dir")
+
+    assert path.parent == tmp_path / "journals"
+    assert path == journal_dir(tmp_path, Path("in").absolute(), "out", "dir")
+    assert path != journal_dir(tmp_path, Path("in"), "out", "s3")
+
+
+def test_resume(tmp_path: Path):
+    image_path = interrupted_journal(tmp_path)
+
+    with SyncJournal(tmp_path / "journal", OPTIONS, resume=True) as journal:
+        assert journal.hash_of(image_path, image_path.stat()) == "hash_1"
+        assert journal.previews == {"hash_1": PREVIEW}
+        assert journal.landed == {"hash_1.jpg"}
+        assert journal.pending_manifest is None
+
+
+def test_not_resumed(tmp_path: Path):
+    image_path = interrupted_journal(tmp_path)
+
+    # without resume, and when resuming with other options, it starts over
+    for options, resume in ((OPTIONS, False), ({**OPTIONS, "shard_size": 1}, True)):
+        with SyncJournal(tmp_path / "journal", options, resume=resume):
+            pass
+        with SyncJournal(tmp_path / "journal", options, resume=True) as journal:
+            assert journal.hash_of(image_path, image_path.stat()) is None
+            assert journal.landed == set()
+
+
+def test_changed_image(tmp_path: Path):
+    image_path = interrupted_journal(tmp_path)
+    stat = image_path.stat()
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    with SyncJournal(tmp_path / "journal", OPTIONS, resume=True) as journal:
+        assert journal.hash_of(image_path, image_path.stat()) is None
+
+
+def test_partial_line(tmp_path: Path):
+    image_path = interrupted_journal(tmp_path)
+    journal_path = tmp_path / "journal" / "journal.jsonl"
+    with journal_path.open("ab") as file:
+        file.write(b'{"type":"landed","filena')
+
+    with SyncJournal(tmp_path / "journal", OPTIONS, resume=True) as journal:
+        assert journal.landed == {"hash_1.jpg"}
+        journal.landed_in_dest("hash_2.jpg")
+
+    with SyncJournal(tmp_path / "journal", OPTIONS, resume=True) as journal:
+        assert journal.hash_of(image_path, image_path.stat()) == "hash_1"
+        assert journal.landed == {"hash_1.jpg", "hash_2.jpg"}
+
+
+def test_pending_manifest(tmp_path: Path):
+    image_path = interrupted_journal(tmp_path)
+    manifest = Manifest(
+        version=MANIFEST_VERSION,
+        hash_engine="pixels",
+        images={
+            "hash_1": ManifestEntry(
+                filename="hash_1.jpg", created_date=None, keyword_tags=[]
+            )
+        },
+    )
+    with SyncJournal(tmp_path / "journal", OPTIONS, resume=True) as journal:
+        journal.pending(manifest, {"old.jpg"})
+
+    with SyncJournal(tmp_path / "journal", OPTIONS, resume=True) as journal:
+        assert journal.pending_manifest == manifest
+        assert journal.stale == {"old.jpg"}
+        assert journal.hash_of(image_path, image_path.stat()) == "hash_1"
+        assert journal.unchanged({image_path: "hash_1"})
+
+    other_path = create_test_datafile(tmp_path, "photo_2.jpg")
+    with SyncJournal(tmp_path / "journal", OPTIONS, resume=True) as journal:
+        journal.hash_of(image_path, image_path.stat())
+        # an image was added since
+        assert not journal.unchanged({image_path: "hash_1", other_path: "hash_2"})
+
+    with SyncJournal(tmp_path / "journal", OPTIONS, resume=True) as journal:
+        # hashed again, so it may have changed
+        assert not journal.unchanged({image_path: "hash_1"})
+
+
+def test_finish(tmp_path: Path):
+    with SyncJournal(tmp_path / "journal", OPTIONS) as journal:
+        journal.finish()
+
+    assert not (tmp_path / "journal").exists()
@@ -1,15 +1,30 @@
+import io
 import json
 import logging
 from pathlib import Path
 from unittest import mock
 
 import pytest
+from typer.testing import CliRunner
 
-from photosite_backend.main import add, hash, remove, sync
-from photosite_backend.manifest import Manifest
+from photosite_backend.main import add, app, duplicates, hash, remove, sync, watch
+from photosite_backend.image import hash_image, read_manifest_tags_bulk
+from photosite_backend.manifest import Manifest, write_manifest
 from photosite_backend.tests import create_test_datafile
 
 
+def create_near_duplicate(in_path: Path, name: str):
+    """
+    A smaller, more compressed copy of photo_1.jpg.
+    """
+
+    from PIL import Image
+
+    with Image.open(create_test_datafile(in_path, "photo_1.jpg")) as img:
+        img.resize((img.width // 2, img.height // 2)).save(in_path / name, quality=60)
+    return in_path / name
+
+
 class TestHashCommand:
     def test_no_file(self):
         path = Path("no_file")
@@ -69,6 +84,340 @@ class TestSync:
         ]
         assert sorted(list(out_path.glob("*"))) == sorted(expected_files)
 
+    def test_nested_sources(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        (in_path / "2020" / "event").mkdir(parents=True)
+        (in_path / "private").mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        create_test_datafile(in_path / "2020" / "event", "photo_2.jpg").rename(
+            in_path / "2020" / "event" / "photo_2.JPG"
+        )
+        create_test_datafile(in_path / "private", "photo_3.jpg")
+
+        sync(in_path, out_path, exclude=["private"])
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+
+        assert sorted(
+            entry["filename"] for entry in manifest_contents["images"].values()
+        ) == sorted(
+            f"{hash_image(in_path / path)}.jpg"
+            for path in ["photo_1.jpg", "2020/event/photo_2.JPG"]
+        )
+
+    def test_skip_near_duplicates(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_2.jpg")
+        copy_path = create_near_duplicate(in_path, "copy.jpg")
+
+        sync(in_path, out_path)
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+        assert len(manifest_contents["images"]) == 3
+        for entry in manifest_contents["images"].values():
+            assert len(entry["perceptual_hash"]) == 16
+            assert entry["width"] > 0 and entry["height"] > 0
+            assert entry["placeholder"].startswith("data:image/webp;base64,")
+
+        sync(in_path, out_path, skip_near_duplicates=True)
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents = json.load(file)
+        # the copy is the one already in dest which sorts first
+        assert sorted(manifest_contents["images"]) == sorted(
+            [hash_image(copy_path), hash_image(in_path / "photo_2.jpg")]
+        )
+        assert len(list(out_path.glob("*.jpg"))) == 2
+
+    def test_previews_from_hash_decode(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        # the pixels engine decodes each image to hash it, which is reused
+        with mock.patch("photosite_backend.image.preview.preview_image") as preview:
+            sync(in_path, out_path)
+
+        preview.assert_not_called()
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+        [entry] = manifest_contents["images"].values()
+        assert entry["placeholder"].startswith("data:image/webp;base64,")
+
+    def test_incremental_skips_unchanged(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        sync(in_path, out_path)
+
+        create_test_datafile(in_path, "photo_2.jpg")
+        with mock.patch("photosite_backend.upload.transfer_file") as transfer_file:
+            sync(in_path, out_path)
+
+        assert [call.args[1] for call in transfer_file.call_args_list] == [
+            in_path / "photo_2.jpg"
+        ]
+
+    def test_unchanged_manifest_not_rewritten(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        sync(in_path, out_path)
+
+        with mock.patch("photosite_backend.main.write_manifest") as write_manifest:
+            sync(in_path, out_path)
+
+        write_manifest.assert_not_called()
+
+    def test_removes_orphans(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        sync(in_path, out_path)
+
+        (in_path / "photo_1.jpg").unlink()
+        create_test_datafile(in_path, "photo_2.jpg")
+        sync(in_path, out_path)
+
+        assert sorted(out_path.glob("*")) == sorted(
+            [
+                out_path / "manifest.json",
+                out_path
+                / "c6e9ec51b31e15299990d475ac83e70ebde470f5a66e6ddfb0fce341caaff6ea.jpg",
+            ]
+        )
+
+    def test_removes_orphans_after_manifest(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        sync(in_path, out_path)
+        [old_path] = out_path.glob("*.jpg")
+
+        (in_path / "photo_1.jpg").unlink()
+        create_test_datafile(in_path, "photo_2.jpg")
+        with (
+            mock.patch(
+                "photosite_backend.main.write_manifest", side_effect=RuntimeError
+            ),
+            pytest.raises(RuntimeError),
+        ):
+            sync(in_path, out_path)
+
+        # dest's manifest still refers to it
+        assert old_path.exists()
+
+    def test_derivatives(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        sync(in_path, out_path, derivative_widths=[400], derivative_formats=["webp"])
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+
+        [(image_hash, entry)] = manifest_contents["images"].items()
+        assert entry["derivatives"] == [
+            {
+                "filename": f"{image_hash}_400w_q80.webp",
+                "width": 400,
+                "height": 300,
+                "format": "webp",
+            }
+        ]
+        assert (out_path / f"{image_hash}_400w_q80.webp").exists()
+
+        # without a cache dir to keep them in, the derivatives in dest are used
+        with mock.patch("photosite_backend.image.derivatives._render") as render:
+            sync(
+                in_path, out_path, derivative_widths=[400], derivative_formats=["webp"]
+            )
+
+        render.assert_not_called()
+        with (out_path / "manifest.json").open() as file:
+            assert json.load(file) == manifest_contents
+
+    def test_sharded_manifest(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        for file in ["photo_1.jpg", "photo_2.jpg", "photo_3.jpg"]:
+            create_test_datafile(in_path, file)
+        sync(in_path, out_path, manifest_format="v3", shard_size=2)
+
+        with (out_path / "manifest.json").open() as file:
+            index = json.load(file)
+
+        assert index["version"] == 3
+        assert index["image_count"] == 3
+        assert [shard["count"] for shard in index["shards"]] == [2, 1]
+        assert all((out_path / shard["filename"]).exists() for shard in index["shards"])
+
+        with mock.patch("photosite_backend.main.write_manifest") as write_manifest:
+            sync(in_path, out_path, manifest_format="v3", shard_size=2)
+
+        write_manifest.assert_not_called()
+
+    def test_keyword_index(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        sync(in_path, out_path, keyword_index=True)
+
+        with (out_path / "keywords.json").open() as file:
+            keyword_index = json.load(file)
+
+        assert keyword_index["images"] == [
+            "f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24"
+        ]
+
+        # kept up to date by add and remove once it exists
+        add(out_path, [str(create_test_datafile(in_path, "photo_2.jpg"))])
+        remove(
+            out_path,
+            ["f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24"],
+        )
+
+        with (out_path / "keywords.json").open() as file:
+            keyword_index = json.load(file)
+
+        assert keyword_index["images"] == [
+            None,
+            "c6e9ec51b31e15299990d475ac83e70ebde470f5a66e6ddfb0fce341caaff6ea",
+        ]
+
+
+class TestResume:
+    def sync(self, tmp_path: Path, *options: str, crash: bool = False):
+        """
+        Syncs tmp_path/in to tmp_path/out with a cache dir to keep the journal
+        in, dying just before the manifest is written if crash is set.
+        """
+
+        arguments = [
+            "--cache-dir",
+            str(tmp_path / "cache"),
+            "--metrics-json",
+            str(tmp_path / "metrics.json"),
+            "sync",
+            str(tmp_path / "in"),
+            str(tmp_path / "out"),
+            *options,
+        ]
+        with mock.patch(
+            "photosite_backend.main.write_manifest",
+            side_effect=RuntimeError("Connection dropped") if crash else None,
+            wraps=None if crash else write_manifest,
+        ):
+            result = CliRunner().invoke(app, arguments)
+        assert (result.exit_code != 0) == crash, result.output
+
+        with (tmp_path / "metrics.json").open() as file:
+            return json.load(file)["counters"]
+
+    def test_resume(self, tmp_path):
+        (tmp_path / "in").mkdir()
+        (tmp_path / "out").mkdir()
+        for file in ["photo_1.jpg", "photo_2.jpg", "photo_3.jpg"]:
+            create_test_datafile(tmp_path / "in", file)
+
+        self.sync(tmp_path, "--verify", "checksum", crash=True)
+        assert not (tmp_path / "out" / "manifest.json").exists()
+        assert len(list((tmp_path / "out").glob("*.jpg"))) == 3
+
+        with mock.patch("photosite_backend.main.generate_manifest") as generate:
+            counters = self.sync(tmp_path, "--verify", "checksum", "--resume")
+
+        # nothing is hashed, previewed, uploaded or read again
+        generate.assert_not_called()
+        assert "hash_cache.hits" not in counters
+        assert counters["preview.files"] == 0
+        assert counters["upload.skipped"] == 3
+        assert "upload.files" not in counters
+
+        with (tmp_path / "out" / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+        assert len(manifest_contents["images"]) == 3
+        assert list((tmp_path / "cache" / "journals").iterdir()) == []
+
+    def test_resume_changed_source(self, tmp_path):
+        (tmp_path / "in").mkdir()
+        (tmp_path / "out").mkdir()
+        create_test_datafile(tmp_path / "in", "photo_1.jpg")
+        self.sync(tmp_path)
+
+        (tmp_path / "in" / "photo_1.jpg").unlink()
+        create_test_datafile(tmp_path / "in", "photo_2.jpg")
+        create_test_datafile(tmp_path / "in", "photo_3.jpg")
+        self.sync(tmp_path, crash=True)
+        # still referred to by dest's manifest, so not removed yet
+        assert len(list((tmp_path / "out").glob("*.jpg"))) == 3
+
+        (tmp_path / "in" / "photo_3.jpg").unlink()
+        counters = self.sync(tmp_path, "--resume")
+        assert counters["upload.skipped"] == 1
+
+        # neither the removed image nor the one uploaded then removed is left
+        with (tmp_path / "out" / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+        assert sorted((tmp_path / "out").glob("*")) == sorted(
+            [
+                tmp_path / "out" / "manifest.json",
+                tmp_path / "out" / f"{hash_image(tmp_path / 'in' / 'photo_2.jpg')}.jpg",
+            ]
+        )
+        assert len(manifest_contents["images"]) == 1
+
+    def test_different_options(self, tmp_path, caplog):
+        (tmp_path / "in").mkdir()
+        (tmp_path / "out").mkdir()
+        create_test_datafile(tmp_path / "in", "photo_1.jpg")
+
+        self.sync(tmp_path, crash=True)
+        counters = self.sync(tmp_path, "--resume", "--strip-metadata")
+
+        assert "run with different options, starting over" in caplog.text
+        assert counters["hash_cache.hits"] == 1
+
+    def test_needs_cache(self, tmp_path, caplog):
+        result = CliRunner().invoke(
+            app, ["--no-cache", "sync", str(tmp_path), str(tmp_path), "--resume"]
+        )
+
+        assert result.exit_code == 1
+        assert "--resume needs the cache dir" in caplog.text
+
 
 class TestAddCommand:
     def test_no_manifest(self, tmp_path):
@@ -80,7 +429,7 @@ class TestAddCommand:
         create_test_datafile(in_path, "photo_1.jpg")
 
         image_path = in_path / "photo_1.jpg"
-        add(out_path, image_path)
+        add(out_path, [str(image_path)])
 
         with (out_path / "manifest.json").open() as file:
             manifest_contents: Manifest = json.load(file)
@@ -107,8 +456,8 @@ class TestAddCommand:
         create_test_datafile(in_path, "photo_1.jpg")
         create_test_datafile(in_path, "photo_2.jpg")
 
-        add(out_path, in_path / "photo_1.jpg")
-        add(out_path, in_path / "photo_2.jpg")
+        add(out_path, [str(in_path / "photo_1.jpg")])
+        add(out_path, [str(in_path / "photo_2.jpg")])
 
         with (out_path / "manifest.json").open() as file:
             manifest_contents: Manifest = json.load(file)
@@ -129,11 +478,93 @@ class TestAddCommand:
             ]
         )
 
+    def test_batch(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        for file in ["photo_1.jpg", "photo_2.jpg", "photo_3.jpg"]:
+            create_test_datafile(in_path, file)
+
+        with (
+            mock.patch(
+                "photosite_backend.manifest.write_manifest", wraps=write_manifest
+            ) as mock_write_manifest,
+            mock.patch(
+                "photosite_backend.manifest.read_manifest_tags_bulk",
+                wraps=read_manifest_tags_bulk,
+            ) as mock_read_tags_bulk,
+        ):
+            add(out_path, [str(in_path / "photo_[12].jpg")])
+
+        assert mock_write_manifest.call_count == 1
+        assert mock_read_tags_bulk.call_count == 1
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+
+        assert sorted(manifest_contents["images"]) == [
+            "c6e9ec51b31e15299990d475ac83e70ebde470f5a66e6ddfb0fce341caaff6ea",
+            "f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24",
+        ]
+
+    def test_glob_skips_sidecars(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        (in_path / "photo_1.xmp").write_text("<x:xmpmeta/>")
+
+        add(out_path, [str(in_path / "photo_1.*")])
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+
+        assert [
+            entry["filename"] for entry in manifest_contents["images"].values()
+        ] == ["f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24.jpg"]
+
+    def test_stdin(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        image_paths = [
+            create_test_datafile(in_path, file)
+            for file in ["photo_1.jpg", "photo_2.jpg"]
+        ]
+
+        stdin = io.StringIO("".join(f"{path}\n" for path in image_paths))
+        with mock.patch("sys.stdin", stdin):
+            add(out_path, ["-"])
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+
+        assert len(manifest_contents["images"]) == 2
+
+    def test_missing_file(self, tmp_path, caplog):
+        def fake_exit(code):
+            raise Exception(code)
+
+        with (
+            pytest.raises(Exception),
+            mock.patch("photosite_backend.main.exit", fake_exit),
+        ):
+            add(tmp_path, [str(tmp_path / "missing.jpg")])
+
+        assert "missing.jpg` doesn't exist!" in caplog.text
+        assert not (tmp_path / "manifest.json").exists()
+
 
 class TestRemoveCommand:
     def test_remove_no_manifest(self, tmp_path):
         with pytest.raises(FileNotFoundError):
-            remove(tmp_path, "asdf")
+            remove(tmp_path, ["asdf"])
 
     def test_remove_missing(self, tmp_path, caplog):
         in_path = tmp_path / "in"
@@ -142,7 +573,7 @@ class TestRemoveCommand:
         out_path.mkdir()
 
         image_path = create_test_datafile(in_path, "photo_1.jpg")
-        add(out_path, image_path)
+        add(out_path, [str(image_path)])
 
         def fake_exit(code):
             raise Exception(code)
@@ -151,7 +582,7 @@ class TestRemoveCommand:
             pytest.raises(Exception),
             mock.patch("photosite_backend.main.exit", fake_exit),
         ):
-            remove(out_path, "asdf")
+            remove(out_path, ["asdf"])
 
         assert "Provided hash `asdf` not found in the manifest!" in caplog.text
 
@@ -162,11 +593,11 @@ class TestRemoveCommand:
         out_path.mkdir()
 
         image_path = create_test_datafile(in_path, "photo_1.jpg")
-        add(out_path, image_path)
+        add(out_path, [str(image_path)])
 
         hash = "f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24"
 
-        remove(out_path, hash)
+        remove(out_path, [hash])
 
         assert list(out_path.glob("*")) == [out_path / "manifest.json"]
 
@@ -175,3 +606,200 @@ class TestRemoveCommand:
 
         manifest_images = list(manifest_contents["images"].keys())
         assert manifest_images == []
+
+    def test_remove_batch(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        for file in ["photo_1.jpg", "photo_2.jpg", "photo_3.jpg"]:
+            create_test_datafile(in_path, file)
+        add(out_path, [str(in_path / "*.jpg")])
+
+        with mock.patch(
+            "photosite_backend.manifest.write_manifest", wraps=write_manifest
+        ) as mock_write_manifest:
+            remove(
+                out_path,
+                [
+                    "f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24",
+                    "c6e9ec51b31e15299990d475ac83e70ebde470f5a66e6ddfb0fce341caaff6ea",
+                ],
+            )
+
+        assert mock_write_manifest.call_count == 1
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+
+        [remaining] = manifest_contents["images"]
+        assert sorted(out_path.glob("*")) == sorted(
+            [out_path / "manifest.json", out_path / f"{remaining}.jpg"]
+        )
+
+
+class TestDuplicatesCommand:
+    def test_lists_near_duplicates(self, tmp_path, caplog):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_2.jpg")
+        copy_path = create_near_duplicate(in_path, "copy.jpg")
+        sync(in_path, out_path)
+
+        caplog.set_level(logging.INFO)
+        duplicates(out_path)
+
+        assert sorted(
+            [
+                f"`{hash_image(in_path / 'photo_1.jpg')}.jpg`",
+                f"`{hash_image(copy_path)}.jpg`",
+            ]
+        ) == sorted(caplog.text.split("Near duplicates: ")[1].split()[:2])
+        assert "1 groups of near duplicates" in caplog.text
+
+
+class TestWatchCommand:
+    def test_applies_changes(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+
+        def changes(watcher, debounce):
+            # present from the start, so synced before watching
+            assert (
+                out_path
+                / "f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24.jpg"
+            ).exists()
+
+            create_test_datafile(in_path, "photo_2.jpg")
+            (in_path / "photo_1.jpg").unlink()
+            (in_path / "notes.txt").write_text("not an image")
+            yield {
+                in_path / "photo_1.jpg",
+                in_path / "photo_2.jpg",
+                in_path / "notes.txt",
+            }
+
+        with mock.patch("photosite_backend.main.watch_changes", changes):
+            watch(in_path, out_path)
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+
+        assert list(manifest_contents["images"]) == [
+            "c6e9ec51b31e15299990d475ac83e70ebde470f5a66e6ddfb0fce341caaff6ea"
+        ]
+        assert sorted(out_path.glob("*")) == sorted(
+            [
+                out_path / "manifest.json",
+                out_path
+                / "c6e9ec51b31e15299990d475ac83e70ebde470f5a66e6ddfb0fce341caaff6ea.jpg",
+            ]
+        )
+
+    def test_removed_directory(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        (in_path / "event").mkdir(parents=True)
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        create_test_datafile(in_path / "event", "photo_2.jpg")
+
+        def changes(watcher, debounce):
+            (in_path / "event" / "photo_2.jpg").unlink()
+            (in_path / "event").rmdir()
+            # as reported for a directory moved out of in_path
+            yield {in_path / "event"}
+
+        with mock.patch("photosite_backend.main.watch_changes", changes):
+            watch(in_path, out_path)
+
+        with (out_path / "manifest.json").open() as file:
+            manifest_contents: Manifest = json.load(file)
+
+        assert list(manifest_contents["images"]) == [
+            "f85e656b84e9bd44354f02bd224b7eb9140f8a09e144ad469b1222b968082b24"
+        ]
+
+    def test_keeps_manifest_format(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+
+        create_test_datafile(in_path, "photo_1.jpg")
+        sync(in_path, out_path, manifest_format="v3")
+
+        def changes(watcher, debounce):
+            create_test_datafile(in_path, "photo_2.jpg")
+            yield {in_path / "photo_2.jpg"}
+            # the same image again, with nothing to publish
+            yield {in_path / "photo_2.jpg"}
+
+        with (
+            mock.patch("photosite_backend.main.watch_changes", changes),
+            mock.patch(
+                "photosite_backend.main.write_manifest", wraps=write_manifest
+            ) as mock_write_manifest,
+        ):
+            watch(in_path, out_path)
+
+        mock_write_manifest.assert_called_once()
+
+        with (out_path / "manifest.json").open() as file:
+            index = json.load(file)
+
+        assert index["version"] == 3
+        assert index["image_count"] == 2
+
+
+class TestInstrumentation:
+    def test_metrics_json(self, tmp_path):
+        in_path = tmp_path / "in"
+        out_path = tmp_path / "out"
+        in_path.mkdir()
+        out_path.mkdir()
+        metrics_path = tmp_path / "metrics.json"
+        profile_path = tmp_path / "sync.prof"
+
+        for file in ["photo_1.jpg", "photo_2.jpg"]:
+            create_test_datafile(in_path, file)
+
+        result = CliRunner().invoke(
+            app,
+            [
+                "--cache-dir",
+                str(tmp_path / "cache"),
+                "--metrics-json",
+                str(metrics_path),
+                "--profile",
+                str(profile_path),
+                "sync",
+                str(in_path),
+                str(out_path),
+            ],
+        )
+        assert result.exit_code == 0, result.output
+
+        with metrics_path.open() as file:
+            metrics = json.load(file)
+
+        assert metrics["command"] == "sync"
+        assert {"scan", "hash_images", "generate_manifest", "write_manifest"} <= set(
+            metrics["phases"]
+        )
+        assert metrics["counters"]["images"] == 2
+        assert metrics["counters"]["hash_cache.misses"] == 2
+        assert metrics["counters"]["upload.files"] == 2
+        # read in process, without exiftool
+        assert metrics["counters"]["metadata.files"] == 2
+        assert "exiftool.files" not in metrics["counters"]
+        assert profile_path.stat().st_size > 0
@@ -1,13 +1,46 @@
+import gzip
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+from fsspec.implementations.dirfs import DirFileSystem
+from fsspec.implementations.memory import MemoryFileSystem
 
 from photosite_backend.backends import get_fs
+from photosite_backend.backends.conditional import (
+    STALE_LOCK_SECONDS,
+    FileVersion,
+    PreconditionFailedError,
+    _break_stale_lock,
+    read_versioned,
+    write_conditional,
+)
 from photosite_backend.manifest import (
     Manifest,
+    ManifestDiff,
     ManifestEntry,
+    diff_manifests,
+    encoding,
     generate_manifest_entry,
+    manifest_previews,
+    read_manifest,
+    read_manifest_versioned,
+    update_manifest,
     write_manifest,
 )
+from photosite_backend.image.preview import ImagePreview
+from photosite_backend.manifest.columnar import from_columnar, to_columnar
+from photosite_backend.manifest.encoding import _upload_kwargs, dumps
+from photosite_backend.manifest.keywords import (
+    add_to_keyword_index,
+    build_keyword_index,
+    remove_from_keyword_index,
+)
+from photosite_backend.manifest.sharded import ShardOptions, build_shards
 from photosite_backend.tests import create_test_datafile
 
 
@@ -40,3 +73,419 @@ def test_write_manifest(tmpdir):
 
     with dest_fs.open("manifest.json", "rb") as file:
         assert json.load(file) == manifest
+
+
+def test_read_manifest_missing(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+
+    assert read_manifest(dest_fs) is None
+
+
+def test_diff_manifests():
+    entry = ManifestEntry(filename="", created_date=None, keyword_tags=[])
+    old = Manifest(version=2, images={"asdf": entry, "hjkl": entry})
+    new = Manifest(version=2, images={"hjkl": entry, "qwer": entry})
+
+    assert diff_manifests(old, new) == ManifestDiff(
+        added={"qwer"}, removed={"asdf"}, unchanged={"hjkl"}
+    )
+    assert diff_manifests(None, new) == ManifestDiff(
+        added={"hjkl", "qwer"}, removed=set(), unchanged=set()
+    )
+
+
+def sharded_manifest(dates: list[str | None], keyword_shards: bool = False):
+    return Manifest(
+        version=3,
+        hash_engine="pixels",
+        sharding=ShardOptions(shard_size=2, keyword_shards=keyword_shards),
+        images={
+            f"hash_{i}": ManifestEntry(
+                filename=f"hash_{i}.jpg",
+                created_date=date,
+                keyword_tags=["even"] if i % 2 == 0 else [],
+            )
+            for i, date in enumerate(dates)
+        },
+    )
+
+
+def test_build_shards():
+    manifest = sharded_manifest(
+        ["2024:01:03", "2024:01:01", None, "2024:01:02", "2024:01:04"]
+    )
+
+    index, shard_files = build_shards(manifest, manifest["sharding"])
+
+    assert index["image_count"] == 5
+    assert [shard["count"] for shard in index["shards"]] == [2, 2, 1]
+    assert [
+        list(json.loads(shard_files[shard["filename"]])["images"])
+        for shard in index["shards"]
+    ] == [["hash_2", "hash_1"], ["hash_3", "hash_0"], ["hash_4"]]
+    assert index["shards"][0]["first_date"] == "2024:01:01"
+    assert index["shards"][2]["last_date"] == "2024:01:04"
+    assert "keywords" not in index
+
+
+def test_build_keyword_shards():
+    manifest = sharded_manifest(["2024:01:01", "2024:01:02", "2024:01:03"], True)
+
+    index, shard_files = build_shards(manifest, manifest["sharding"])
+
+    keyword_shard = index["keywords"]["even"]
+    assert keyword_shard["count"] == 2
+    assert list(json.loads(shard_files[keyword_shard["filename"]])["images"]) == [
+        "hash_0",
+        "hash_2",
+    ]
+
+
+def test_sharded_manifest_round_trip(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+    manifest = sharded_manifest(["2024:01:01", "2024:01:02", "2024:01:03"], True)
+
+    write_manifest(dest_fs, manifest)
+
+    with dest_fs.open("manifest.json", "rb") as file:
+        assert json.load(file)["version"] == 3
+    assert read_manifest(dest_fs) == manifest
+
+
+def test_sharded_manifest_only_writes_changed_shards(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+    manifest = sharded_manifest(["2024:01:01", "2024:01:02", "2024:01:03"])
+    write_manifest(dest_fs, manifest)
+    old_shards = set(dest_fs.glob("manifest-*.json"))
+
+    # a newer image only changes the last shard
+    manifest["images"]["hash_new"] = ManifestEntry(
+        filename="hash_new.jpg", created_date="2024:01:04", keyword_tags=[]
+    )
+    write_manifest(dest_fs, manifest)
+    new_shards = set(dest_fs.glob("manifest-*.json"))
+
+    assert len(old_shards & new_shards) == 1
+    assert len(new_shards) == 2
+    assert read_manifest(dest_fs) == manifest
+
+
+def test_unsharded_manifest_removes_shards(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+    manifest = sharded_manifest(["2024:01:01", "2024:01:02", "2024:01:03"])
+    write_manifest(dest_fs, manifest)
+
+    manifest = Manifest(version=2, images=manifest["images"])
+    write_manifest(dest_fs, manifest)
+
+    assert dest_fs.ls("", detail=False) == ["manifest.json"]
+    assert read_manifest(dest_fs) == manifest
+
+
+def keyword_manifest():
+    return Manifest(
+        version=2,
+        images={
+            "cat": ManifestEntry(
+                filename="cat.jpg",
+                created_date="2024:01:02",
+                keyword_tags=["pet"],
+                hierarchical_subjects=["animal|cat"],
+            ),
+            "dog": ManifestEntry(
+                filename="dog.jpg",
+                created_date="2024:01:01",
+                keyword_tags=["pet"],
+                hierarchical_subjects=["animal|dog"],
+            ),
+            "tree": ManifestEntry(
+                filename="tree.jpg", created_date=None, keyword_tags=["outdoors"]
+            ),
+        },
+    )
+
+
+def test_manifest_previews():
+    manifest = keyword_manifest()
+    preview = ImagePreview(600, 400, "0f0f0f0f0f0f0f0f", "data:image/webp;base64,")
+    cat = manifest["images"]["cat"]
+    cat["width"], cat["height"] = preview.width, preview.height
+    cat["perceptual_hash"] = preview.perceptual_hash
+    cat["placeholder"] = preview.placeholder
+    # written before previews were, only the perceptual hash
+    manifest["images"]["dog"]["perceptual_hash"] = "0f0f0f0f0f0f0f0f"
+
+    assert manifest_previews(manifest) == {"cat": preview}
+
+    entry = generate_manifest_entry(
+        Path("cat.jpg"), {}, "cat", derivatives=None, preview=preview
+    )
+    assert entry["width"] == 600
+    assert entry["placeholder"] == preview.placeholder
+
+
+def test_build_keyword_index():
+    index = build_keyword_index(keyword_manifest())
+
+    # ids are assigned oldest first
+    assert index["images"] == ["tree", "dog", "cat"]
+    assert index["keywords"] == {
+        "pet": {"count": 2, "ids": [1, 2]},
+        "outdoors": {"count": 1, "ids": [0]},
+        "animal": {"count": 2, "ids": [1, 2], "children": ["animal|cat", "animal|dog"]},
+        "animal|cat": {"count": 1, "ids": [2], "parent": "animal"},
+        "animal|dog": {"count": 1, "ids": [1], "parent": "animal"},
+    }
+
+
+def test_keyword_index_incremental_updates():
+    manifest = keyword_manifest()
+    index = build_keyword_index(manifest)
+
+    remove_from_keyword_index(index, "cat")
+    assert index["images"] == ["tree", "dog", None]
+    assert "animal|cat" not in index["keywords"]
+    assert index["keywords"]["animal"] == {
+        "count": 1,
+        "ids": [1],
+        "children": ["animal|dog"],
+    }
+
+    add_to_keyword_index(index, "cat", manifest["images"]["cat"])
+    assert index["images"] == ["tree", "dog", None, "cat"]
+    assert index["keywords"]["pet"] == {"count": 2, "ids": [1, 3]}
+    assert index["keywords"]["animal"]["children"] == ["animal|cat", "animal|dog"]
+
+    remove_from_keyword_index(index, "tree")
+    assert "outdoors" not in index["keywords"]
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_matches_json(use_orjson: bool):
+    manifest = keyword_manifest()
+    manifest["images"]["tree"]["keyword_tags"] = ["日本/東京"]
+
+    with mock.patch.object(encoding, "orjson", encoding.orjson if use_orjson else None):
+        assert json.loads(dumps(manifest)) == manifest
+        assert (
+            dumps(manifest)
+            == json.dumps(manifest, ensure_ascii=False, separators=(",", ":")).encode()
+        )
+
+
+def test_columnar_round_trip():
+    manifest = keyword_manifest()
+    manifest["version"] = 4
+    manifest["images"]["cat"]["derivatives"] = [
+        {"filename": "cat_400w_q80.webp", "width": 400, "height": 300, "format": "webp"}
+    ]
+    manifest["images"]["dog"].update(
+        perceptual_hash="0f0f0f0f0f0f0f0f",
+        width=600,
+        height=400,
+        placeholder="data:image/webp;base64,",
+    )
+
+    columnar = to_columnar(manifest)
+
+    assert columnar["tags"] == ["animal|cat", "animal|dog", "outdoors", "pet"]
+    assert columnar["images"]["hash"] == ["tree", "dog", "cat"]
+    assert columnar["images"]["suffix"] == [".jpg", ".jpg", ".jpg"]
+    assert columnar["images"]["keyword_tags"] == [[2], [3], [3]]
+    assert columnar["images"]["derivatives"] == [
+        None,
+        None,
+        [["_400w_q80.webp", 400, 300, "webp"]],
+    ]
+    assert columnar["images"]["perceptual_hash"] == [None, "0f0f0f0f0f0f0f0f", None]
+    assert columnar["images"]["width"] == [None, 600, None]
+    assert columnar["images"]["height"] == [None, 400, None]
+    assert from_columnar(columnar) == manifest
+
+
+def test_columnar_manifest_round_trip(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+    manifest = keyword_manifest()
+    manifest["version"] = 4
+
+    write_manifest(dest_fs, manifest)
+
+    assert read_manifest(dest_fs) == manifest
+
+
+def test_precompressed_siblings(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+    manifest = sharded_manifest(["2024:01:01", "2024:01:02", "2024:01:03"])
+    manifest["precompressed"] = ["gz"]
+
+    write_manifest(dest_fs, manifest)
+
+    filenames = dest_fs.ls("", detail=False)
+    assert len(filenames) == 6
+    for filename in filenames:
+        if filename.endswith(".json"):
+            compressed = dest_fs.cat_file(f"{filename}.gz")
+            assert gzip.decompress(compressed) == dest_fs.cat_file(filename)
+    assert read_manifest(dest_fs) == manifest
+
+    # dropping the compression removes the siblings again
+    del manifest["precompressed"]
+    write_manifest(dest_fs, manifest)
+
+    assert not dest_fs.glob("*.gz")
+
+
+def test_precompressed_siblings_concurrent_commit(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+    commit = encoding.write_conditional
+
+    def then_commit_other(dest_fs, filename, contents, version, **kwargs):
+        commit(dest_fs, filename, contents, version, **kwargs)
+        if contents == b"first":
+            # another writer commits, and writes its siblings, before the first
+            # writer writes its siblings
+            _, version = read_versioned(dest_fs, filename)
+            encoding.write_encoded(
+                dest_fs, {filename: b"second"}, ["gz"], expected={filename: version}
+            )
+
+    with mock.patch.object(encoding, "write_conditional", then_commit_other):
+        encoding.write_encoded(
+            dest_fs,
+            {"manifest.json": b"first"},
+            ["gz"],
+            expected={"manifest.json": FileVersion(tag=None)},
+        )
+
+    assert dest_fs.cat_file("manifest.json") == b"second"
+    assert gzip.decompress(dest_fs.cat_file("manifest.json.gz")) == b"second"
+
+
+def test_upload_kwargs():
+    local_fs = get_fs("/tmp", "dir")
+    remote_fs = DirFileSystem("bucket", MemoryFileSystem())
+
+    assert _upload_kwargs(local_fs, "gz") == {}
+    assert _upload_kwargs(remote_fs, None) == {"ContentType": "application/json"}
+    assert _upload_kwargs(remote_fs, "gz") == {
+        "ContentType": "application/json",
+        "ContentEncoding": "gzip",
+    }
+
+
+def test_write_manifest_conditional(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+    manifest = Manifest(version=2, images={})
+
+    _, version = read_manifest_versioned(dest_fs)
+    write_manifest(dest_fs, manifest, version)
+
+    # version is from before the manifest existed
+    with pytest.raises(PreconditionFailedError):
+        write_manifest(dest_fs, manifest, version)
+
+    assert dest_fs.ls("", detail=False) == ["manifest.json"]
+
+
+def test_write_conditional_local(tmp_path: Path):
+    dest_fs = get_fs(str(tmp_path), "dir")
+    lock_path = tmp_path / "manifest.json.lock"
+    lock_path.touch()
+    stale_time = lock_path.stat().st_mtime - STALE_LOCK_SECONDS - 1
+    os.utime(lock_path, (stale_time, stale_time))
+
+    write_conditional(dest_fs, "manifest.json", b"{}", FileVersion(tag=None))
+
+    umask = os.umask(0)
+    os.umask(umask)
+    # readable by whatever serves dest, like any other file written there
+    assert (tmp_path / "manifest.json").stat().st_mode & 0o777 == 0o666 & ~umask
+    assert os.listdir(tmp_path) == ["manifest.json"]
+
+
+def test_break_stale_lock_taken_since(tmp_path: Path):
+    lock_path = tmp_path / "manifest.json.lock"
+    lock_path.touch()
+    stale_time = lock_path.stat().st_mtime - STALE_LOCK_SECONDS - 1
+    os.utime(lock_path, (stale_time, stale_time))
+    rename = os.rename
+
+    def taken_since(source, dest):
+        # another writer breaks the stale lock and takes a new one first
+        lock_path.unlink()
+        lock_path.touch()
+        rename(source, dest)
+
+    with mock.patch("os.rename", side_effect=taken_since):
+        assert not _break_stale_lock(str(lock_path))
+
+    # the other writer's lock is left in place
+    assert lock_path.stat().st_mtime > stale_time
+    assert os.listdir(tmp_path) == ["manifest.json.lock"]
+
+
+def test_update_manifest_merges_concurrent_updates(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+    entry = ManifestEntry(filename="", created_date=None, keyword_tags=[])
+    write_manifest(dest_fs, Manifest(version=2, images={"a": entry}))
+
+    calls = []
+
+    def update(manifest):
+        calls.append(manifest)
+        if len(calls) == 1:
+            # another writer gets in between the read and write
+            write_manifest(dest_fs, Manifest(version=2, images={"b": entry}))
+
+        manifest["images"]["c"] = entry
+        return manifest
+
+    manifest, removed_filenames = update_manifest(dest_fs, update)
+
+    assert len(calls) == 2
+    assert sorted(manifest["images"]) == ["b", "c"]
+    assert read_manifest(dest_fs) == manifest
+
+
+def test_update_manifest_threads(tmpdir):
+    dest_fs = get_fs(str(tmpdir), "dir")
+
+    def add_entry(image_hash: str):
+        def update(manifest):
+            manifest = manifest or Manifest(version=2, images={})
+            manifest["images"][image_hash] = ManifestEntry(
+                filename=f"{image_hash}.jpg", created_date=None, keyword_tags=[]
+            )
+            return manifest
+
+        return update_manifest(dest_fs, update, attempts=100)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(add_entry, [str(number) for number in range(16)]))
+
+    manifest = read_manifest(dest_fs)
+    assert manifest is not None
+    assert sorted(manifest["images"], key=int) == [str(number) for number in range(16)]
+
+
+def test_write_conditional_s3():
+    dest_fs = DirFileSystem("bucket", MemoryFileSystem())
+
+    with mock.patch.object(dest_fs, "pipe_file") as pipe_file:
+        write_conditional(dest_fs, "manifest.json", b"{}", FileVersion(tag=None))
+        write_conditional(dest_fs, "manifest.json", b"{}", FileVersion(tag='"abc"'))
+
+    assert pipe_file.call_args_list == [
+        mock.call("manifest.json", b"{}", IfNoneMatch="*"),
+        mock.call("manifest.json", b"{}", IfMatch='"abc"'),
+    ]
+
+    error = OSError(22, "At least one of the pre-conditions did not hold")
+    error.__cause__ = ClientError(
+        {"Error": {"Code": "PreconditionFailed"}}, "PutObject"
+    )
+    with (
+        mock.patch.object(dest_fs, "pipe_file", side_effect=error),
+        pytest.raises(PreconditionFailedError),
+    ):
+        write_conditional(dest_fs, "manifest.json", b"{}", FileVersion(tag='"abc"'))
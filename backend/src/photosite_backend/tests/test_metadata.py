@@ -0,0 +1,158 @@
+import io
+import struct
+from collections.abc import Sequence
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from photosite_backend.image import (
+    get_exiftool,
+    read_manifest_tags_bulk,
+    read_tags,
+)
+from photosite_backend.image.jpeg import APP1, APP13
+from photosite_backend.image.metadata import MANIFEST_TAGS, read_jpeg_tags
+from photosite_backend.tests import create_test_datafile
+
+FIXTURES = [f"photo_{i}.jpg" for i in range(1, 6)]
+
+XMP_TEMPLATE = """<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:lr="http://ns.adobe.com/lightroom/1.0/">
+   {properties}
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>"""
+
+
+def bag(name: str, values: list[str]):
+    items = "".join(f"<rdf:li>{value}</rdf:li>" for value in values)
+    return f"<{name}><rdf:Bag>{items}</rdf:Bag></{name}>"
+
+
+def segment(marker: int, payload: bytes):
+    return bytes([0xFF, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def iptc_segment(keywords: list[bytes], utf8: bool = True):
+    records = b"\x1c\x01\x5a\x00\x03\x1b%G" if utf8 else b""
+    for keyword in keywords:
+        records += b"\x1c\x02\x19" + struct.pack(">H", len(keyword)) + keyword
+    if len(records) % 2:
+        records += b"\x00"
+
+    resource = b"8BIM\x04\x04\x00\x00" + struct.pack(">I", len(records)) + records
+    return segment(APP13, b"Photoshop 3.0\x00" + resource)
+
+
+def tagged_jpeg(path: Path, segments: Sequence[bytes] = (), xmp: str | None = None):
+    output = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(
+        output, "JPEG", **({"xmp": xmp.encode()} if xmp else {})
+    )
+    data = output.getvalue()
+    path.write_bytes(data[:2] + b"".join(segments) + data[2:])
+    return path
+
+
+@pytest.mark.parametrize("filename", FIXTURES)
+def test_matches_exiftool(tmp_path: Path, filename: str):
+    image_path = create_test_datafile(tmp_path, filename)
+    tagged_path = tmp_path / f"tagged_{filename}"
+    tagged_path.write_bytes(image_path.read_bytes())
+    get_exiftool().set_tags(
+        tagged_path,
+        {
+            "IPTC:CodedCharacterSet": "UTF8",
+            "IPTC:Keywords": ["cat", "東京", "2020"],
+            "XMP:Subject": ["cat"],
+            "XMP:HierarchicalSubject": ["animal|cat", "place|japan|東京"],
+        },
+    )
+
+    for path in (image_path, tagged_path):
+        exiftool_tags = read_tags(path)
+        assert read_jpeg_tags(path) == {
+            tag: exiftool_tags[tag] for tag in MANIFEST_TAGS if tag in exiftool_tags
+        }
+
+
+def test_fixture_dates(tmp_path: Path):
+    image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+
+    assert read_jpeg_tags(image_path) == {
+        "EXIF:DateTimeOriginal": "2017:01:06 11:05:48",
+        "EXIF:CreateDate": "2017:01:06 11:05:48",
+    }
+
+
+def test_keywords(tmp_path: Path):
+    image_path = tagged_jpeg(
+        tmp_path / "tagged.jpg",
+        [iptc_segment(["cat".encode(), "東京".encode(), b"2020", b"True"])],
+        XMP_TEMPLATE.format(
+            properties=bag("dc:subject", ["cat"])
+            + bag("lr:hierarchicalSubject", ["animal|cat", "place|japan|東京"])
+        ),
+    )
+
+    # like exiftool, one value on its own and numbers and booleans as those
+    assert read_jpeg_tags(image_path) == {
+        "IPTC:Keywords": ["cat", "東京", 2020, True],
+        "XMP:Subject": "cat",
+        "XMP:HierarchicalSubject": ["animal|cat", "place|japan|東京"],
+    }
+
+
+@pytest.mark.parametrize(
+    "segments,xmp",
+    [
+        # IPTC text without a character set
+        ([iptc_segment(["café".encode("latin-1")], utf8=False)], None),
+        ([iptc_segment([b" cat"])], None),
+        # split across segments
+        ([iptc_segment([b"cat"]), iptc_segment([b"dog"])], None),
+        ([segment(APP1, b"http://ns.adobe.com/xmp/extension/\x00")], None),
+        ([], XMP_TEMPLATE.format(properties=bag("dc:subject", []))),
+        ([], XMP_TEMPLATE.format(properties="<dc:subject><rdf:Bag><rdf:li>")),
+        ([], XMP_TEMPLATE.format(properties=bag("photoshop:subject", ["cat"]))),
+        ([segment(APP1, b"Exif\x00\x00XX")], None),
+    ],
+)
+def test_unusual_metadata(tmp_path: Path, segments: list[bytes], xmp: str | None):
+    image_path = tagged_jpeg(tmp_path / "unusual.jpg", segments, xmp)
+
+    assert read_jpeg_tags(image_path) is None
+
+
+def test_not_a_jpeg(tmp_path: Path):
+    image_path = tmp_path / "image.jpg"
+    Image.new("RGB", (8, 8)).save(image_path, "PNG")
+
+    assert read_jpeg_tags(image_path) is None
+    assert read_jpeg_tags(tmp_path / "image.png") is None
+
+
+def test_read_manifest_tags_bulk_falls_back(tmp_path: Path):
+    image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+    unusual_path = tagged_jpeg(
+        tmp_path / "unusual.jpg", [iptc_segment([b"cat"]), iptc_segment([b"dog"])]
+    )
+    exiftool_tags = {"IPTC:Keywords": ["cat", "dog"]}
+
+    with mock.patch(
+        "photosite_backend.image.read_tags_bulk",
+        return_value={unusual_path: exiftool_tags},
+    ) as mock_read_tags_bulk:
+        tags = read_manifest_tags_bulk([unusual_path, image_path])
+
+    mock_read_tags_bulk.assert_called_once_with([unusual_path], mock.ANY)
+    assert list(tags) == [unusual_path, image_path]
+    assert tags[unusual_path] == exiftool_tags
+    assert tags[image_path] == read_jpeg_tags(image_path)
@@ -0,0 +1,36 @@
+import threading
+
+from photosite_backend.metrics import Metrics
+
+
+def test_phases_and_counters():
+    metrics = Metrics()
+
+    with metrics.phase("hash"):
+        metrics.count("hash.files")
+    with metrics.phase("hash"):
+        metrics.count("hash.files")
+        metrics.count("hash.bytes", 1024)
+
+    summary = metrics.summary("sync")
+
+    assert summary["command"] == "sync"
+    assert summary["phases"]["hash"]["count"] == 2
+    assert 0 <= summary["phases"]["hash"]["seconds"] <= summary["seconds"]
+    assert summary["counters"] == {"hash.bytes": 1024, "hash.files": 2}
+
+
+def test_count_from_threads():
+    metrics = Metrics()
+
+    def work():
+        for _ in range(1000):
+            metrics.count("upload.files")
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert metrics.summary()["counters"] == {"upload.files": 8000}
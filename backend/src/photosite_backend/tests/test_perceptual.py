@@ -0,0 +1,120 @@
+import io
+import random
+from pathlib import Path
+
+from PIL import Image
+
+from photosite_backend.image.perceptual import (
+    HammingIndex,
+    NearDuplicateOptions,
+    find_near_duplicates,
+    hamming_distance,
+    select_distinct,
+)
+from photosite_backend.image.preview import preview_image
+from photosite_backend.tests import create_test_datafile
+
+
+def distance(a: str, b: str):
+    return hamming_distance(int(a, 16), int(b, 16))
+
+
+def resaved_copy(image_path: Path, dest_path: Path, scale: float, quality: int):
+    with Image.open(image_path) as img:
+        img = img.resize((int(img.width * scale), int(img.height * scale)))
+        output = io.BytesIO()
+        img.save(output, "JPEG", quality=quality)
+    dest_path.write_bytes(output.getvalue())
+    return dest_path
+
+
+def perceptual_hash(image_path: Path):
+    return preview_image(image_path).perceptual_hash
+
+
+def test_perceptual_hash(tmp_path: Path):
+    photo_1 = create_test_datafile(tmp_path, "photo_1.jpg")
+    photo_2 = create_test_datafile(tmp_path, "photo_2.jpg")
+    resized = resaved_copy(photo_1, tmp_path / "resized.jpg", 0.5, 60)
+
+    assert len(perceptual_hash(photo_1)) == 16
+    assert distance(perceptual_hash(photo_1), perceptual_hash(resized)) <= 4
+    assert distance(perceptual_hash(photo_1), perceptual_hash(photo_2)) > 10
+
+
+def test_hamming_index_matches_brute_force():
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(2000)]
+    # some near copies
+    hashes += [value ^ (1 << rng.randrange(64)) for value in hashes[:100]]
+
+    index = HammingIndex()
+    for key, value in enumerate(hashes):
+        index.add(value, str(key))
+
+    for query in hashes[:50] + [rng.getrandbits(64) for _ in range(50)]:
+        expected = {
+            (str(key), hamming_distance(query, value))
+            for key, value in enumerate(hashes)
+            if hamming_distance(query, value) <= 8
+        }
+        assert set(index.find(query, 8)) == expected
+
+
+def test_select_distinct():
+    perceptual_hashes = {
+        "a": "0000000000000000",
+        "b": "0000000000000003",
+        "c": "ffffffffffffffff",
+        "published": "0000000000000001",
+    }
+    image_hashes = {
+        Path("1.jpg"): "a",
+        Path("2.jpg"): "b",
+        Path("3.jpg"): "c",
+        # another copy of the same pixels is kept
+        Path("4.jpg"): "c",
+    }
+
+    assert select_distinct(image_hashes, perceptual_hashes) == {
+        Path("1.jpg"): "a",
+        Path("3.jpg"): "c",
+        Path("4.jpg"): "c",
+    }
+
+    # a near duplicate of an image already in dest is skipped instead
+    options = NearDuplicateOptions(published={"b": perceptual_hashes["b"]})
+    assert select_distinct(image_hashes, perceptual_hashes, options) == {
+        Path("2.jpg"): "b",
+        Path("3.jpg"): "c",
+        Path("4.jpg"): "c",
+    }
+
+    published = {"published": perceptual_hashes["published"]}
+    options = NearDuplicateOptions(max_distance=2, published=published)
+    assert list(select_distinct(image_hashes, perceptual_hashes, options)) == [
+        Path("3.jpg"),
+        Path("4.jpg"),
+    ]
+    # unless it's about to be removed
+    options = NearDuplicateOptions(max_distance=2, published=published, mirror=True)
+    assert list(select_distinct(image_hashes, perceptual_hashes, options)) == [
+        Path("1.jpg"),
+        Path("3.jpg"),
+        Path("4.jpg"),
+    ]
+
+
+def test_find_near_duplicates():
+    assert find_near_duplicates(
+        {
+            "a": "0000000000000000",
+            "b": "0000000000000007",
+            # only near b, but grouped with a through it
+            "c": "000000000000003f",
+            "d": "ffffffffffffffff",
+            "e": "fffffffffffffffe",
+            "f": "00000000ffffffff",
+        },
+        max_distance=3,
+    ) == [["a", "b", "c"], ["d", "e"]]
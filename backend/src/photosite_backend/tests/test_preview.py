@@ -0,0 +1,96 @@
+import base64
+import io
+from pathlib import Path
+
+from PIL import Image
+
+from photosite_backend.image.hashing import hash_pixels
+from photosite_backend.image.perceptual import hamming_distance
+from photosite_backend.image.preview import (
+    PLACEHOLDER_SIZE,
+    ImagePreview,
+    hash_and_preview,
+    preview_image,
+    preview_images,
+)
+from photosite_backend.tests import create_test_datafile
+
+ORIENTATION = 0x0112
+
+
+def test_preview_image(tmp_path: Path):
+    photo_1 = create_test_datafile(tmp_path, "photo_1.jpg")
+
+    preview = preview_image(photo_1)
+
+    with Image.open(photo_1) as img:
+        assert (preview.width, preview.height) == img.size
+
+    header, encoded = preview.placeholder.split(",")
+    assert header == "data:image/webp;base64"
+    with Image.open(io.BytesIO(base64.b64decode(encoded))) as placeholder:
+        assert placeholder.format == "WEBP"
+        assert max(placeholder.size) == PLACEHOLDER_SIZE
+        # same aspect ratio, give or take rounding
+        assert (
+            abs(placeholder.width / placeholder.height - preview.width / preview.height)
+            < 0.2
+        )
+
+
+def test_preview_image_orientation(tmp_path: Path):
+    photo_1 = create_test_datafile(tmp_path, "photo_1.jpg")
+    rotated = tmp_path / "rotated.jpg"
+    with Image.open(photo_1) as img:
+        exif = img.getexif()
+        exif[ORIENTATION] = 6
+        img.save(rotated, exif=exif, quality=95)
+
+    upright = preview_image(photo_1)
+    preview = preview_image(rotated)
+
+    # shown rotated by 90 degrees
+    assert (preview.width, preview.height) == (upright.height, upright.width)
+    header, encoded = preview.placeholder.split(",")
+    with Image.open(io.BytesIO(base64.b64decode(encoded))) as placeholder:
+        assert placeholder.height > placeholder.width
+
+
+def test_hash_and_preview(tmp_path: Path):
+    photo_1 = create_test_datafile(tmp_path, "photo_1.jpg")
+    rotated = tmp_path / "rotated.jpg"
+    with Image.open(photo_1) as img:
+        exif = img.getexif()
+        exif[ORIENTATION] = 6
+        img.save(rotated, exif=exif, quality=95)
+
+    for image_path in (photo_1, rotated):
+        image_hash, preview = hash_and_preview(image_path)
+        expected = preview_image(image_path)
+
+        assert image_hash == hash_pixels(image_path)
+        assert (preview.width, preview.height) == (expected.width, expected.height)
+        # from a full decode rather than a reduced one, so not quite the same
+        assert (
+            hamming_distance(
+                int(preview.perceptual_hash, 16), int(expected.perceptual_hash, 16)
+            )
+            <= 6
+        )
+        header, encoded = preview.placeholder.split(",")
+        with Image.open(io.BytesIO(base64.b64decode(encoded))) as placeholder:
+            assert (placeholder.width > placeholder.height) == (
+                preview.width > preview.height
+            )
+
+
+def test_preview_images_reuses_known(tmp_path: Path):
+    photo_1 = create_test_datafile(tmp_path, "photo_1.jpg")
+    photo_2 = create_test_datafile(tmp_path, "photo_2.jpg")
+    known = ImagePreview(1, 1, "0000000000000000", "data:")
+
+    previews = preview_images(
+        [(photo_1, "hash_1"), (photo_2, "hash_2")], {"hash_1": known}
+    )
+
+    assert previews == {"hash_1": known, "hash_2": preview_image(photo_2)}
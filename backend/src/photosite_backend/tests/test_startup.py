@@ -0,0 +1,88 @@
+"""
+Guards how long the CLI takes to start, which dominates short runs like `hash`
+in a commit hook. Heavy dependencies should only be imported by the commands
+(and dests) that need them.
+"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from photosite_backend.tests import create_test_datafile
+
+# always slow to import, and only needed for s3 dests or reading tags
+HEAVY_MODULES = {"s3fs", "botocore", "aiobotocore", "aiohttp", "exiftool"}
+
+# total import time budgets in milliseconds, about twice what they take on a
+# laptop so only real regressions fail
+HELP_BUDGET_MS = 400
+HASH_BUDGET_MS = 250
+SYNC_BUDGET_MS = 250
+
+
+def import_times(*args: str):
+    """
+    Runs the CLI with -X importtime, returning how long importing each module
+    took by itself in milliseconds.
+    """
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "photosite_backend.main", *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    times: dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        self_time, _, name = line.removeprefix("import time:").split("|")
+        if self_time.strip().isdigit():
+            times[name.strip()] = int(self_time) / 1000
+
+    return times
+
+
+def assert_within_budget(times: dict[str, float], budget_ms: float):
+    total = sum(times.values())
+    slowest = sorted(times.items(), key=lambda item: item[1], reverse=True)[:10]
+    assert total < budget_ms, f"imports took {total:.0f}ms, slowest: {slowest}"
+
+
+def top_level_packages(times: dict[str, float]):
+    return {name.split(".")[0] for name in times}
+
+
+@pytest.mark.parametrize("args", [["--help"], ["sync", "--help"]])
+def test_help(args: list[str]):
+    times = import_times(*args)
+
+    assert not top_level_packages(times) & (HEAVY_MODULES | {"fsspec", "PIL"})
+    assert_within_budget(times, HELP_BUDGET_MS)
+
+
+def test_hash(tmp_path: Path):
+    image_path = create_test_datafile(tmp_path, "photo_1.jpg")
+
+    times = import_times("--no-cache", "hash", str(image_path))
+
+    assert not top_level_packages(times) & (HEAVY_MODULES | {"fsspec"})
+    assert_within_budget(times, HASH_BUDGET_MS)
+
+
+def test_sync_dir(tmp_path: Path):
+    source = tmp_path / "source"
+    dest = tmp_path / "dest"
+    source.mkdir()
+    dest.mkdir()
+
+    times = import_times(
+        "--no-cache", "sync", str(source), str(dest), "--dest-type", "dir"
+    )
+
+    assert not top_level_packages(times) & HEAVY_MODULES
+    assert_within_budget(times, SYNC_BUDGET_MS)
@@ -0,0 +1,253 @@
+import io
+import struct
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from fsspec.implementations.dirfs import DirFileSystem
+from fsspec.implementations.memory import MemoryFile, MemoryFileSystem
+from PIL import Image, IptcImagePlugin
+
+from photosite_backend.backends import get_fs
+from photosite_backend.image import transfer_file
+from photosite_backend.image.jpeg import APP1, APP13, is_metadata_marker, iter_segments
+from photosite_backend.image.strip import (
+    DEFAULT_KEPT_TAGS,
+    StripOptions,
+    parse_rewrite,
+    write_stripped,
+)
+
+ORIENTATION = 0x0112
+MAKE = 0x010F
+ARTIST = 0x013B
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+DATETIME_ORIGINAL = 0x9003
+SERIAL_NUMBER = 0xA431
+
+XMP = b"""<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmp:CreatorTool="camera firmware">
+   <dc:subject><rdf:Bag><rdf:li>cat</rdf:li><rdf:li>private</rdf:li></rdf:Bag></dc:subject>
+   <dc:rights><rdf:Alt><rdf:li xml:lang="x-default">me</rdf:li></rdf:Alt></dc:rights>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>"""
+
+
+def iptc_segment(datasets: list[tuple[int, int, bytes]]):
+    records = b"".join(
+        struct.pack(">BBBH", 0x1C, record, dataset, len(value)) + value
+        for record, dataset, value in datasets
+    )
+    if len(records) % 2:
+        records += b"\x00"
+    payload = (
+        b"Photoshop 3.0\x00"
+        # a thumbnail resource, which should be dropped
+        + b"8BIM\x04\x0c\x00\x00"
+        + struct.pack(">I", 4)
+        + b"\xff\xd8\xff\xd9"
+        + b"8BIM\x04\x04\x00\x00"
+        + struct.pack(">I", len(records))
+        + records
+    )
+    return bytes([0xFF, APP13]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def make_photo(xmp: bytes = XMP):
+    image = Image.new("RGB", (64, 48), (200, 100, 50))
+    exif = Image.Exif()
+    exif[ORIENTATION] = 6
+    exif[MAKE] = "Camera Co"
+    exif[ARTIST] = "Someone"
+    exif.get_ifd(EXIF_IFD)[DATETIME_ORIGINAL] = "2020:01:02 03:04:05"
+    exif.get_ifd(EXIF_IFD)[SERIAL_NUMBER] = "12345"
+    exif.get_ifd(GPS_IFD)[2] = (37.0, 48.0, 0.0)
+
+    output = io.BytesIO()
+    image.save(output, "JPEG", exif=exif, xmp=xmp, comment=b"secret")
+    data = output.getvalue()
+
+    iptc = iptc_segment(
+        [(2, 0, b"\x00\x04"), (2, 25, b"cat"), (2, 25, b"private"), (2, 120, b"hi")]
+    )
+    # trailing data after EOI, like an MPF secondary image
+    return data[:2] + iptc + data[2:] + b"\xff\xd8trailing\xff\xd9"
+
+
+def strip(data: bytes, options: StripOptions):
+    output = io.BytesIO()
+    write_stripped(data, output, options)
+    return output.getvalue()
+
+
+def test_keeps_image_data():
+    photo = make_photo()
+    stripped = strip(photo, StripOptions())
+
+    def image_segments(data: bytes):
+        return [
+            data[segment.start : segment.end]
+            for segment in iter_segments(data)
+            if not is_metadata_marker(segment.marker)
+        ]
+
+    assert image_segments(stripped) == image_segments(
+        photo[: photo.rindex(b"\xff\xd8")]
+    )
+    assert stripped.endswith(b"\xff\xd9")
+    assert b"trailing" not in stripped
+
+    with (
+        Image.open(io.BytesIO(stripped)) as image,
+        Image.open(io.BytesIO(photo)) as original,
+    ):
+        assert image.tobytes() == original.tobytes()
+
+
+def test_default_tags():
+    stripped = strip(make_photo(), StripOptions())
+
+    with Image.open(io.BytesIO(stripped)) as image:
+        exif = image.getexif()
+        assert exif[ORIENTATION] == 6
+        assert exif[ARTIST] == "Someone"
+        assert MAKE not in exif
+        assert GPS_IFD not in exif
+        assert exif.get_ifd(EXIF_IFD) == {DATETIME_ORIGINAL: "2020:01:02 03:04:05"}
+
+        assert IptcImagePlugin.getiptcinfo(image) is None
+        assert "comment" not in image.info
+
+    assert b"secret" not in stripped
+    assert b"Camera Co" not in stripped
+    assert b"12345" not in stripped
+    assert b"camera firmware" not in stripped
+    assert b'<rdf:li xml:lang="x-default">me</rdf:li>' in stripped
+    assert b"private" not in stripped
+
+
+def test_keep_and_rewrite_tags():
+    options = StripOptions(
+        keep_tags=DEFAULT_KEPT_TAGS | {"IPTC:Keywords", "XMP:Subject"},
+        rewrites=(
+            parse_rewrite("IPTC:Keywords/^private$//"),
+            parse_rewrite("XMP:Subject|^private$|"),
+            parse_rewrite("EXIF:Artist/Some/No"),
+        ),
+    )
+    stripped = strip(make_photo(), options)
+
+    with Image.open(io.BytesIO(stripped)) as image:
+        assert image.getexif()[ARTIST] == "Noone"
+        assert IptcImagePlugin.getiptcinfo(image) == {
+            (2, 0): b"\x00\x04",
+            (2, 25): b"cat",
+        }
+
+    assert b"<rdf:li>cat</rdf:li>" in stripped
+    assert b"private" not in stripped
+
+
+def test_xmp_prefixes_kept_locally():
+    options = StripOptions(keep_tags=DEFAULT_KEPT_TAGS | {"XMP:Subject"})
+    namespaces = dict(ET._namespace_map)  # type: ignore
+    # the same namespace under another prefix
+    renamed = make_photo(XMP.replace(b"dc:", b"dcx:").replace(b":dc=", b":dcx="))
+
+    assert b"<dcx:subject>" in strip(renamed, options)
+    assert ET._namespace_map == namespaces  # type: ignore
+    # which isn't carried over to other images
+    assert b"<dc:subject>" in strip(make_photo(), options)
+
+
+def test_drops_unparseable_segments():
+    photo = make_photo()
+    exif_start = photo.index(b"Exif\x00\x00")
+    # corrupt the TIFF byte order
+    photo = photo[: exif_start + 6] + b"XX" + photo[exif_start + 8 :]
+
+    stripped = strip(photo, StripOptions())
+
+    markers = [segment.marker for segment in iter_segments(stripped)]
+    with Image.open(io.BytesIO(stripped)) as image:
+        assert ORIENTATION not in image.getexif()
+    assert b"Camera Co" not in stripped
+    # the XMP survives
+    assert APP1 in markers
+
+
+@pytest.mark.parametrize(
+    "rule", ["IPTC:Keywords", "IPTC:Keywords/a", "XMP:Subject/(/x"]
+)
+def test_parse_rewrite_invalid(rule: str):
+    with pytest.raises(ValueError):
+        parse_rewrite(rule)
+
+
+def test_transfer_file_strips(tmp_path: Path):
+    source_path = tmp_path / "photo.jpg"
+    source_path.write_bytes(make_photo())
+    (tmp_path / "dest").mkdir()
+    dest_fs = get_fs(str(tmp_path / "dest"), "dir")
+
+    transfer_file(dest_fs, source_path, "stripped.jpg", StripOptions())
+
+    written = dest_fs.read_bytes("stripped.jpg")
+    assert written == strip(source_path.read_bytes(), StripOptions())
+    assert not list((tmp_path / "dest").glob(".*"))
+
+
+class UploadingMemoryFileSystem(MemoryFileSystem):
+    """
+    Stands in for s3, where a file written without autocommit only appears
+    once it's committed (its multipart upload completed).
+    """
+
+    def _open(
+        self,
+        path,
+        mode="rb",
+        block_size=None,
+        autocommit=True,
+        cache_options=None,
+        **kwargs,
+    ):
+        if mode == "wb" and not autocommit:
+            return MemoryFile(self, self._strip_protocol(path))
+
+        return super()._open(
+            path, mode, block_size, autocommit, cache_options, **kwargs
+        )
+
+
+def test_transfer_file_strips_remotely(tmp_path: Path):
+    source_path = tmp_path / "photo.jpg"
+    source_path.write_bytes(make_photo())
+    dest_fs = DirFileSystem(str(tmp_path / "dest"), UploadingMemoryFileSystem())
+
+    transfer_file(dest_fs, source_path, "stripped.jpg", StripOptions())
+    assert dest_fs.read_bytes("stripped.jpg") == strip(
+        source_path.read_bytes(), StripOptions()
+    )
+
+    def fail_partway(source_path, dest, options):
+        dest.write(b"\xff\xd8")
+        raise OSError()
+
+    with (
+        mock.patch("photosite_backend.image.strip_metadata", fail_partway),
+        pytest.raises(OSError),
+    ):
+        transfer_file(dest_fs, source_path, "failed.jpg", StripOptions())
+
+    # a truncated file would be trusted by --verify exists
+    assert dest_fs.ls("", detail=False) == ["stripped.jpg"]
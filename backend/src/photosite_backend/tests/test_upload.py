@@ -0,0 +1,219 @@
+import hashlib
+from pathlib import Path
+from unittest import mock
+
+import pytest
+from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
+from fsspec.implementations.dirfs import DirFileSystem
+from fsspec.implementations.local import LocalFileSystem
+
+from photosite_backend.backends import get_fs
+from photosite_backend.image import hash_image, transfer_file
+from photosite_backend.tests import create_test_datafile
+from photosite_backend.upload import Uploader
+from photosite_backend.upload.listing import DestListing, _Digest
+
+
+def create_images(tmp_path: Path):
+    in_path = tmp_path / "in"
+    in_path.mkdir()
+
+    return [create_test_datafile(in_path, f"photo_{i}.jpg") for i in range(1, 4)]
+
+
+class TestUploader:
+    def test_upload(self, tmp_path: Path):
+        image_paths = create_images(tmp_path)
+        dest_fs = get_fs(str(tmp_path), "dir")
+
+        with Uploader(dest_fs, concurrency=2) as uploader:
+            for image_path in image_paths:
+                uploader.submit(image_path, f"{hash_image(image_path)}.jpg")
+
+        assert uploader.uploaded_files == len(image_paths)
+        for image_path in image_paths:
+            assert (
+                dest_fs.read_bytes(f"{hash_image(image_path)}.jpg")
+                == image_path.read_bytes()
+            )
+
+    def test_same_filename(self, tmp_path: Path):
+        image_paths = create_images(tmp_path)
+        dest_fs = get_fs(str(tmp_path), "dir")
+
+        with (
+            mock.patch(
+                "photosite_backend.upload.transfer_file", wraps=transfer_file
+            ) as mock_transfer_file,
+            Uploader(dest_fs, concurrency=8) as uploader,
+        ):
+            for image_path in image_paths:
+                uploader.submit(image_path, "h.jpg")
+
+        mock_transfer_file.assert_called_once()
+        assert uploader.uploaded_files == 1
+        assert uploader.skipped_files == 2
+        assert (tmp_path / "h.jpg").read_bytes() == image_paths[0].read_bytes()
+
+    def test_upload_async(self, tmp_path: Path):
+        # stands in for s3, which is the only async backend
+        image_paths = create_images(tmp_path)
+        dest_fs = DirFileSystem(
+            str(tmp_path), AsyncFileSystemWrapper(LocalFileSystem())
+        )
+
+        with Uploader(dest_fs, concurrency=2) as uploader:
+            for image_path in image_paths:
+                uploader.submit(image_path, f"{hash_image(image_path)}.jpg")
+
+        for image_path in image_paths:
+            assert (
+                tmp_path / f"{hash_image(image_path)}.jpg"
+            ).read_bytes() == image_path.read_bytes()
+
+    @mock.patch("photosite_backend.upload.RETRY_BASE_DELAY", 0)
+    def test_retries(self, tmp_path: Path):
+        image_path = create_images(tmp_path)[0]
+        dest_fs = get_fs(str(tmp_path), "dir")
+
+        with (
+            mock.patch(
+                "photosite_backend.upload.transfer_file",
+                side_effect=[ConnectionError(), None],
+            ) as transfer_file,
+            Uploader(dest_fs, retries=1) as uploader,
+        ):
+            uploader.submit(image_path, "asdf.jpg")
+
+        assert transfer_file.call_count == 2
+
+    @mock.patch("photosite_backend.upload.RETRY_BASE_DELAY", 0)
+    def test_gives_up(self, tmp_path: Path):
+        image_path = create_images(tmp_path)[0]
+        dest_fs = get_fs(str(tmp_path), "dir")
+
+        with (
+            mock.patch(
+                "photosite_backend.upload.transfer_file", side_effect=ConnectionError()
+            ) as transfer_file,
+            pytest.raises(ConnectionError),
+            Uploader(dest_fs, retries=2) as uploader,
+        ):
+            uploader.submit(image_path, "asdf.jpg")
+
+        assert transfer_file.call_count == 3
+
+    def test_missing_file_not_retried(self, tmp_path: Path):
+        dest_fs = get_fs(str(tmp_path), "dir")
+
+        with (
+            pytest.raises(FileNotFoundError),
+            Uploader(dest_fs) as uploader,
+        ):
+            uploader.submit(tmp_path / "missing.jpg", "asdf.jpg")
+
+
+class TestDestListing:
+    def dest(self, tmp_path: Path):
+        dest_path = tmp_path / "dest"
+        dest_path.mkdir()
+        return dest_path, get_fs(str(dest_path), "dir")
+
+    @pytest.mark.parametrize("verify", ["exists", "size", "checksum"])
+    def test_skips_existing(self, tmp_path: Path, verify):
+        image_paths = create_images(tmp_path)
+        dest_path, dest_fs = self.dest(tmp_path)
+        (dest_path / "photo_1.jpg").write_bytes(image_paths[0].read_bytes())
+
+        listing = DestListing(dest_fs, verify)
+        with (
+            mock.patch.object(dest_fs, "ls", wraps=dest_fs.ls) as ls,
+            Uploader(dest_fs, listing=listing) as uploader,
+        ):
+            for image_path in image_paths:
+                uploader.submit(image_path, image_path.name)
+            uploader.wait()
+            # everything is known about after the one listing
+            for image_path in image_paths:
+                uploader.submit(image_path, image_path.name)
+
+        assert ls.call_count == 1
+        assert uploader.uploaded_files == 2
+        assert uploader.skipped_files == 4
+
+    def test_skips_existing_async(self, tmp_path: Path):
+        image_paths = create_images(tmp_path)
+        dest_path, _ = self.dest(tmp_path)
+        (dest_path / "photo_1.jpg").write_bytes(image_paths[0].read_bytes())
+        dest_fs = DirFileSystem(
+            str(dest_path), AsyncFileSystemWrapper(LocalFileSystem())
+        )
+
+        with Uploader(dest_fs, listing=DestListing(dest_fs)) as uploader:
+            for image_path in image_paths:
+                uploader.submit(image_path, image_path.name)
+
+        assert uploader.uploaded_files == 2
+        assert uploader.skipped_files == 1
+
+    @pytest.mark.parametrize(
+        ("verify", "contents", "uploaded"),
+        [
+            ("exists", b"truncated", False),
+            ("size", b"truncated", True),
+            ("checksum", b"truncated", True),
+            # same size, different contents
+            ("size", None, False),
+            ("checksum", None, True),
+        ],
+    )
+    def test_verify(self, tmp_path: Path, verify, contents, uploaded):
+        image_path = create_images(tmp_path)[0]
+        dest_path, dest_fs = self.dest(tmp_path)
+        if contents is None:
+            contents = bytes(reversed(image_path.read_bytes()))
+        (dest_path / "photo.jpg").write_bytes(contents)
+
+        with Uploader(dest_fs, listing=DestListing(dest_fs, verify)) as uploader:
+            uploader.submit(image_path, "photo.jpg")
+
+        assert uploader.uploaded_files == uploaded
+        assert ((dest_path / "photo.jpg").read_bytes() == contents) != uploaded
+
+    def test_removed(self, tmp_path: Path):
+        image_path = create_images(tmp_path)[0]
+        dest_path, dest_fs = self.dest(tmp_path)
+        (dest_path / "photo.jpg").write_bytes(image_path.read_bytes())
+
+        listing = DestListing(dest_fs)
+        assert listing.has(image_path, "photo.jpg")
+        listing.removed({"photo.jpg"})
+        assert not listing.has(image_path, "photo.jpg")
+
+    def test_landed(self, tmp_path: Path):
+        image_path = create_images(tmp_path)[0]
+        dest_path, dest_fs = self.dest(tmp_path)
+        (dest_path / "photo.jpg").write_bytes(image_path.read_bytes())
+
+        listing = DestListing(dest_fs, "checksum")
+        listing.landed({"photo.jpg", "missing.jpg"})
+        with mock.patch.object(dest_fs, "open") as mock_open:
+            assert listing.has(image_path, "photo.jpg")
+            assert not listing.has(image_path, "missing.jpg")
+
+        # trusted without reading it back
+        mock_open.assert_not_called()
+
+    def test_etag(self):
+        digest = _Digest(part_size=4)
+        digest.write(b"abcdefghij")
+
+        assert digest.md5.hexdigest() == hashlib.md5(b"abcdefghij").hexdigest()
+        parts = b"".join(
+            hashlib.md5(part).digest() for part in (b"abcd", b"efgh", b"ij")
+        )
+        assert digest.etag() == f"{hashlib.md5(parts).hexdigest()}-3"
+
+        small = _Digest(part_size=4)
+        small.write(b"abcdefg")
+        assert small.etag() == hashlib.md5(b"abcdefg").hexdigest()
@@ -0,0 +1,102 @@
+from pathlib import Path
+
+from photosite_backend.tests import create_test_datafile
+from photosite_backend.watch import InotifyWatcher, PollingWatcher, watch_changes
+
+
+class FakeWatcher:
+    def __init__(self, reads):
+        self.reads = list(reads)
+
+    def read(self, timeout):
+        return self.reads.pop(0)
+
+    def close(self):
+        pass
+
+
+class TestInotifyWatcher:
+    def test_reports_changes(self, tmp_path: Path):
+        watcher = InotifyWatcher(tmp_path)
+        try:
+            assert watcher.read(0) == set()
+
+            photo_path = create_test_datafile(tmp_path, "photo_1.jpg")
+            assert watcher.read(1) == {photo_path}
+
+            moved_path = photo_path.rename(tmp_path / "photo_2.jpg")
+            assert watcher.read(1) == {photo_path, moved_path}
+
+            moved_path.unlink()
+            assert watcher.read(1) == {moved_path}
+        finally:
+            watcher.close()
+
+    def test_reports_nested_changes(self, tmp_path: Path):
+        (tmp_path / "2020").mkdir()
+        watcher = InotifyWatcher(tmp_path)
+        try:
+            photo_path = create_test_datafile(tmp_path / "2020", "photo_1.jpg")
+            assert watcher.read(1) == {photo_path}
+
+            # moved in with an image already inside it
+            event_path = tmp_path.parent / f"{tmp_path.name}_event"
+            event_path.mkdir()
+            create_test_datafile(event_path, "photo_2.jpg")
+            event_path = event_path.rename(tmp_path / "2020" / "event")
+            assert watcher.read(1) == {event_path / "photo_2.jpg"}
+
+            nested_path = create_test_datafile(event_path, "photo_3.jpg")
+            assert watcher.read(1) == {nested_path}
+
+            moved_path = event_path.rename(tmp_path.parent / f"{tmp_path.name}_moved")
+            assert watcher.read(1) == {event_path}
+            create_test_datafile(moved_path, "photo_4.jpg")
+            assert watcher.read(0) == set()
+        finally:
+            watcher.close()
+
+
+class TestPollingWatcher:
+    def test_reports_changes(self, tmp_path: Path):
+        existing_path = create_test_datafile(tmp_path, "photo_1.jpg")
+        watcher = PollingWatcher(tmp_path, interval=0)
+
+        assert watcher.read(None) == set()
+
+        photo_path = create_test_datafile(tmp_path, "photo_2.jpg")
+        existing_path.unlink()
+        assert watcher.read(None) == {existing_path, photo_path}
+
+    def test_reports_nested_changes(self, tmp_path: Path):
+        watcher = PollingWatcher(tmp_path, interval=0)
+
+        (tmp_path / "2020").mkdir()
+        photo_path = create_test_datafile(tmp_path / "2020", "photo_1.jpg")
+        photo_path = photo_path.rename(photo_path.with_suffix(".JPG"))
+        assert watcher.read(None) == {photo_path}
+
+
+class TestWatchChanges:
+    def test_debounces_bursts(self, tmp_path: Path):
+        watcher = FakeWatcher(
+            [
+                set(),
+                {tmp_path / "a.jpg"},
+                {tmp_path / "b.jpg"},
+                set(),
+                {tmp_path / "c.jpg"},
+                set(),
+            ]
+        )
+        changes = watch_changes(watcher, debounce=0)
+
+        assert next(changes) == {tmp_path / "a.jpg", tmp_path / "b.jpg"}
+        assert next(changes) == {tmp_path / "c.jpg"}
+
+    def test_lost_changes(self, tmp_path: Path):
+        watcher = FakeWatcher([{tmp_path / "a.jpg"}, None, {tmp_path / "b.jpg"}, set()])
+        changes = watch_changes(watcher, debounce=0)
+
+        assert next(changes) is None
+        assert next(changes) == {tmp_path / "b.jpg"}
@@ -0,0 +1,235 @@
+"""
+This file contains the upload pipeline, which writes many files (images and
+their derivatives) into dest concurrently rather than waiting on each request
+in turn.
+"""
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from photosite_backend.image import TRANSFER_CHUNK_SIZE, transfer_file
+from photosite_backend.image.strip import StripOptions
+from photosite_backend.metrics import count, phase
+
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
+
+    from photosite_backend.journal import SyncJournal
+    from photosite_backend.upload.listing import DestListing
+
+DEFAULT_UPLOAD_CONCURRENCY = 8
+DEFAULT_UPLOAD_RETRIES = 3
+
+# the first retry waits around this long, doubling for each retry after
+RETRY_BASE_DELAY = 0.5
+
+# these won't go away by trying again
+FATAL_ERRORS = (FileNotFoundError, PermissionError, IsADirectoryError)
+
+
+class Uploader:
+    """
+    Uploads files into dest with up to `concurrency` uploads in flight at
+    once, retrying failed uploads with exponential backoff.
+
+    Async filesystems (s3) have their uploads scheduled straight onto their own
+    event loop, anything else is uploaded from a pool of threads. submit blocks
+    while all the slots are in use, so files can be fed in as fast as they are
+    produced without queueing up unbounded work.
+
+    A filename which has already been submitted is skipped, images with the
+    same pixels but different metadata share one. Given a listing of dest,
+    files dest already holds are skipped rather than uploaded again. Given a
+    journal, every file which lands in dest (uploaded or skipped) is recorded
+    in it.
+
+    Use it as a context manager, leaving the block waits for every upload to
+    finish and raises the first error any of them hit.
+    """
+
+    def __init__(
+        self,
+        dest_fs: "DirFileSystem",
+        concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+        retries: int = DEFAULT_UPLOAD_RETRIES,
+        listing: "DestListing | None" = None,
+        journal: "SyncJournal | None" = None,
+    ):
+        self.dest_fs = dest_fs
+        self.retries = retries
+        self.listing = listing
+        self.journal = journal
+
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._futures: list[Future] = []
+        self._submitted: set[str] = set()
+        self._executor = (
+            None if dest_fs.fs.async_impl else ThreadPoolExecutor(concurrency)
+        )
+
+        self._progress_lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.skipped_files = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            self.wait()
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+
+    def submit(
+        self, source_path: Path, filename: str, strip: StripOptions | None = None
+    ):
+        """
+        Uploads source_path into dest as filename, stripping its metadata on the
+        way if strip is given.
+        """
+
+        if filename in self._submitted:
+            # it will be recorded as landed by the upload already submitted
+            self._count_skip()
+            return
+        self._submitted.add(filename)
+
+        self._slots.acquire()
+
+        if self._executor:
+            future = self._executor.submit(
+                self._upload_sync, source_path, filename, strip
+            )
+        else:
+            # only async filesystems (which have already imported it) need
+            # asyncio, it's slow to import otherwise
+            import asyncio
+
+            future = asyncio.run_coroutine_threadsafe(
+                self._upload_async(source_path, filename, strip), self.dest_fs.fs.loop
+            )
+
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def wait(self):
+        for future in self._futures:
+            future.result()
+
+    def _upload_sync(
+        self, source_path: Path, filename: str, strip: StripOptions | None
+    ):
+        if self.listing and self.listing.has(source_path, filename, strip):
+            self._record_skip(filename)
+            return
+
+        for attempt in range(self.retries + 1):
+            try:
+                with phase("upload"):
+                    transfer_file(self.dest_fs, source_path, filename, strip)
+                break
+            except FATAL_ERRORS:
+                raise
+            except OSError as error:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self._retry_delay(source_path, attempt, error))
+
+        self._record_progress(source_path, filename)
+
+    async def _upload_async(
+        self, source_path: Path, filename: str, strip: StripOptions | None
+    ):
+        import asyncio
+
+        # listing (once) and verifying block, so are kept off the event loop
+        if self.listing and await asyncio.to_thread(
+            self.listing.has, source_path, filename, strip
+        ):
+            self._record_skip(filename)
+            return
+
+        for attempt in range(self.retries + 1):
+            try:
+                with phase("upload"):
+                    if strip is not None:
+                        # stripping writes through a file object, which is
+                        # only usable synchronously
+                        await asyncio.to_thread(
+                            transfer_file, self.dest_fs, source_path, filename, strip
+                        )
+                    else:
+                        await self.dest_fs.fs._put_file(
+                            str(source_path),
+                            self.dest_fs._join(filename),
+                            # files over twice this are sent as a multipart
+                            # upload, streamed a part at a time
+                            chunksize=TRANSFER_CHUNK_SIZE,
+                        )
+                break
+            except FATAL_ERRORS:
+                raise
+            except OSError as error:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(source_path, attempt, error))
+
+        self._record_progress(source_path, filename)
+
+    def _retry_delay(self, source_path: Path, attempt: int, error: OSError):
+        delay = RETRY_BASE_DELAY * 2**attempt
+        delay += random.uniform(0, delay)
+        count("upload.retries")
+
+        logging.warning(
+            "Failed to upload `%s` (%s), retrying in %.1fs",
+            source_path.name,
+            error,
+            delay,
+        )
+        return delay
+
+    def _record_skip(self, filename: str):
+        if self.journal:
+            self.journal.landed_in_dest(filename)
+
+        self._count_skip()
+
+    def _count_skip(self):
+        count("upload.skipped")
+        with self._progress_lock:
+            self.skipped_files += 1
+
+    def _record_progress(self, source_path: Path, filename: str):
+        if self.listing:
+            self.listing.uploaded(filename)
+        if self.journal:
+            self.journal.landed_in_dest(filename)
+
+        logging.info(
+            "Wrote `%s` to `%s/%s`", source_path.name, self.dest_fs.path, filename
+        )
+
+        size = source_path.stat().st_size
+        count("upload.files")
+        count("upload.bytes", size)
+
+        with self._progress_lock:
+            self.uploaded_files += 1
+            self.uploaded_bytes += size
+
+            elapsed = time.monotonic() - self._started_at
+            logging.info(
+                "Uploaded %d files, %.1f MB at %.1f MB/s",
+                self.uploaded_files,
+                self.uploaded_bytes / 2**20,
+                self.uploaded_bytes / 2**20 / elapsed if elapsed else 0,
+            )
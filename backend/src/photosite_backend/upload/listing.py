@@ -0,0 +1,196 @@
+"""
+This file contains the listing of the files already in dest, so uploading a
+file dest already holds can be skipped. As files are content addressed, one
+with the right name almost always has the right contents, so by default that's
+all that's checked.
+
+Dest is listed in one go the first time a file is checked, and the listing is
+kept up to date with what's uploaded and removed through it after that, so a
+whole run (or a long running watch) costs a single listing however many files
+are checked.
+
+The size of a file can be verified too, and its checksum. For local dests the
+checksum is an MD5 of the file read back, for s3 it's compared against the
+object's ETag, which is the MD5 of objects uploaded in one go and an MD5 of
+each part's MD5s for multipart uploads. Either way the source is streamed
+through the same metadata stripping it would be uploaded with, so stripped
+images are compared against what would actually be written.
+"""
+
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Literal
+
+from photosite_backend.backends import is_local
+from photosite_backend.image import TRANSFER_CHUNK_SIZE
+from photosite_backend.image.strip import StripOptions, strip_metadata
+from photosite_backend.metrics import count, phase
+
+if TYPE_CHECKING:
+    from fsspec.implementations.dirfs import DirFileSystem
+
+VerifyMode = Literal["exists", "size", "checksum"]
+
+# set on listed files which were uploaded during the run, so aren't verified
+VERIFIED_KEY = "verified"
+
+
+class _Digest:
+    """
+    A file-like sink which measures and checksums what's written to it, both
+    as a whole and as s3 would for a multipart upload in parts of part_size.
+    """
+
+    def __init__(self, part_size: int = TRANSFER_CHUNK_SIZE):
+        self.part_size = part_size
+        self.size = 0
+        self.md5 = hashlib.md5(usedforsecurity=False)
+
+        self._part_digests: list[bytes] = []
+        self._part = hashlib.md5(usedforsecurity=False)
+        self._part_filled = 0
+
+    def write(self, data: bytes | memoryview):
+        data = memoryview(data)
+        written = len(data)
+        self.size += written
+        self.md5.update(data)
+
+        while data:
+            take = min(len(data), self.part_size - self._part_filled)
+            self._part.update(data[:take])
+            self._part_filled += take
+            data = data[take:]
+
+            if self._part_filled == self.part_size:
+                self._part_digests.append(self._part.digest())
+                self._part = hashlib.md5(usedforsecurity=False)
+                self._part_filled = 0
+
+        return written
+
+    def etag(self):
+        # files under twice the part size are uploaded in one go
+        if self.size < 2 * self.part_size:
+            return self.md5.hexdigest()
+
+        digests = list(self._part_digests)
+        if self._part_filled:
+            digests.append(self._part.digest())
+        combined = hashlib.md5(b"".join(digests), usedforsecurity=False)
+        return f"{combined.hexdigest()}-{len(digests)}"
+
+
+def _digest(source_path: Path, strip: StripOptions | None):
+    digest = _Digest()
+    if strip is not None:
+        strip_metadata(source_path, digest, strip)
+        return digest
+
+    with source_path.open("rb") as source:
+        while chunk := source.read(TRANSFER_CHUNK_SIZE):
+            digest.write(chunk)
+
+    return digest
+
+
+class DestListing:
+    def __init__(self, dest_fs: "DirFileSystem", verify: VerifyMode = "exists"):
+        self.dest_fs = dest_fs
+        self.verify = verify
+
+        self._lock = threading.Lock()
+        self._files: dict[str, dict[str, Any]] | None = None
+
+    def _listed(self):
+        with self._lock:
+            if self._files is None:
+                # anything cached from earlier in the run may be out of date
+                self.dest_fs.invalidate_cache("")
+                with phase("list_dest"):
+                    entries = self.dest_fs.ls("", detail=True)
+                count("dest.listings")
+
+                self._files = {
+                    entry["name"].rsplit("/", 1)[-1]: entry
+                    for entry in entries
+                    if entry["type"] == "file"
+                }
+                logging.info("Found %d files in dest", len(self._files))
+
+            return self._files
+
+    def has(self, source_path: Path, filename: str, strip: StripOptions | None = None):
+        """
+        Whether dest already holds source_path as filename, checked as
+        thoroughly as verify says.
+        """
+
+        info = self._listed().get(filename)
+        if info is None:
+            return False
+        if self.verify == "exists" or info.get(VERIFIED_KEY):
+            return True
+
+        if strip is None and self.verify == "size":
+            matches = info["size"] == source_path.stat().st_size
+        else:
+            digest = _digest(source_path, strip)
+            matches = info["size"] == digest.size
+            if matches and self.verify == "checksum":
+                matches = self._checksum_matches(filename, info, digest)
+
+        if not matches:
+            logging.warning("`%s` in dest doesn't match `%s`", filename, source_path)
+            count("dest.mismatches")
+
+        return matches
+
+    def holds(self, filename: str):
+        """
+        Whether dest holds filename, as far as can be told without a source
+        file to check it against: any file with that name if verify is exists,
+        otherwise only one already verified this run.
+        """
+
+        info = self._listed().get(filename)
+        if info is None:
+            return False
+
+        return self.verify == "exists" or bool(info.get(VERIFIED_KEY))
+
+    def _checksum_matches(self, filename: str, info: dict[str, Any], digest: _Digest):
+        if is_local(self.dest_fs):
+            dest_md5 = hashlib.md5(usedforsecurity=False)
+            with self.dest_fs.open(filename, "rb") as file:
+                while chunk := file.read(TRANSFER_CHUNK_SIZE):
+                    dest_md5.update(chunk)
+            return dest_md5.hexdigest() == digest.md5.hexdigest()
+
+        # an object uploaded with different part sizes won't match, and is
+        # uploaded again
+        return info.get("ETag", "").strip('"') == digest.etag()
+
+    def uploaded(self, filename: str):
+        self._listed()[filename] = {
+            "name": filename,
+            "type": "file",
+            VERIFIED_KEY: True,
+        }
+
+    def landed(self, filenames: set[str]):
+        """
+        Marks files known to have landed intact (by an interrupted sync which is
+        being resumed) as verified, if dest still holds them.
+        """
+
+        files = self._listed()
+        for filename in filenames & files.keys():
+            files[filename][VERIFIED_KEY] = True
+
+    def removed(self, filenames: set[str]):
+        files = self._listed()
+        for filename in filenames:
+            files.pop(filename, None)
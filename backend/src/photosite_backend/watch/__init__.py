@@ -0,0 +1,241 @@
+"""
+This file contains the filesystem watchers used by the watch command, which
+report which files in a directory (or any directory under it) have been
+written, moved or deleted.
+
+On linux changes are read from inotify (through ctypes, so there is no extra
+dependency), with a watch on every directory in the tree. Anywhere else or if
+inotify can't be used the directory is polled instead.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from typing import Iterator, Protocol
+
+from photosite_backend.image.scan import ScanOptions, get_images
+
+DEFAULT_DEBOUNCE = 1.0
+DEFAULT_POLL_INTERVAL = 2.0
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# only report files once they have been completely written, not every write.
+# creates are only watched for to start watching new directories
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_CREATE
+
+# the directory tree can't be watched whole, with no watches (or memory) left
+WATCH_LIMIT_ERRORS = (errno.ENOSPC, errno.ENOMEM)
+
+# struct inotify_event, followed by a null padded name of len bytes
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 2**10
+
+
+class Watcher(Protocol):
+    def read(self, timeout: float | None) -> set[Path] | None:
+        """
+        Waits up to timeout seconds (forever if None) for changes. Returns the
+        paths which changed, or None if changes were lost and the whole
+        directory needs checking. A directory which was removed is returned
+        rather than each file that was in it.
+        """
+        ...
+
+    def close(self): ...
+
+
+class InotifyWatcher:
+    def __init__(self, path: Path):
+        self.path = path
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # the directory each watch descriptor is watching
+        self._directories: dict[int, Path] = {}
+        try:
+            self._watch_tree(path)
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _watch(self, directory: Path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_add_watch failed for `{directory}`")
+
+        self._directories[wd] = directory
+
+    def _watch_tree(self, directory: Path, files: set[Path] | None = None):
+        """
+        Watches directory and every directory under it, adding the files in
+        them to files if given.
+        """
+
+        self._watch(directory)
+        for parent, dirnames, filenames in os.walk(directory):
+            parent_path = Path(parent)
+            for dirname in dirnames:
+                try:
+                    self._watch(parent_path / dirname)
+                except OSError as error:
+                    if error.errno in WATCH_LIMIT_ERRORS:
+                        raise
+                    # e.g. removed since its parent was listed
+            if files is not None:
+                files.update(parent_path / filename for filename in filenames)
+
+    def _unwatch_tree(self, directory: Path):
+        for wd, watched in list(self._directories.items()):
+            if watched == directory or directory in watched.parents:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._directories[wd]
+
+    def read(self, timeout: float | None):
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        data = os.read(self._fd, READ_SIZE)
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self._directories.pop(wd, None)
+                continue
+
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / os.fsdecode(name)
+
+            if not mask & IN_ISDIR:
+                # files are reported once written, not when created
+                if not mask & IN_CREATE:
+                    changed.add(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                # anything written into it before it was watched is reported
+                # by walking it
+                try:
+                    self._watch_tree(path, changed)
+                except OSError as error:
+                    logging.warning("Can't watch `%s` (%s)", path, error)
+                    return None
+            else:
+                self._unwatch_tree(path)
+                changed.add(path)
+
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    def __init__(
+        self,
+        path: Path,
+        interval: float = DEFAULT_POLL_INTERVAL,
+        options: ScanOptions = ScanOptions(),
+    ):
+        self.path = path
+        self.interval = interval
+        self.options = options
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for image_path, stat in get_images(self.path, self.options):
+            snapshot[image_path] = (stat.st_size, stat.st_mtime_ns)
+
+        return snapshot
+
+    def read(self, timeout: float | None):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+
+        snapshot = self._scan()
+        changed = {
+            path
+            for path in snapshot.keys() | self._snapshot.keys()
+            if snapshot.get(path) != self._snapshot.get(path)
+        }
+        self._snapshot = snapshot
+
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_watcher(
+    path: Path, poll: bool = False, options: ScanOptions = ScanOptions()
+) -> Watcher:
+    """
+    Watches path with inotify if possible, otherwise by polling the images
+    options picks out of it.
+    """
+
+    if not poll:
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError, TypeError) as error:
+            logging.warning("Can't use inotify (%s), polling instead", error)
+
+    return PollingWatcher(path, options=options)
+
+
+def watch_changes(
+    watcher: Watcher, debounce: float = DEFAULT_DEBOUNCE
+) -> Iterator[set[Path] | None]:
+    """
+    Yields batches of changed paths. Once something changes, changes are
+    collected until none have happened for debounce seconds, so a burst of
+    files being copied in is handled as one batch.
+
+    Yields None instead if changes were lost, and the whole directory needs
+    checking.
+    """
+
+    while True:
+        changed = watcher.read(None)
+        if changed == set():
+            continue
+
+        while True:
+            more = watcher.read(debounce)
+            if not more:
+                if more is None:
+                    changed = None
+                break
+
+            if changed is not None:
+                changed |= more
+
+        yield changed
@@ -1,8 +1,23 @@
 import { useState } from "react";
-import { ManifestEntry, useManifest } from "./manifest.ts";
+import { DerivativeEntry, ManifestEntry, useManifest } from "./manifest.ts";
 
 const BACKEND_URL = Deno.env.get("BACKEND_URL") ?? "http://127.0.0.1/";
 
+// the width images are displayed at in the grid
+const IMAGE_SIZES = "300px";
+
+// preferred first, the browser picks the first source it supports
+const DERIVATIVE_FORMATS: DerivativeEntry["format"][] = ["avif", "webp", "jpeg"];
+
+const srcSet = (derivatives: DerivativeEntry[]) =>
+  derivatives
+    .map((derivative) =>
+      `${
+        new URL(derivative.filename, BACKEND_URL).toString()
+      } ${derivative.width}w`
+    )
+    .join(", ");
+
 type GalleryImageProps = {
   manifestEntry: ManifestEntry;
 };
@@ -16,8 +31,10 @@ const GalleryImage = (
 		overflow: hidden;
 	}
 
-	.image > img {
+	.image img {
     width: 100%;
+    height: auto;
+    background-size: cover;
 	}
 
   .image > span {
@@ -31,9 +48,32 @@ const GalleryImage = (
       </style>
 
       <div className="image">
-        <img
-          src={new URL(manifestEntry.filename, BACKEND_URL).toString()}
-        />
+        <picture>
+          {DERIVATIVE_FORMATS.map((format) => {
+            const derivatives = (manifestEntry.derivatives ?? []).filter(
+              (derivative) => derivative.format === format,
+            );
+            return derivatives.length > 0 && (
+              <source
+                key={format}
+                type={`image/${format}`}
+                srcSet={srcSet(derivatives)}
+                sizes={IMAGE_SIZES}
+              />
+            );
+          })}
+          {/* the size reserves the image's space before it loads, with the
+              placeholder showing through until it does */}
+          <img
+            src={new URL(manifestEntry.filename, BACKEND_URL).toString()}
+            loading="lazy"
+            width={manifestEntry.width}
+            height={manifestEntry.height}
+            style={manifestEntry.placeholder
+              ? { backgroundImage: `url("${manifestEntry.placeholder}")` }
+              : undefined}
+          />
+        </picture>
 
         <span>{manifestEntry.created_date}</span>
         <br />
@@ -2,24 +2,184 @@ import { useEffect, useState } from "react";
 
 const BACKEND_URL = Deno.env.get("BACKEND_URL") ?? "http://127.0.0.1/";
 
-const MANIFEST_URL = new URL("manifest.json", BACKEND_URL);
+// set when the backend was synced with --precompress, e.g. "br". on s3 the
+// compressed copies are served with a Content-Encoding, so the browser
+// decompresses them itself, but a plain file server sends them as is.
+const MANIFEST_COMPRESSION = Deno.env.get("MANIFEST_COMPRESSION");
+
+const manifestFileURL = (filename: string) =>
+  new URL(
+    MANIFEST_COMPRESSION ? `${filename}.${MANIFEST_COMPRESSION}` : filename,
+    BACKEND_URL,
+  );
+
+export type DerivativeEntry = {
+  filename: string;
+  width: number;
+  height: number;
+  format: "webp" | "avif" | "jpeg";
+};
 
 export type ManifestEntry = {
   filename: string;
   created_date: string | undefined;
   keyword_tags: string[];
+  hierarchical_subjects?: string[];
+  derivatives?: DerivativeEntry[];
+  perceptual_hash?: string;
+  // as shown, with the exif orientation applied
+  width?: number;
+  height?: number;
+  // a data URI of a tiny version of the image, to show while it loads
+  placeholder?: string;
 };
 
 export type Manifest = {
-  version: string;
-  images: ManifestEntry[];
+  version: number;
+  images: Record<string, ManifestEntry>;
+};
+
+// v3 manifests are an index of shards, oldest first
+type ShardEntry = {
+  filename: string;
+  count: number;
+  first_date: string | null;
+  last_date: string | null;
+};
+
+type ManifestIndex = {
+  version: number;
+  image_count: number;
+  shards: ShardEntry[];
+  keywords?: Record<string, { filename: string; count: number }>;
+};
+
+type Shard = {
+  images: Record<string, ManifestEntry>;
+};
+
+// columnar manifests store each field as its own array
+type ColumnarManifest = {
+  version: number;
+  tags: string[];
+  images: {
+    hash: string[];
+    suffix?: string[];
+    filename?: string[];
+    created_date: (string | undefined)[];
+    keyword_tags: number[][];
+    hierarchical_subjects?: (number[] | null)[];
+    derivatives?: ([string, number, number, DerivativeEntry["format"]][] | null)[];
+    perceptual_hash?: (string | null)[];
+    width?: (number | null)[];
+    height?: (number | null)[];
+    placeholder?: (string | null)[];
+  };
+};
+
+const SHARDED_MANIFEST_VERSION = 3;
+const COLUMNAR_MANIFEST_VERSION = 4;
+
+const fromColumnar = (columnar: ColumnarManifest): Manifest => {
+  const { tags, images: columns } = columnar;
+
+  const images: Record<string, ManifestEntry> = {};
+  columns.hash.forEach((hash, row) => {
+    const subjects = columns.hierarchical_subjects?.[row];
+    const derivatives = columns.derivatives?.[row];
+
+    images[hash] = {
+      filename: columns.suffix
+        ? hash + columns.suffix[row]
+        : columns.filename![row],
+      created_date: columns.created_date[row],
+      keyword_tags: columns.keyword_tags[row].map((tagId) => tags[tagId]),
+      hierarchical_subjects: subjects?.map((tagId) => tags[tagId]),
+      derivatives: derivatives?.map(([suffix, width, height, format]) => ({
+        filename: hash + suffix,
+        width,
+        height,
+        format,
+      })),
+      perceptual_hash: columns.perceptual_hash?.[row] ?? undefined,
+      width: columns.width?.[row] ?? undefined,
+      height: columns.height?.[row] ?? undefined,
+      placeholder: columns.placeholder?.[row] ?? undefined,
+    };
+  });
+
+  return { version: columnar.version, images };
 };
 
-const getManifest = async () => {
-  const response = await fetch(MANIFEST_URL);
-  const manifestContents = await response.json();
+// the manifest is always a json object, so a body starting with anything else
+// is still compressed. the Content-Encoding header can't be checked instead,
+// as it isn't exposed to cross origin requests.
+const JSON_OBJECT_START = "{".charCodeAt(0);
+
+const fetchJSON = async <T,>(filename: string) => {
+  const response = await fetch(manifestFileURL(filename));
+  if (!MANIFEST_COMPRESSION) {
+    return await response.json() as T;
+  }
+
+  const body = new Uint8Array(await response.arrayBuffer());
+  if (body[0] === JSON_OBJECT_START) {
+    return JSON.parse(new TextDecoder().decode(body)) as T;
+  }
+  if (MANIFEST_COMPRESSION === "gz") {
+    const decompressed = new Blob([body]).stream().pipeThrough(
+      new DecompressionStream("gzip"),
+    );
+    return await new Response(decompressed).json() as T;
+  }
+
+  // browsers can't decompress brotli by hand, so the uncompressed copy it sits
+  // next to is fetched instead
+  const uncompressed = await fetch(new URL(filename, BACKEND_URL));
+  return await uncompressed.json() as T;
+};
+
+const getManifest = async (
+  onUpdate: (manifest: Manifest) => void,
+) => {
+  const manifestContents = await fetchJSON<
+    Manifest | ManifestIndex | ColumnarManifest
+  >("manifest.json");
+
+  if (manifestContents.version === COLUMNAR_MANIFEST_VERSION) {
+    onUpdate(fromColumnar(manifestContents as ColumnarManifest));
+    return;
+  }
+
+  if (manifestContents.version < SHARDED_MANIFEST_VERSION) {
+    onUpdate(manifestContents as Manifest);
+    return;
+  }
+
+  const index = manifestContents as ManifestIndex;
+  const fetchShard = (shard: ShardEntry) =>
+    fetchJSON<Shard>(shard.filename);
+
+  const [newest, ...older] = [...index.shards].reverse();
+  if (!newest) {
+    onUpdate({ version: index.version, images: {} });
+    return;
+  }
+
+  // the older shards are all fetched at once, alongside the newest one which
+  // is shown as soon as it arrives
+  const olderShards = Promise.all(older.map(fetchShard));
+  const newestShard = await fetchShard(newest);
+  onUpdate({ version: index.version, images: newestShard.images });
 
-  return manifestContents as Manifest;
+  if (older.length) {
+    // merged into one new object, rather than copied again for each shard
+    const images = { ...newestShard.images };
+    for (const shard of await olderShards) {
+      Object.assign(images, shard.images);
+    }
+    onUpdate({ version: index.version, images });
+  }
 };
 
 export const useManifest = () => {
@@ -27,10 +187,11 @@ export const useManifest = () => {
 
   useEffect(() => {
     const manifestEffect = async () => {
-      const manifestContents = await getManifest();
-      if (manifestContents) {
-        setManifest(manifestContents);
-      }
+      await getManifest((manifestContents) => {
+        if (manifestContents) {
+          setManifest(manifestContents);
+        }
+      });
     };
     manifestEffect();
   }, []);